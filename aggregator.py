@@ -0,0 +1,418 @@
+'''Fleet aggregator: polls the /sensors snapshot of every growroom node concurrently and serves them merged on /fleet.
+
+    python aggregator.py room1=10.0.0.11:4200 room2=10.0.0.12:4200 --port 4300
+    python aggregator.py --standins 3 --stalled
+
+Every node keeps a small pool of keep-alive connections, so a sweep costs about one round trip of the slowest node.
+A node that doesn't answer within its timeout is marked down and retried with exponential backoff, without holding up the others.
+/fleet/history fans a /history query out to every node the same way.
+--standins starts local API nodes on simulated hardware, and --stalled adds one that accepts connections but never answers.'''
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from urllib.parse import urlencode
+
+from flask import Flask, make_response, request
+
+from runtime import runtime as default_runtime
+
+
+class HTTPError(Exception):
+    '''Raised for a malformed response, or a status code the caller didn't expect.'''
+
+
+class Connection:
+    '''One keep-alive HTTP/1.1 connection to a node.'''
+
+    def __init__(self, host, reader, writer):
+
+        self.host = host
+        self.reader = reader
+        self.writer = writer
+        self.reusable = True
+
+    @classmethod
+    async def open(cls, host, port):
+
+        reader, writer = await asyncio.open_connection(host, port)
+
+        return cls(host, reader, writer)
+
+    async def request(self, method, path, headers=None):
+        '''Sends a request and returns (status, headers, body), header names lower-cased.'''
+
+        lines = ["%s %s HTTP/1.1" % (method, path), "Host: %s" % self.host, "Connection: keep-alive"]
+        lines.extend("%s: %s" % item for item in (headers or {}).items())
+
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await self.writer.drain()
+
+        # a half read response leaves the connection unusable, it's only marked reusable again once the body is complete
+        self.reusable = False
+
+        status_line = await self.reader.readline()
+
+        try:
+            _, status, _ = status_line.decode("latin-1").split(" ", 2)
+            status = int(status)
+        except ValueError:
+            raise HTTPError("Malformed status line %r" % status_line)
+
+        response_headers = {}
+
+        while True:
+            line = await self.reader.readline()
+
+            if line in (b"\r\n", b"\n", b""):
+                break
+
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if status in (204, 304) or method == "HEAD":
+            body = b""
+        elif response_headers.get("transfer-encoding", "").lower() == "chunked":
+            body = await self._read_chunked()
+        elif "content-length" in response_headers:
+            body = await self.reader.readexactly(int(response_headers["content-length"]))
+        else:
+            # no length, the body runs until the node closes the connection
+            body = await self.reader.read()
+            return status, response_headers, body
+
+        self.reusable = response_headers.get("connection", "").lower() != "close"
+
+        return status, response_headers, body
+
+    async def _read_chunked(self):
+
+        chunks = []
+
+        while True:
+            size = int((await self.reader.readline()).split(b";", 1)[0], 16)
+
+            if size == 0:
+                # trailers, up to the blank line
+                while (await self.reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+
+                return b"".join(chunks)
+
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readexactly(2)
+
+    def close(self):
+
+        self.reusable = False
+        self.writer.close()
+
+
+class Node:
+    '''One growroom node, polled through a pool of up to "connections" keep-alive connections.
+    Requests taking longer than "timeout" seconds fail, and every failed poll doubles the wait before the next one, from "backoff" up to "max_backoff" seconds.'''
+
+    def __init__(self, name, host, port, timeout=2.0, connections=2, backoff=1.0, max_backoff=60.0):
+
+        self.name = name
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        # idle connections, and a semaphore capping the open ones
+        self.idle = []
+        self.slots = asyncio.Semaphore(connections)
+
+        # poll state
+        self.snapshot = None
+        self.etag = None
+        self.updated = None
+        self.latency = None
+        self.error = None
+        self.failures = 0
+        self.retry_at = 0.0
+
+    async def _request(self, method, path, headers):
+
+        async with self.slots:
+            connection = self.idle.pop() if self.idle else None
+            reused = connection is not None
+
+            try:
+                if connection is None:
+                    connection = await Connection.open(self.host, self.port)
+
+                try:
+                    response = await connection.request(method, path, headers)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    if not reused:
+                        raise
+
+                    # the node closed an idle connection, try once more on a new one
+                    connection.close()
+                    connection = await Connection.open(self.host, self.port)
+                    response = await connection.request(method, path, headers)
+
+            except BaseException:
+                if connection is not None:
+                    connection.close()
+                raise
+
+            if connection.reusable:
+                self.idle.append(connection)
+            else:
+                connection.close()
+
+            return response
+
+    async def get(self, path, headers=None, expect=(200, )):
+        '''GETs "path" within the node's timeout and returns (status, headers, body). Raises HTTPError for any status not in "expect".'''
+
+        status, headers, body = await asyncio.wait_for(self._request("GET", path, headers), self.timeout)
+
+        if status not in expect:
+            raise HTTPError("%s answered %d" % (path, status))
+
+        return status, headers, body
+
+    async def poll(self):
+        '''Refreshes the node's /sensors snapshot unless it is backing off. Never raises, failures are kept in "error".'''
+
+        if time.monotonic() < self.retry_at:
+            return
+
+        start = time.monotonic()
+
+        try:
+            # the node answers 304 until a reading changes
+            status, headers, body = await self.get("/sensors", {"If-None-Match": '"%s"' % self.etag} if self.etag else None,
+                                                   expect=(200, 304))
+
+            if status == 200:
+                self.snapshot = json.loads(body)
+                self.etag = headers.get("etag", "").strip('"') or None
+
+        except Exception as error:
+            self.failures += 1
+            self.error = repr(error) if not isinstance(error, asyncio.TimeoutError) else "timed out after %ss" % self.timeout
+
+            # exponential backoff with a little jitter, so nodes that failed together aren't retried together
+            delay = min(self.max_backoff, self.backoff * 2 ** (self.failures - 1))
+            self.retry_at = time.monotonic() + delay * random.uniform(1.0, 1.1)
+            return
+
+        self.failures = 0
+        self.error = None
+        self.retry_at = 0.0
+        self.updated = time.time()
+        self.latency = time.monotonic() - start
+
+    def status(self, now=None):
+        '''Returns the node's fields in the fleet snapshot.'''
+
+        now = now or time.time()
+
+        if self.error is None and self.updated is not None:
+            state = "up"
+        elif self.snapshot is not None:
+            state = "stale"
+        else:
+            state = "down"
+
+        return {
+            "address": "%s:%d" % (self.host, self.port),
+            "state": state,
+            "error": self.error,
+            "failures": self.failures,
+            "age": None if self.updated is None else round(now - self.updated, 3),
+            "latency": None if self.latency is None else round(self.latency, 4),
+            "retry_in": round(max(0.0, self.retry_at - time.monotonic()), 3) if self.failures else None,
+            "sensors": self.snapshot,
+        }
+
+    def close(self):
+
+        while self.idle:
+            self.idle.pop().close()
+
+
+class Aggregator:
+    '''Polls every node concurrently every "interval" seconds on the runtime loop, and merges their snapshots.'''
+
+    def __init__(self, nodes, interval=5.0, runtime=None):
+
+        self.nodes = {node.name: node for node in nodes}
+        self.interval = interval
+        self.runtime = runtime or default_runtime
+        self.task = None
+
+        # duration of the last sweep over every node
+        self.sweep_seconds = None
+        self.swept = None
+
+    def start(self):
+        '''Starts polling. Call from a runtime startup hook.'''
+
+        if self.task is None:
+            self.task = self.runtime.spawn(self.run(), name="aggregator")
+
+    async def run(self):
+
+        try:
+            while True:
+                await self.sweep()
+                await asyncio.sleep(self.interval)
+        finally:
+            for node in self.nodes.values():
+                node.close()
+
+    async def sweep(self):
+        '''Polls every node at once, each bound by its own timeout, so the sweep takes as long as the slowest node.'''
+
+        start = time.monotonic()
+
+        await asyncio.gather(*(node.poll() for node in self.nodes.values()))
+
+        self.sweep_seconds = time.monotonic() - start
+        self.swept = time.time()
+
+    def snapshot(self):
+        '''Returns the fleet-wide snapshot: every node's latest sensors, and how current they are.'''
+
+        now = time.time()
+        nodes = {name: node.status(now) for name, node in sorted(self.nodes.items())}
+
+        return {
+            "timestamp": now,
+            "swept": self.swept,
+            "sweep_seconds": None if self.sweep_seconds is None else round(self.sweep_seconds, 4),
+            "up": sum(1 for node in nodes.values() if node["state"] == "up"),
+            "nodes": nodes,
+        }
+
+    async def history(self, query: dict):
+        '''Runs a /history query on every node at once, returning {node: response or {"error"}}. Nodes backing off are skipped.'''
+
+        path = "/history?" + urlencode(query)
+
+        async def fetch(node):
+
+            if time.monotonic() < node.retry_at:
+                return {"error": "backing off: %s" % node.error}
+
+            try:
+                _, _, body = await node.get(path, expect=(200, 404))
+                return json.loads(body)
+            except asyncio.TimeoutError:
+                return {"error": "timed out after %ss" % node.timeout}
+            except Exception as error:
+                return {"error": repr(error)}
+
+        results = await asyncio.gather(*(fetch(node) for node in self.nodes.values()))
+
+        return dict(zip(self.nodes, results))
+
+
+def create_app(aggregator: Aggregator):
+    '''Returns the Flask app serving "aggregator".'''
+
+    app = Flask(__name__)
+
+    @app.route("/fleet")
+    def read_fleet():
+        return aggregator.snapshot()
+
+    @app.route("/fleet/history")
+    def read_fleet_history():
+
+        if request.args.get("metric") is None:
+            return make_response('''Missing query param "metric"''', 400)
+
+        # every node is bound by its own timeout, so this never waits much longer than the slowest one
+        timeout = max(node.timeout for node in aggregator.nodes.values()) * 2 + 1.0 if aggregator.nodes else 1.0
+        nodes = aggregator.runtime.submit(aggregator.history(request.args.to_dict()), timeout)
+
+        return {"metric": request.args["metric"], "nodes": nodes}
+
+    return app
+
+
+async def stalled_node(port):
+    '''Local stand-in for a hung node: accepts connections and never answers.'''
+
+    async def hang(reader, writer):
+        await reader.read()
+        writer.close()
+
+    return await asyncio.start_server(hang, "127.0.0.1", port)
+
+
+def parse_node(text):
+    '''Parses "name=host:port", the name defaulting to the address.'''
+
+    name, _, address = text.rpartition("=")
+    host, _, port = address.rpartition(":")
+
+    return name or address, host or "127.0.0.1", int(port)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("nodes", nargs="*", type=parse_node, help="nodes to poll, as name=host:port")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=4300)
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between sweeps")
+    parser.add_argument("--timeout", type=float, default=2.0, help="per node request timeout in seconds")
+    parser.add_argument("--connections", type=int, default=2, help="keep-alive connections per node")
+    parser.add_argument("--standins", type=int, default=0, help="start this many local nodes on simulated hardware")
+    parser.add_argument("--standin-port", type=int, default=4310, help="port of the first stand-in node")
+    parser.add_argument("--stalled", action="store_true", help="add a local node that never answers")
+    args = parser.parse_args()
+
+    nodes = list(args.nodes)
+    servers = []
+
+    if args.standins:
+        # the benchmark's simulated server, each in its own scratch directory
+        from benchmark import Server
+
+        for index in range(args.standins):
+            server = Server(args.standin_port + index)
+            server.start()
+            servers.append(server)
+            nodes.append(("standin%d" % index, "127.0.0.1", server.port))
+
+    runtime = default_runtime
+
+    if args.stalled:
+        port = args.standin_port + args.standins
+        runtime.on_startup(lambda: stalled_node(port))
+        nodes.append(("stalled", "127.0.0.1", port))
+
+    if not nodes:
+        parser.error("no nodes to poll")
+
+    aggregator = Aggregator([Node(name, host, port, timeout=args.timeout, connections=args.connections)
+                             for name, host, port in nodes], interval=args.interval, runtime=runtime)
+    runtime.on_startup(aggregator.start)
+    runtime.start()
+
+    try:
+        create_app(aggregator).run(args.host, args.port, threaded=True)
+    finally:
+        runtime.stop()
+
+        for server in servers:
+            server.stop()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,28 +1,224 @@
 from flask import Flask, make_response, request, render_template, Response
-from gpiozero import InputDevice
-import asyncio
+import math
+import os
+import time
+
+# "sim" runs every device on simulated hardware, for development and load tests off the Pi
+BACKEND = os.environ.get("GROWROOM_BACKEND", "pi")
+
+if BACKEND == "sim":
+    # sets up the environment the device libraries need, so it comes before them
+    import sim
 
 # local
-from devices import DHT22, DS18B20, ADS1115, Camera
+from devices import DHT22, DS18B20Bus, ADS1115, Camera, LevelSensor
 from persistence import task_handler
+import tasks
+from sampler import Sampler
+from runtime import runtime
+from scheduler import RelayScheduler, Cycle, Duty, Window
+from events import EventHub
+from timeseries import TimeSeriesStore
+from rollups import Rollups
+from tds import TdsPipeline, Calibration, recompute
+from controllers import make_rule
+import export
+from shared import snapshot_ages, snapshot_etag
+import arbiter
+import metrics
+
+# devices are created on first use, so the server starts without waiting on hardware
+devices = tasks.devices
+
+# TDS processing, with per-probe calibrations and the DS18B20 temperatures it compensates with
+tds_pipeline = TdsPipeline(".tds")
+
+# the TDS probe the ADS1115 task samples, whose values the history keeps as ads1115.voltage and ads1115.tds
+TDS_PROBE = "ads1115.1"
+
+if BACKEND == "sim":
+    hardware = sim.Hardware()
+
+    devices.register("camera", hardware.camera)
+    devices.register("DHT22", lambda: hardware.dht22(27, 23))
+    devices.register("DS18B20", hardware.ds18b20)
+    devices.register("LLPK1", lambda: hardware.level_sensor(25, debounce=0.02))
+    devices.register("ADS1115", lambda: hardware.ads1115(pipeline=tds_pipeline))
+
+else:
+    # local camera
+    devices.register("camera", Camera)
+
+    # local GPIO devices
+    devices.register("DHT22", lambda: DHT22(27, 23))
+    devices.register("DS18B20", DS18B20Bus)
+    devices.register("LLPK1", lambda: LevelSensor(25, debounce=0.02))
+    devices.register("ADS1115", lambda: ADS1115(pipeline=tds_pipeline))
 
-# local camera
-pi_camera = Camera()
-
-# local GPIO devices
-dht22 = DHT22(27, 23)
-ds18b20 = DS18B20()
-llpk1 = InputDevice(25)
-ads1115 = ADS1115()
 relays = {
     "pump_relay": 24,
 }
 
+# background samplers, requests are answered from their cached readings
+# their readings drive controllers, so they're taken at CONTROL priority, and give up on a bus that stays busy
+async def read_dht22():
+    return await devices["DHT22"].read(arbiter.CONTROL, timeout=10.0)
+
+
+dht22_sampler = Sampler(read_dht22, interval=30.0, ttl=60.0, timeout=15.0)
+ds18b20_sampler = Sampler(lambda: devices["DS18B20"].read_all(arbiter.CONTROL, timeout=3.0), interval=10.0, ttl=30.0, timeout=5.0)
+
+for sampler in (dht22_sampler, ds18b20_sampler):
+    runtime.on_startup(sampler.start)
+
 # start task handler
 th = task_handler(".tasks")
+runtime.on_shutdown(th.close)
+
+# one scheduler drives every relay, picking up loops persisted by older versions as power_loop tasks
+scheduler = RelayScheduler(relays, ".relays")
+runtime.on_startup(lambda: scheduler.adopt(th))
+runtime.on_startup(scheduler.start)
+
+# controllers run as "run_controller" tasks and switch their relays through the scheduler
+tasks.scheduler = scheduler
+
+# stored tasks are restarted once loops have been adopted, so a migrated power_loop never runs
+runtime.on_startup(th.restore)
+runtime.on_shutdown(scheduler.journal.flush)
+
+# sensor history, fed by the samplers
+history = TimeSeriesStore(".history", retention=180 * 86400)
+rollups = Rollups(history, tiers=(60, 900, 3600))
+runtime.on_startup(history.start)
+runtime.on_startup(rollups.start)
+runtime.on_shutdown(history.flush)
+
+# every recorded sample also updates the signal of the same name, waking the controllers that follow it
+history.listeners.append(tasks.signals.publish)
+
+# the level is only recorded when it changes
+tasks.signals.hold("llpk1.level")
+
+
+def record_dht22(reading):
+    history.append("dht22.humidity", reading.value[0], reading.timestamp)
+    history.append("dht22.temperature", reading.value[1], reading.timestamp)
+
+
+def record_llpk1(value, timestamp):
+
+    # only level changes reach here, each stamped with the time of its edge
+    history.append("llpk1.level", value, timestamp)
+
+
+def record_ads1115(metadata):
+    history.append("ads1115.voltage", metadata["averageVoltage"], metadata["timestamp"])
+    history.append("ads1115.tds", metadata["tdsValue"], metadata["timestamp"])
+
+
+def record_ds18b20(reading):
+
+    # the first probe by id is also kept as the plain water temperature
+    for index, (probe, temperature) in enumerate(sorted(reading.value.items())):
+        if index == 0:
+            history.append("ds18b20.temperature", temperature, reading.timestamp)
+
+        history.append("ds18b20." + probe, temperature, reading.timestamp)
+
+
+dht22_sampler.listeners.append(record_dht22)
+ds18b20_sampler.listeners.append(record_ds18b20)
+ds18b20_sampler.listeners.append(tds_pipeline.add_temperatures)
+runtime.on_shutdown(tds_pipeline.journal.flush)
+devices.on_create("LLPK1", lambda llpk1: llpk1.listeners.append(record_llpk1))
+devices.on_create("ADS1115", lambda ads1115: ads1115.listeners.append(record_ads1115))
+
+
+def record_relay(event, relay, data):
+
+    # relay toggles are kept as a 1/0 series per relay
+    if event == "relay":
+        history.append("relay." + relay, 1.0 if data else 0.0)
+
+
+scheduler.listeners.append(record_relay)
+
+# live updates pushed to dashboards, with the minimum seconds between two events of a topic
+hub = EventHub({"DHT22": 5.0, "DS18B20": 5.0, "LLPK1": 0.5, "ADS1115": 2.0, "relay": 0.1})
+
+dht22_sampler.listeners.append(lambda reading: hub.publish("DHT22", dht22_fields(reading)))
+ds18b20_sampler.listeners.append(lambda reading: hub.publish("DS18B20", ds18b20_fields(reading)))
+devices.on_create("LLPK1", lambda llpk1: llpk1.listeners.append(
+    lambda value, timestamp: hub.publish("LLPK1", llpk1_fields(llpk1))))
+devices.on_create("ADS1115", lambda ads1115: ads1115.listeners.append(
+    lambda metadata: hub.publish("ADS1115", ads1115_fields(metadata))))
+th.listeners.append(lambda event, task_id: hub.publish("task", {"event": event, "id": task_id}, key=task_id))
+
+
+def publish_relay(event, relay, data):
+
+    if event == "relay":
+        hub.publish("relay", {"id": relay, "relay_state": data}, key=relay)
+    else:
+        hub.publish("loop", dict(loop_fields(relay), id=relay), key=relay)
+
+
+scheduler.listeners.append(publish_relay)
+
+# relays switched off as soon as the water level drops, and released when it is back
+low_water_interlock = ["pump_relay"]
+
+
+def water_interlock(value, timestamp):
+
+    for relay in low_water_interlock:
+        if value:
+            scheduler.release(relay, "low water")
+        else:
+            scheduler.inhibit(relay, "low water")
+
+
+@devices.on_create("LLPK1")
+def wire_interlock(llpk1):
+
+    llpk1.listeners.append(water_interlock)
+    water_interlock(llpk1.value, llpk1.timestamp)
+
+    # only changes reach the listeners, so the level read at startup is recorded here for history and controllers
+    record_llpk1(llpk1.value, llpk1.timestamp)
+
+
+# the level sensor guards the pump, so it's the one device created at startup rather than on first use
+runtime.on_startup(lambda: devices["LLPK1"])
+
+# values other objects already keep, read when /metrics is scraped
+metrics.Callback("growroom_bus_queue_depth", "Requests waiting for a hardware bus.",
+                 lambda: {(name, ): bus.stats()["depth"] for name, bus in arbiter.arbiters.items()}, ["bus"])
+metrics.Callback("growroom_bus_requests_expired_total", "Bus requests dropped because their deadline passed.",
+                 lambda: {(name, ): sum(counters["expired"] for counters in bus.counters.values())
+                          for name, bus in arbiter.arbiters.items()}, ["bus"], type="counter")
+
+
+def camera_stats():
+
+    camera = devices.peek("camera")
+
+    return camera.stats() if camera is not None else {}
+
+
+metrics.Callback("growroom_camera_viewers", "Connected MJPEG viewers.",
+                 lambda: {(profile, ): stats["viewers"] for profile, stats in camera_stats().items()}, ["profile"])
+metrics.Callback("growroom_camera_frames_delivered_total", "Frames sent to MJPEG viewers.",
+                 lambda: {(profile, ): stats["delivered"] for profile, stats in camera_stats().items()}, ["profile"], type="counter")
+metrics.Callback("growroom_camera_frames_dropped_total", "Frames skipped by MJPEG viewers that fell behind.",
+                 lambda: {(profile, ): stats["dropped"] for profile, stats in camera_stats().items()}, ["profile"], type="counter")
+
+runtime.on_startup(lambda: runtime.spawn(metrics.watch_loop(), name="loop_lag"))
 
 # flask
 app = Flask(__name__)
+metrics.instrument(app)
 
 
 @app.route("/")
@@ -32,30 +228,298 @@ def index():
 
 @app.route('/camera_feed')
 def camera_feed():
-    return Response(pi_camera.gen_stream(), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+    profile = request.args.get("profile", "full")
+
+    if profile not in Camera.PROFILES:
+        return make_response('''Invalid query param "profile"''', 400)
+
+    return Response(devices["camera"].gen_stream(profile), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+
+@app.route('/camera_snapshot')
+def camera_snapshot():
+
+    profile = request.args.get("profile", "full")
+
+    if profile not in Camera.PROFILES:
+        return make_response('''Invalid query param "profile"''', 400)
+
+    return Response(devices["camera"].snapshot(profile), mimetype='image/jpeg')
+
+
+def dht22_fields(reading):
+    '''Formats a DHT22 Reading the way the endpoints report it'''
+
+    if reading is None:
+        return {"humidity": None, "temperature": None, "timestamp": None}
+
+    humidity, temperature = reading.value
+
+    return {"humidity": humidity, "temperature": temperature, "timestamp": reading.timestamp}
+
+
+def ds18b20_fields(reading):
+    '''Formats a DS18B20 bus Reading the way the endpoints report it. "temperature" is the first probe by id.'''
+
+    if reading is None or not reading.value:
+        return {"temperature": None, "probes": {}, "timestamp": None if reading is None else reading.timestamp}
+
+    probes = {probe: round(temperature, 1) for probe, temperature in sorted(reading.value.items())}
+
+    return {"temperature": next(iter(probes.values())), "probes": probes, "timestamp": reading.timestamp}
+
+
+def llpk1_fields(sensor):
+    '''Formats the LLPK1 level the way the endpoints report it, "timestamp" is when the level last changed'''
+
+    if sensor is None:
+        return {"state": None, "timestamp": None}
+
+    return {"state": sensor.value, "timestamp": sensor.timestamp}
+
+
+def ads1115_fields(metadata):
+    '''Formats the ADS1115 TDS metadata the way the endpoints report it'''
+
+    if metadata is None:
+        return {"averageVoltage": None, "tdsValue": None, "temperature": None, "timestamp": None}
+
+    return {
+        "averageVoltage": metadata["averageVoltage"],
+        "tdsValue": metadata["tdsValue"],
+        "temperature": metadata["temperature"],
+        "timestamp": metadata["timestamp"],
+    }
+
+
+def loop_fields(relay):
+    '''Formats a relay's loop state the way /loop reports it'''
+
+    controller = tasks.controllers.get(relay)
+
+    return {
+        "loop_state": "Running" if scheduler.schedule(relay) != None else "Stopped",
+        "loop_info": scheduler.info(relay),
+        "controller": None if controller is None else controller.info(),
+    }
+
+
+def controller_task(relay):
+    return "controller_" + relay
+
+
+def no_reading(sampler):
+    '''503 for a sensor that hasn't been read yet, asking the client to retry once a read had time to finish'''
+
+    response = make_response('''No reading yet''', 503)
+    response.headers["Retry-After"] = str(math.ceil(sampler.timeout))
+
+    return response
 
 
 @app.route("/DHT22")
-async def read_DHT22():
+def read_DHT22():
 
-    try:
-        humidity, temperature = await asyncio.wait_for(dht22.read(), timeout=15.0)
-    except asyncio.TimeoutError:
-        humidity, temperature = None, None
+    reading = dht22_sampler.get()
 
-    return {"humidity": humidity, "temperature": temperature}
+    if reading is None:
+        return no_reading(dht22_sampler)
+
+    return dht22_fields(reading)
 
 
 @app.route("/DS18B20")
 def read_DS18B20():
 
-    return {"temperature": round(ds18b20.read(), 1)}
+    reading = ds18b20_sampler.get()
+
+    if reading is None:
+        return no_reading(ds18b20_sampler)
+
+    return ds18b20_fields(reading)
+
+
+@app.route("/DS18B20/<probe>")
+def read_DS18B20_probe(probe):
+
+    reading = ds18b20_sampler.get()
+
+    if reading is None:
+        return no_reading(ds18b20_sampler)
+
+    fields = ds18b20_fields(reading)
+
+    if probe not in fields["probes"]:
+        return make_response('''Unknown probe''', 404)
+
+    return {"temperature": fields["probes"][probe], "timestamp": fields["timestamp"]}
 
 
 @app.route("/LLPK1")
 def read_LLPK1():
 
-    return {"state": llpk1.value}
+    return llpk1_fields(devices["LLPK1"])
+
+
+@app.route("/history")
+def read_history():
+
+    # query params, "from" and "to" are unix timestamps and default to the last day
+    end = request.args.get("to", time.time(), type=float)
+    start = request.args.get("from", end - 86400, type=float)
+    step = request.args.get("step", 60.0, type=float)
+    metric = request.args.get("metric")
+
+    if step <= 0 or end <= start:
+        return make_response('''Invalid query params "from", "to" or "step"''', 400)
+
+    # keep a single response to a sane number of buckets
+    if (end - start) / step > 100000:
+        return make_response('''Query param "step" is too small for the range''', 400)
+
+    try:
+        tier, buckets = rollups.query(metric, start, end, step)
+    except KeyError:
+        return make_response({"error": '''Unknown metric''', "metrics": history.metrics()}, 404)
+
+    return {
+        "metric": metric,
+        "from": start,
+        "to": end,
+        "step": step,
+        "tier": tier,
+        "buckets": {field: values.tolist() for field, values in buckets.items()},
+    }
+
+
+def export_response(rows, fields, name):
+    '''Streams rows as NDJSON (default) or CSV, chosen by the "format" query param, optionally gzip compressed with "gzip=1".'''
+
+    output = request.args.get("format", "ndjson")
+
+    if output == "csv":
+        lines, mimetype = export.csv_lines(rows, fields), "text/csv"
+    elif output == "ndjson":
+        lines, mimetype = export.ndjson(rows, fields), "application/x-ndjson"
+    else:
+        return make_response('''Invalid query param "format"''', 400)
+
+    chunks = export.chunked(lines)
+    headers = {"Content-Disposition": "attachment; filename=%s.%s" % (name, output)}
+
+    if request.args.get("gzip", "0") == "1":
+        chunks = export.gzipped(chunks)
+        headers["Content-Encoding"] = "gzip"
+
+    return Response(chunks, mimetype=mimetype, headers=headers)
+
+
+def export_range():
+    '''Reads the "from", "to" and "cursor" query params shared by the export endpoints.
+    "cursor" is "<t>,<metric>" of the last record received, to resume an interrupted export right after it.'''
+
+    start = request.args.get("from", None, type=float)
+    end = request.args.get("to", None, type=float)
+    cursor = request.args.get("cursor")
+
+    if cursor:
+        timestamp, metric = cursor.split(",", 1)
+        cursor = (float(timestamp), metric)
+
+    return start, end, cursor or None
+
+
+@app.route("/export/readings")
+def export_readings():
+
+    sensors = [metric for metric in history.metrics() if not metric.startswith("relay.")]
+    names = request.args.get("metrics")
+
+    if names:
+        names = names.split(",")
+
+        if not set(names) <= set(sensors):
+            return make_response('''Invalid query param "metrics"''', 400)
+
+    try:
+        start, end, cursor = export_range()
+    except ValueError:
+        return make_response('''Invalid query param "cursor"''', 400)
+
+    rows = export.records(history, names or sensors, start, end, cursor)
+
+    return export_response(rows, ("t", "metric", "value"), "readings")
+
+
+@app.route("/export/relays")
+def export_relays():
+
+    try:
+        start, end, cursor = export_range()
+    except ValueError:
+        return make_response('''Invalid query param "cursor"''', 400)
+
+    names = [metric for metric in history.metrics() if metric.startswith("relay.")]
+
+    # cursors and rows use the series names, shown as relay ids with on/off states
+    rows = ((timestamp, metric, int(value))
+            for timestamp, metric, value in export.records(history, names, start, end, cursor))
+
+    return export_response(rows, ("t", "metric", "state"), "relays")
+
+
+@app.route("/events")
+def events():
+
+    topics = request.args.get("topics")
+
+    return Response(hub.stream(topics.split(",") if topics else None),
+                    mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def sensor_snapshot():
+    '''Returns every cached sensor value, relay state and loop configuration in one dict. Never touches hardware.
+    Ages are left out, add them with snapshot_ages() at the time of sending.'''
+
+    return {
+        "DHT22": dht22_fields(dht22_sampler.latest),
+        "DS18B20": ds18b20_fields(ds18b20_sampler.latest),
+        "LLPK1": llpk1_fields(devices.peek("LLPK1")),
+        "ADS1115": ads1115_fields(getattr(devices.peek("ADS1115"), "metadata", None)),
+        "relays": {relay: loop_fields(relay) for relay in relays},
+    }
+
+
+@app.route("/metrics")
+def read_metrics():
+
+    return Response(metrics.REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route("/buses")
+def read_buses():
+
+    # queue depth and wait times of every hardware bus arbiter
+    return {name: bus.stats() for name, bus in sorted(arbiter.arbiters.items())}
+
+
+@app.route("/sensors")
+def read_sensors():
+
+    snapshot = sensor_snapshot()
+    etag = snapshot_etag(snapshot)
+
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(snapshot_ages(snapshot))
+
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+
+    return response
 
 
 @app.route("/loop")
@@ -64,49 +528,142 @@ def set_loop():
     # query params
     args = {
         "id": request.args.get("id"),
+        "schedule": request.args.get("schedule", "cycle"),
         "timeOn": request.args.get("timeOn", "60", type=int),
-        "timeOff": request.args.get("timeOff", "300", type=int)
+        "timeOff": request.args.get("timeOff", "300", type=int),
+        "period": request.args.get("period", "600", type=int),
+        "duty": request.args.get("duty", "0.5", type=float),
+        "windows": request.args.get("windows", "06:00-18:00"),
+        "days": request.args.get("days"),
     }
 
     # if no "id" query parameter then return list of all running loops
     if args["id"] == None:
 
-        arr = []
+        return {"running_tasks": th.list_tasks(), "running_loops": scheduler.list()}
 
-        for task in th.tasks_set:
-            arr.append(task.get_name())
+    if args["id"] not in relays:
+        return make_response('''Invalid query param "id"''', 400)
 
-        return {"running_tasks": arr}
+    # main operation
+    execution = request.args.get("execution", "", type=str)
 
-    # set relay in args dict
-    try:
-        args["relay_pin"] = relays[args["id"]]
-    except KeyError:
+    # ?execution=start
+    if execution == "start":
+
+        try:
+            if args["schedule"] == "cycle":
+                schedule = Cycle(args["timeOn"], args["timeOff"])
+            elif args["schedule"] == "duty":
+                schedule = Duty(args["period"], args["duty"])
+            elif args["schedule"] == "window":
+                days = args["days"].split(",") if args["days"] else None
+                schedule = Window(args["windows"].split(","), days)
+            else:
+                return make_response('''Invalid query param "schedule"''', 400)
+        except ValueError as error:
+            return make_response(str(error), 400)
+
+        # a schedule replaces the relay's controller
+        th.stop(controller_task(args["id"]))
+        scheduler.add(args["id"], schedule)
+
+    # ?execution=stop
+    elif execution == "stop":
+        scheduler.remove(args["id"])
+
+    return loop_fields(args["id"])
+
+
+@app.route("/control")
+def set_control():
+    '''Starts or stops a closed-loop controller driving relay "id" from a sensor signal, the name of its history metric.
+    ?mode=hysteresis takes "low", "high" and "direction", ?mode=pid takes "setpoint", "kp", "ki", "kd", "period" and "direction".
+    "min_on" and "min_off" are the seconds the relay is held after switching, "max_age" the seconds after which a signal is too old to act on.'''
+
+    relay = request.args.get("id")
+
+    # without an "id" list every running controller
+    if relay == None:
+        return {"controllers": {relay: controller.info() for relay, controller in tasks.controllers.items()}}
+
+    if relay not in relays:
         return make_response('''Invalid query param "id"''', 400)
 
-    # main operation
     execution = request.args.get("execution", "", type=str)
 
     # ?execution=start
     if execution == "start":
-        th.start('power_loop', args["id"], **args)
+
+        signal = request.args.get("signal", "")
+
+        if not TimeSeriesStore.NAME.match(signal) or signal.startswith("relay."):
+            return make_response('''Invalid query param "signal"''', 400)
+
+        mode = request.args.get("mode", "hysteresis")
+        names = {"hysteresis": ("low", "high"), "pid": ("setpoint", "kp", "ki", "kd", "period")}.get(mode, ())
+
+        try:
+            settings = {name: float(request.args[name]) for name in names if name in request.args}
+            settings["direction"] = request.args.get("direction", "raise")
+
+            # built here only to reject bad settings, the task builds its own
+            make_rule(mode, **settings)
+
+            timing = {name: float(request.args.get(name, default)) for name, default in (("min_on", 60), ("min_off", 60), ("max_age", 600))}
+        except ValueError as error:
+            return make_response(str(error), 400)
+
+        # a controller replaces the relay's schedule
+        scheduler.remove(relay)
+        th.start("run_controller", controller_task(relay), relay=relay, signal=signal, mode=mode, **timing, **settings)
 
     # ?execution=stop
     elif execution == "stop":
-        th.stop(args["id"])
+        th.stop(controller_task(relay))
 
-    task = th.fetch_task(args["id"])
+    return loop_fields(relay)
 
-    # get loop task state
-    if task != None:
-        loop_state = "Running"
-    else:
-        loop_state = "Stopped"
 
-    return {
-        'loop_state': loop_state,
-        'loop_info': th.fetch_task_info(args["id"])
-    }
+@app.route("/calibration")
+def set_calibration():
+
+    probe = request.args.get("probe", TDS_PROBE)
+    current = tds_pipeline.calibration(probe)
+
+    # without any settings this only reports the probe's calibration
+    if not any(key in request.args for key in ("k", "points", "temperature_probe", "coefficient")):
+        return {"probe": probe, "calibration": current.to_dict()}
+
+    # ?points=measured:reference,... in ppm, an empty value clears them
+    points = request.args.get("points")
+
+    try:
+        calibration = Calibration(
+            k=request.args.get("k", current.k, type=float),
+            points=current.points if points is None else [point.split(":") for point in points.split(",") if point],
+            temperature_probe=request.args.get("temperature_probe", current.temperature_probe) or None,
+            coefficient=request.args.get("coefficient", current.coefficient, type=float),
+        )
+    except (ValueError, TypeError):
+        return make_response('''Invalid calibration''', 400)
+
+    tds_pipeline.set_calibration(probe, calibration)
+
+    result = {"probe": probe, "calibration": calibration.to_dict()}
+
+    # ?recompute=1 rewrites the stored TDS history with the new calibration, optionally limited by "from" and "to"
+    if request.args.get("recompute", "0") == "1":
+        if probe != TDS_PROBE:
+            return make_response('''Only the history of probe %s can be recomputed''' % TDS_PROBE, 400)
+
+        start = request.args.get("from", None, type=float)
+        end = request.args.get("to", time.time(), type=float)
+
+        result["recomputed"] = recompute(tds_pipeline, history, probe, start=start, end=end)
+        rollups.rebuild("ads1115.tds")
+
+    return result
 
 
 @app.route("/ADS1115")
@@ -115,7 +672,29 @@ def read_TDS():
     if th.fetch_task("ADS1115") == None:
         th.start("run_tds", "ADS1115")
 
+    ads1115 = devices["ADS1115"]
+
     return {
         "averageVoltage": ads1115.metadata["averageVoltage"],
         "tdsValue": ads1115.metadata["tdsValue"]
     }
+
+
+@app.route("/ready")
+def read_ready():
+    '''Reports which subsystems have finished starting and the state of every device. Answers 503 until startup is done.'''
+
+    subsystems = {
+        "runtime": runtime.started.is_set(),
+        "tasks": th.restored,
+        "scheduler": scheduler.task is not None,
+        "history": history.task is not None,
+    }
+    ready = all(subsystems.values())
+
+    return {"ready": ready, "subsystems": subsystems, "devices": devices.status()}, 200 if ready else 503
+
+
+# start the runtime every device read and task runs on, once everything above is wired up.
+# startup hooks, like restoring stored tasks, run in the background so the server answers straight away
+runtime.start(wait=False)
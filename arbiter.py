@@ -0,0 +1,220 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+
+# request priorities, lower numbers are served first
+SAFETY = 0
+CONTROL = 1
+DASHBOARD = 2
+
+PRIORITIES = {SAFETY: "safety", CONTROL: "control", DASHBOARD: "dashboard"}
+
+
+class DeadlineExpired(TimeoutError):
+    '''Raised when a request's deadline passes before it is given the bus.'''
+
+
+class _Waiter:
+
+    def __init__(self, priority, deadline, wake):
+
+        self.priority = priority
+        self.deadline = deadline
+        self.wake = wake
+        self.queued = time.monotonic()
+        self.granted = None
+
+        # "waiting", then "granted" or "expired"
+        self.state = "waiting"
+
+
+class BusArbiter:
+    '''Serializes transactions on one hardware bus, so multi-step sequences like an I2C config write, conversion wait and read never interleave.
+    Waiting requests are served by priority, then in arrival order. A request still waiting when its deadline passes is dropped with DeadlineExpired.
+    Usable from coroutines through hold() and from threads through hold_sync().'''
+
+    def __init__(self, name):
+
+        self.name = name
+        self.lock = threading.Lock()
+
+        # (priority, sequence, waiter), abandoned waiters are skipped when popped
+        self.queue = []
+        self.sequence = itertools.count()
+        self.owner = None
+
+        # statistics
+        self.depth = 0
+        self.max_depth = 0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+        self.counters = {
+            priority: {"granted": 0, "expired": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for priority in PRIORITIES
+        }
+
+    def _enqueue(self, priority, timeout, wake):
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waiter = _Waiter(priority, deadline, wake)
+
+        with self.lock:
+            if self.owner is None and not self.depth:
+                self._grant(waiter)
+            else:
+                heapq.heappush(self.queue, (priority, next(self.sequence), waiter))
+                self.depth += 1
+                self.max_depth = max(self.max_depth, self.depth)
+
+        return waiter
+
+    def _grant(self, waiter):
+
+        now = time.monotonic()
+        wait = now - waiter.queued
+        counters = self.counters[waiter.priority]
+
+        counters["granted"] += 1
+        counters["wait_total"] += wait
+        counters["wait_max"] = max(counters["wait_max"], wait)
+
+        waiter.state = "granted"
+        waiter.granted = now
+        self.owner = waiter
+
+    def _expire(self, waiter):
+
+        waiter.state = "expired"
+        self.counters[waiter.priority]["expired"] += 1
+
+    def _abandon(self, waiter):
+        '''Takes a waiter that gave up out of the queue. Returns False if it was granted the bus in the meantime.'''
+
+        with self.lock:
+            if waiter.state == "waiting":
+                self.depth -= 1
+                self._expire(waiter)
+
+            return waiter.state != "granted"
+
+    def _release(self, waiter):
+
+        with self.lock:
+            now = time.monotonic()
+            held = now - waiter.granted
+
+            self.hold_total += held
+            self.hold_max = max(self.hold_max, held)
+            self.owner = None
+
+            while self.queue:
+                _, _, waiter = heapq.heappop(self.queue)
+
+                if waiter.state != "waiting":
+                    continue
+
+                self.depth -= 1
+
+                if waiter.deadline is not None and waiter.deadline <= now:
+                    self._expire(waiter)
+                    waiter.wake()
+                    continue
+
+                self._grant(waiter)
+                waiter.wake()
+                break
+
+    @asynccontextmanager
+    async def hold(self, priority=DASHBOARD, timeout=None):
+        '''Async context manager holding the bus. Raises DeadlineExpired if it isn't given the bus within "timeout" seconds.'''
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve():
+            if not future.done():
+                future.set_result(None)
+
+        waiter = self._enqueue(priority, timeout, lambda: loop.call_soon_threadsafe(resolve))
+
+        if waiter.state == "waiting":
+            try:
+                await asyncio.wait_for(future, timeout)
+
+            except asyncio.TimeoutError:
+                if self._abandon(waiter):
+                    raise DeadlineExpired("%s bus busy for %ss" % (self.name, timeout))
+
+            except BaseException:
+                # cancelled while waiting, hand the bus on if it was granted meanwhile
+                if not self._abandon(waiter):
+                    self._release(waiter)
+                raise
+
+        if waiter.state == "expired":
+            raise DeadlineExpired("%s bus busy for %ss" % (self.name, timeout))
+
+        try:
+            yield
+        finally:
+            self._release(waiter)
+
+    @contextmanager
+    def hold_sync(self, priority=DASHBOARD, timeout=None):
+        '''Blocking version of hold() for code running on threads. Never call it from the event loop.'''
+
+        event = threading.Event()
+        waiter = self._enqueue(priority, timeout, event.set)
+
+        if waiter.state == "waiting" and not event.wait(timeout) and self._abandon(waiter):
+            raise DeadlineExpired("%s bus busy for %ss" % (self.name, timeout))
+
+        if waiter.state == "expired":
+            raise DeadlineExpired("%s bus busy for %ss" % (self.name, timeout))
+
+        try:
+            yield
+        finally:
+            self._release(waiter)
+
+    def stats(self):
+        '''Returns the current queue depth and the wait time statistics of every priority, times in seconds.'''
+
+        with self.lock:
+            granted = sum(counters["granted"] for counters in self.counters.values())
+
+            return {
+                "busy": self.owner is not None,
+                "depth": self.depth,
+                "max_depth": self.max_depth,
+                "hold_mean": self.hold_total / granted if granted else 0.0,
+                "hold_max": self.hold_max,
+                "priorities": {
+                    PRIORITIES[priority]: {
+                        "granted": counters["granted"],
+                        "expired": counters["expired"],
+                        "wait_mean": counters["wait_total"] / counters["granted"] if counters["granted"] else 0.0,
+                        "wait_max": counters["wait_max"],
+                    }
+                    for priority, counters in self.counters.items()
+                },
+            }
+
+
+# one arbiter per bus name, e.g. "i2c-1", "w1" or "gpio27"
+arbiters = {}
+_lock = threading.Lock()
+
+
+def get_arbiter(name) -> BusArbiter:
+    '''Returns the arbiter of bus "name", creating it if needed, so every device on a bus shares one.'''
+
+    with _lock:
+        if name not in arbiters:
+            arbiters[name] = BusArbiter(name)
+
+        return arbiters[name]
@@ -0,0 +1,520 @@
+'''Load test and micro-benchmarks for the API, run against the simulated hardware backend.
+
+    python benchmark.py --clients 8 --viewers 4 --duration 10 --output before.json
+    python benchmark.py --output after.json --compare before.json
+
+By default the API is started in a child process with GROWROOM_BACKEND=sim, so its CPU time and memory can be read from /proc.
+Pass --url to load test a server that is already running, e.g. on the Pi, without process statistics.'''
+
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from urllib.parse import urlsplit
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+ROUTES = [
+    "/DHT22",
+    "/DS18B20",
+    "/LLPK1",
+    "/ADS1115",
+    "/sensors",
+    "/loop",
+    "/loop?id=pump_relay",
+    "/history?metric=dht22.temperature&step=60",
+]
+
+CAMERA_ROUTE = "/camera_feed?profile=%s"
+
+
+def percentile(values, p):
+    '''Nearest-rank percentile of an already sorted list.'''
+
+    if not values:
+        return None
+
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))]
+
+
+class Server:
+    '''The API running in a child process on simulated hardware, in a scratch directory so its journals and history start empty.'''
+
+    def __init__(self, port):
+
+        self.port = port
+        self.process = None
+        self.directory = None
+        self.clock = os.sysconf("SC_CLK_TCK")
+
+    def start(self, timeout=60.0):
+
+        self.directory = tempfile.mkdtemp(prefix="growroom-bench-")
+        env = dict(os.environ, GROWROOM_BACKEND="sim", FLASK_APP="api",
+                   PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+
+        self.log = open(os.path.join(self.directory, "server.log"), "wb")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "flask", "run", "--port", str(self.port), "--with-threads"],
+            cwd=self.directory, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+
+        deadline = time.monotonic() + timeout
+
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("server exited, see %s" % self.log.name)
+
+            try:
+                connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=1.0)
+                connection.request("GET", "/")
+                connection.getresponse().read()
+                connection.close()
+                return
+            except OSError:
+                time.sleep(0.2)
+
+        raise RuntimeError("server didn't start within %ss" % timeout)
+
+    def stop(self):
+
+        if self.process is not None:
+            self.process.terminate()
+
+            try:
+                self.process.wait(10.0)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+            self.log.close()
+            shutil.rmtree(self.directory, True)
+
+    def cpu(self):
+        '''CPU seconds used by the server so far, user and system.'''
+
+        with open("/proc/%d/stat" % self.process.pid) as file:
+            fields = file.read().rsplit(")", 1)[1].split()
+
+        return (int(fields[11]) + int(fields[12])) / self.clock
+
+    def rss(self):
+        '''Resident memory of the server in MiB.'''
+
+        with open("/proc/%d/status" % self.process.pid) as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+
+        return None
+
+
+class Monitor:
+    '''Samples the server's CPU time and peak RSS over one benchmark phase.'''
+
+    def __init__(self, server: Server, interval=0.25):
+
+        self.server = server
+        self.interval = interval
+        self.running = False
+
+    def __enter__(self):
+
+        if self.server is None:
+            return self
+
+        self.running = True
+        self.start = time.monotonic()
+        self.cpu = self.server.cpu()
+        self.rss_max = self.server.rss()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+        return self
+
+    def run(self):
+
+        while self.running:
+            self.rss_max = max(self.rss_max, self.server.rss())
+            time.sleep(self.interval)
+
+    def __exit__(self, *exc):
+
+        if self.server is None:
+            self.result = {}
+            return
+
+        self.running = False
+        self.thread.join()
+
+        elapsed = time.monotonic() - self.start
+        self.result = {
+            "cpu_percent": round(100.0 * (self.server.cpu() - self.cpu) / elapsed, 1),
+            "rss_max_mb": round(self.rss_max, 1),
+        }
+
+
+def load(host, port, path, clients, duration):
+    '''Runs "clients" keep-alive connections requesting "path" back to back for "duration" seconds.'''
+
+    latencies = [[] for _ in range(clients)]
+    statuses = [{} for _ in range(clients)]
+    errors = [0] * clients
+    stop = time.monotonic() + duration
+
+    def client(index):
+
+        connection = http.client.HTTPConnection(host, port, timeout=30.0)
+
+        while time.monotonic() < stop:
+            start = time.perf_counter()
+
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                errors[index] += 1
+                connection.close()
+                connection = http.client.HTTPConnection(host, port, timeout=30.0)
+                continue
+
+            latencies[index].append(time.perf_counter() - start)
+            statuses[index][response.status] = statuses[index].get(response.status, 0) + 1
+
+        connection.close()
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client, args=(index, )) for index in range(clients)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.monotonic() - started
+    merged = sorted(latency for client_latencies in latencies for latency in client_latencies)
+    status = {}
+
+    for client_statuses in statuses:
+        for code, count in client_statuses.items():
+            status[str(code)] = status.get(str(code), 0) + count
+
+    def ms(value):
+        return None if value is None else round(value * 1000.0, 3)
+
+    return {
+        "clients": clients,
+        "requests": len(merged),
+        "errors": sum(errors) + sum(count for code, count in status.items() if int(code) >= 500),
+        "status": status,
+        "throughput": round(len(merged) / elapsed, 1),
+        "p50_ms": ms(percentile(merged, 50)),
+        "p95_ms": ms(percentile(merged, 95)),
+        "p99_ms": ms(percentile(merged, 99)),
+        "max_ms": ms(merged[-1] if merged else None),
+    }
+
+
+def view(host, port, profile, viewers, duration):
+    '''Runs "viewers" MJPEG clients of "profile" for "duration" seconds and counts the frames each one receives.'''
+
+    results = [None] * viewers
+    boundary = b"--frame\r\n"
+
+    def viewer(index):
+
+        connection = http.client.HTTPConnection(host, port, timeout=10.0)
+        start = time.monotonic()
+        frames = 0
+        received = 0
+        first = None
+        tail = b""
+
+        try:
+            connection.request("GET", CAMERA_ROUTE % profile)
+            response = connection.getresponse()
+
+            while time.monotonic() - start < duration:
+                chunk = response.read1(65536)
+
+                if not chunk:
+                    break
+
+                # boundaries can be split between chunks
+                data = tail + chunk
+                count = data.count(boundary)
+
+                if count and first is None:
+                    first = time.monotonic() - start
+
+                frames += count
+                received += len(chunk)
+                tail = data[-(len(boundary) - 1):]
+
+        except (OSError, http.client.HTTPException):
+            pass
+
+        finally:
+            connection.close()
+
+        elapsed = time.monotonic() - start
+        results[index] = {
+            "frames": frames,
+            "fps": round(frames / elapsed, 2),
+            "mbytes": round(received / 1048576.0, 2),
+            "first_frame_ms": None if first is None else round(first * 1000.0, 1),
+        }
+
+    threads = [threading.Thread(target=viewer, args=(index, )) for index in range(viewers)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    fps = [result["fps"] for result in results]
+
+    return {
+        "viewers": viewers,
+        "fps_min": min(fps),
+        "fps_mean": round(sum(fps) / len(fps), 2),
+        "fps_max": max(fps),
+        "per_viewer": results,
+    }
+
+
+def measure(function, repeat=5):
+    '''Times "function" with timeit, in batches long enough to be measured, and returns microseconds per call.'''
+
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    times = sorted(batch / number * 1e6 for batch in timer.repeat(repeat, number))
+
+    return {"us_best": round(times[0], 3), "us_median": round(times[len(times) // 2], 3), "calls": number}
+
+
+def micro():
+    '''Micro-benchmarks of the hot device and persistence paths, run in this process on simulated hardware.'''
+
+    import random
+    import sim
+    import tasks
+    from devices import ADS1115, Camera
+    from persistence import task_handler
+    from runtime import Runtime
+
+    results = {}
+
+    # median filter the TDS loop reads on every update
+    ads1115 = ADS1115(bus=sim.SimSMBus())
+    median = ads1115.getFilter(1)
+
+    for _ in range(median.window.capacity):
+        median.push(random.uniform(800.0, 1000.0))
+
+    results["ADS1115.getMedianTemp"] = measure(ads1115.getMedianTemp)
+    results["RunningMedian.push"] = measure(lambda: median.push(random.uniform(800.0, 1000.0)))
+
+    # one TDS update: a 0.8 s block of 25 sps samples through the filter, compensation and curve
+    block = [random.uniform(800.0, 1000.0) for _ in range(20)]
+    times = [time.time() + index * 0.04 for index in range(20)]
+    results["TdsPipeline.process x20"] = measure(lambda: ads1115.pipeline.process("ads1115.1", times, block))
+
+    # task persistence round trips, with a do-nothing coroutine so only the handler is measured
+    async def benchmark_idle():
+        await asyncio.Event().wait()
+
+    tasks.benchmark_idle = benchmark_idle
+
+    directory = tempfile.mkdtemp(prefix="growroom-bench-")
+    runtime = Runtime("benchmark")
+    runtime.start()
+
+    try:
+        th = task_handler(os.path.join(directory, ".tasks"), runtime=runtime)
+
+        def start_stop():
+            th.start("benchmark_idle", "benchmark")
+            th.stop("benchmark")
+
+        results["task_handler.start+stop"] = measure(start_stop)
+
+        th.start("benchmark_idle", "benchmark")
+        results["task_handler.fetch_task_info"] = measure(lambda: th.fetch_task_info("benchmark"))
+        th.stop("benchmark")
+        th.close()
+
+    finally:
+        runtime.stop()
+        del tasks.benchmark_idle
+        shutil.rmtree(directory, True)
+
+    # multipart framing and fan-out of one camera frame
+    frame = sim.synthetic_jpeg(620, 480, size=45000)
+
+    for viewers in (1, 10, 50):
+        output = Camera.StreamingOutput(max_fps=None)
+        subscriptions = [output.broadcaster.subscribe() for _ in range(viewers)]
+
+        results["gen_stream.write x%d" % viewers] = measure(lambda: output.write(frame))
+
+        for subscription in subscriptions:
+            subscription.close()
+
+    return results
+
+
+def metrics(results):
+    '''Flattens results into (name, value, lower is better) for comparison.'''
+
+    for route, result in results.get("http", {}).items():
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            yield "%s %s" % (route, key), result[key], True
+
+        yield "%s throughput" % route, result["throughput"], False
+
+    for profile, result in results.get("camera", {}).items():
+        yield "camera %s fps_min" % profile, result["fps_min"], False
+
+    for name, result in results.get("micro", {}).items():
+        yield "%s us" % name, result["us_best"], True
+
+
+def compare(old, new, threshold):
+    '''Prints every metric of "new" next to "old" and returns the names of those more than "threshold" percent worse.'''
+
+    before = {name: value for name, value, _ in metrics(old)}
+    regressions = []
+
+    print("\n%-58s %12s %12s %9s" % ("metric", "before", "after", "change"))
+
+    for name, value, lower in metrics(new):
+        previous = before.get(name)
+
+        if previous in (None, 0) or value is None:
+            continue
+
+        change = 100.0 * (value - previous) / previous
+        worse = change > threshold if lower else change < -threshold
+
+        if worse:
+            regressions.append(name)
+
+        print("%-58s %12.3f %12.3f %+8.1f%%%s" % (name, previous, value, change, "  REGRESSION" if worse else ""))
+
+    return regressions
+
+
+def git_commit():
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="benchmark a running server instead of starting one on simulated hardware")
+    parser.add_argument("--port", type=int, default=4299, help="port for the simulated server")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent HTTP clients per route")
+    parser.add_argument("--viewers", type=int, default=4, help="concurrent MJPEG viewers per camera profile")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per route and camera profile")
+    parser.add_argument("--warmup", type=float, default=8.0, help="seconds to let samplers fill before measuring")
+    parser.add_argument("--routes", nargs="*", default=ROUTES)
+    parser.add_argument("--profiles", nargs="*", default=["full", "thumbnail"])
+    parser.add_argument("--skip-http", action="store_true")
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="compare against results saved by an earlier run")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent change counted as a regression")
+    args = parser.parse_args()
+
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "time": time.time(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "args": vars(args),
+        },
+    }
+
+    if not args.skip_http:
+        server = None
+
+        if args.url:
+            url = urlsplit(args.url)
+            host, port = url.hostname, url.port or 80
+        else:
+            host, port = "127.0.0.1", args.port
+            server = Server(port)
+            server.start()
+            time.sleep(args.warmup)
+
+        try:
+            results["http"] = {}
+            results["camera"] = {}
+
+            for route in args.routes:
+                with Monitor(server) as monitor:
+                    result = load(host, port, route, args.clients, args.duration)
+
+                result.update(monitor.result)
+                results["http"][route] = result
+
+                print("%-45s %8.1f req/s  p50 %8.2f  p95 %8.2f  p99 %8.2f ms  %s" % (
+                    route, result["throughput"], result["p50_ms"] or 0, result["p95_ms"] or 0, result["p99_ms"] or 0,
+                    " ".join("%s=%s" % item for item in sorted(monitor.result.items()))))
+
+            for profile in args.profiles:
+                with Monitor(server) as monitor:
+                    result = view(host, port, profile, args.viewers, args.duration)
+
+                result.update(monitor.result)
+                results["camera"][profile] = result
+
+                print("camera %-38s %8.2f fps min  %8.2f fps mean  %s" % (
+                    profile, result["fps_min"], result["fps_mean"],
+                    " ".join("%s=%s" % item for item in sorted(monitor.result.items()))))
+
+        finally:
+            if server is not None:
+                server.stop()
+
+    if not args.skip_micro:
+        results["micro"] = micro()
+
+        for name, result in results["micro"].items():
+            print("%-45s %10.3f us" % (name, result["us_best"]))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(json.load(file), results, args.threshold)
+
+        if regressions:
+            print("\n%d regressions over %s%%" % (len(regressions), args.threshold))
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+import threading
+from collections import deque
+
+
+class Subscription:
+    '''One client's view of a Broadcaster. Items are queued up to "maxsize", after which the oldest queued item is dropped.'''
+
+    def __init__(self, broadcaster, maxsize):
+
+        self.broadcaster = broadcaster
+        self.queue = deque(maxlen=maxsize)
+        self.ready = threading.Event()
+        self.dropped = 0
+        self.delivered = 0
+        self.closed = False
+
+    def put(self, item):
+        '''Queues an item without blocking. Called by the broadcaster.'''
+
+        # a full deque silently discards its oldest item on append
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+
+        self.queue.append(item)
+        self.ready.set()
+
+    def get(self, timeout=None):
+        '''Returns the next queued item, waiting up to "timeout" seconds. Returns None on timeout or once closed.'''
+
+        while not self.closed:
+
+            # clear before checking so a put between the check and the wait isn't missed
+            self.ready.clear()
+
+            try:
+                item = self.queue.popleft()
+            except IndexError:
+                if not self.ready.wait(timeout) and timeout is not None:
+                    return None
+                continue
+
+            self.delivered += 1
+            return item
+
+        return None
+
+    def close(self):
+        '''Stops receiving items and removes this subscription from its broadcaster.'''
+
+        self.closed = True
+        self.ready.set()
+        self.broadcaster.unsubscribe(self)
+
+    def __iter__(self):
+
+        while not self.closed:
+            item = self.get()
+            if item is not None:
+                yield item
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Broadcaster:
+    '''Fans every published item out to all subscribers through per-subscriber bounded queues.
+    Items are shared, not copied, so publish immutable objects. A slow subscriber drops its oldest items instead of stalling the others.'''
+
+    def __init__(self, maxsize=2):
+
+        self.maxsize = maxsize
+        self.latest = None
+
+        # replaced rather than mutated, so publish can iterate it without a lock
+        self.subscribers = ()
+        self._lock = threading.Lock()
+
+    def subscribe(self, maxsize=None):
+        '''Returns a new Subscription. Use it as a context manager, or call close() when done.'''
+
+        subscription = Subscription(self, maxsize or self.maxsize)
+
+        with self._lock:
+            self.subscribers = self.subscribers + (subscription, )
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+
+        with self._lock:
+            self.subscribers = tuple(
+                s for s in self.subscribers if s is not subscription)
+
+    def publish(self, item):
+        '''Queues "item" for every current subscriber. Never blocks.'''
+
+        self.latest = item
+
+        for subscription in self.subscribers:
+            subscription.put(item)
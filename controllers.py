@@ -0,0 +1,287 @@
+import asyncio
+import time
+
+from runtime import runtime as default_runtime
+
+
+class Signal:
+    '''Latest value of one sensor signal. Coroutines wait for its next update on one shared future,
+    so any number of controllers can follow a signal without polling it. Only touched on the runtime thread.'''
+
+    def __init__(self, name):
+
+        self.name = name
+
+        # held signals are only published when they change, so their value stays current however old it is
+        self.held = False
+
+        self.value = None
+        self.timestamp = None
+        self.version = 0
+        self.future = None
+
+    def set(self, value, timestamp):
+
+        self.value = value
+        self.timestamp = timestamp
+        self.version += 1
+
+        if self.future is not None:
+            if not self.future.done():
+                self.future.set_result(self.version)
+            self.future = None
+
+    def changed(self):
+        '''Returns a future resolved at the next update. Wait on it with asyncio.wait(), cancelling it would wake every other waiter.'''
+
+        if self.future is None:
+            self.future = asyncio.get_running_loop().create_future()
+
+        return self.future
+
+
+class Signals:
+    '''Every sensor signal by name, e.g. "dht22.humidity" or "llpk1.level", fed from any thread through publish().'''
+
+    def __init__(self, runtime=None):
+
+        self.signals = {}
+        self.runtime = runtime or default_runtime
+
+    def __getitem__(self, name) -> Signal:
+
+        signal = self.signals.get(name)
+
+        if signal is None:
+            signal = self.signals.setdefault(name, Signal(name))
+
+        return signal
+
+    def hold(self, name):
+        '''Marks signal "name" as published only on change, exempting it from the controllers' "max_age".'''
+
+        self[name].held = True
+
+    def publish(self, name, timestamp, value):
+        '''Updates signal "name". Takes the arguments of a TimeSeriesStore listener, so it can be one.'''
+
+        signal = self[name]
+
+        if self.runtime.in_loop():
+            signal.set(value, timestamp)
+        else:
+            self.runtime.loop.call_soon_threadsafe(signal.set, value, timestamp)
+
+
+class Hysteresis:
+    '''On/off rule with a dead band. "raise" switches on below "low" and off above "high", e.g. a heater or humidifier,
+    "lower" switches on above "high" and off below "low", e.g. a fan. In between the relay keeps its state.'''
+
+    type = "hysteresis"
+
+    def __init__(self, low, high, direction="raise"):
+
+        self.low = float(low)
+        self.high = float(high)
+        self.direction = direction
+        self.on = False
+
+        if self.low > self.high:
+            raise ValueError("Hysteresis low must not be above high")
+
+        if direction not in ("raise", "lower"):
+            raise ValueError("Invalid direction %s" % direction)
+
+    def update(self, value, timestamp):
+
+        if self.direction == "raise":
+            if value < self.low:
+                self.on = True
+            elif value > self.high:
+                self.on = False
+        else:
+            if value > self.high:
+                self.on = True
+            elif value < self.low:
+                self.on = False
+
+    def state(self, now):
+        '''Returns (on, next_change), next_change being when the rule changes its mind without a new sample, or None.'''
+
+        return self.on, None
+
+    def info(self):
+        return {"type": self.type, "low": self.low, "high": self.high, "direction": self.direction}
+
+
+class PID:
+    '''PID rule for an on/off relay: the output, clamped to 0..1, is the fraction of every "period" seconds the relay is on.
+    "raise" drives the value up towards "setpoint", "lower" drives it down. The integral is clamped to the output range against windup.'''
+
+    type = "pid"
+
+    def __init__(self, setpoint, kp, ki=0.0, kd=0.0, period=300.0, direction="raise"):
+
+        self.setpoint = float(setpoint)
+        self.kp = float(kp)
+        self.ki = float(ki)
+        self.kd = float(kd)
+        self.period = float(period)
+        self.direction = direction
+
+        if self.period <= 0:
+            raise ValueError("PID period must be positive")
+
+        if direction not in ("raise", "lower"):
+            raise ValueError("Invalid direction %s" % direction)
+
+        self.integral = 0.0
+        self.last = None
+        self.duty = None
+
+    def update(self, value, timestamp):
+
+        error = self.setpoint - value if self.direction == "raise" else value - self.setpoint
+        derivative = 0.0
+
+        if self.last is not None:
+            last_value, last_timestamp = self.last
+            dt = timestamp - last_timestamp
+
+            if dt > 0:
+                self.integral += error * dt
+
+                # derivative on the measurement, so a setpoint change doesn't kick the output
+                change = (value - last_value) / dt
+                derivative = -change if self.direction == "raise" else change
+
+        if self.ki:
+            self.integral = min(max(self.integral, 0.0), 1.0 / self.ki)
+
+        self.last = (value, timestamp)
+        self.duty = min(max(self.kp * error + self.ki * self.integral + self.kd * derivative, 0.0), 1.0)
+
+    def state(self, now):
+
+        if not self.duty:
+            return False, None
+
+        if self.duty >= 1.0:
+            return True, None
+
+        # windows are aligned to the epoch, on for the first duty * period seconds of each
+        start = now - now % self.period
+        on_until = start + self.duty * self.period
+
+        if now < on_until:
+            return True, on_until
+
+        return False, start + self.period
+
+    def info(self):
+        return {"type": self.type, "setpoint": self.setpoint, "kp": self.kp, "ki": self.ki, "kd": self.kd,
+                "period": self.period, "direction": self.direction, "duty": self.duty}
+
+
+# rule classes by their "type"
+RULES = {rule.type: rule for rule in (Hysteresis, PID)}
+
+
+def make_rule(mode, **settings):
+    '''Builds the rule called "mode" from its settings. Raises ValueError for unknown modes or bad settings.'''
+
+    if mode not in RULES:
+        raise ValueError("Invalid controller mode %s" % mode)
+
+    try:
+        return RULES[mode](**settings)
+    except TypeError as error:
+        raise ValueError(str(error))
+
+
+class Controller:
+    '''Drives one relay through the scheduler from one signal and rule. It wakes only for new samples and for the times its
+    decision can change: a PID window edge, a minimum on/off time running out, or the latest sample going stale.
+    The relay is held for at least "min_on"/"min_off" seconds after switching, and switched off when the signal is older than "max_age",
+    unless it is a held signal.'''
+
+    def __init__(self, relay, signal: Signal, rule, scheduler, min_on=60.0, min_off=60.0, max_age=600.0):
+
+        self.relay = relay
+        self.signal = signal
+        self.rule = rule
+        self.scheduler = scheduler
+        self.min_on = float(min_on)
+        self.min_off = float(min_off)
+        self.max_age = None if max_age is None else float(max_age)
+
+        self.on = None
+        self.switched = None
+        self.version = 0
+        self.reason = "starting"
+
+    def evaluate(self, now):
+        '''Applies the latest sample and switches the relay if the rule says so. Returns when to evaluate again without a new sample, or None.'''
+
+        signal = self.signal
+        wakes = []
+
+        if signal.version != self.version:
+            self.version = signal.version
+
+            if signal.value is not None:
+                self.rule.update(signal.value, signal.timestamp)
+
+        if signal.timestamp is None or (self.max_age is not None and not signal.held and now - signal.timestamp > self.max_age):
+            desired, self.reason = False, "no recent %s sample" % signal.name
+        else:
+            desired, change = self.rule.state(now)
+            self.reason = "rule"
+
+            if change is not None:
+                wakes.append(change)
+
+            if self.max_age is not None and not signal.held:
+                wakes.append(signal.timestamp + self.max_age)
+
+        # protect the hardware from short cycling
+        if self.on is not None and desired != self.on:
+            allowed = self.switched + (self.min_on if self.on else self.min_off)
+
+            if now < allowed:
+                desired, self.reason = self.on, "minimum %s time" % ("on" if self.on else "off")
+                wakes.append(allowed)
+
+        if desired != self.on:
+            self.scheduler.drive(self.relay, desired)
+            self.on = desired
+            self.switched = now
+
+        return min(wakes) if wakes else None
+
+    async def run(self):
+        '''Controls the relay until cancelled, then switches it off.'''
+
+        try:
+            while True:
+                wake = self.evaluate(time.time())
+                timeout = None if wake is None else max(0.0, wake - time.time())
+
+                await asyncio.wait((self.signal.changed(), ), timeout=timeout)
+
+        finally:
+            self.scheduler.undrive(self.relay)
+
+    def info(self):
+        return {
+            "relay": self.relay,
+            "signal": self.signal.name,
+            "value": self.signal.value,
+            "timestamp": self.signal.timestamp,
+            "on": self.on,
+            "reason": self.reason,
+            "min_on": self.min_on,
+            "min_off": self.min_off,
+            "max_age": self.max_age,
+            "rule": self.rule.info(),
+        }
@@ -1,54 +1,366 @@
-import adafruit_dht
-import board
 import asyncio
-import smbus
+import bisect
 import time
 import io
-from threading import Condition
-from picamera2 import Picamera2
-from picamera2.encoders import JpegEncoder
-from picamera2.outputs import FileOutput
-from gpiozero import OutputDevice
+import os
+import glob
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from gpiozero import OutputDevice, DigitalInputDevice
 from gpiozero.pins import mock
 from w1thermsensor import W1ThermSensor, Sensor
 
+from arbiter import get_arbiter, DeadlineExpired, SAFETY, CONTROL, DASHBOARD
+from broadcast import Broadcaster
+from filters import RingBuffer, RunningMedian
+import metrics
+
+# hardware libraries only import on the Pi, elsewhere devices get simulated stand-ins from sim.py
+try:
+    import adafruit_dht
+    import board
+except (ImportError, NotImplementedError):
+    adafruit_dht = board = None
+
+try:
+    import smbus
+except ImportError:
+    smbus = None
+
+try:
+    from picamera2 import Picamera2
+    from picamera2.encoders import JpegEncoder
+    from picamera2.outputs import FileOutput
+except ImportError:
+    Picamera2 = JpegEncoder = FileOutput = None
+
+
+def require(module, name):
+    '''Returns "module", raising a helpful error if its import failed.'''
+
+    if module is None:
+        raise RuntimeError("%s is not installed, set GROWROOM_BACKEND=sim to run on simulated hardware" % name)
+
+    return module
+
+
+# a named camera stream: which sensor stream it is encoded from ("main" or "lores"), its size, JPEG quality and frame rate cap
+StreamProfile = namedtuple("StreamProfile", ["stream", "size", "quality", "max_fps"])
+
+
+class DeviceRegistry:
+    '''Creates devices by name on first use, so nothing touches the hardware until something needs it.
+    Hooks registered with on_create() wire up each device as soon as it exists.'''
+
+    def __init__(self):
+
+        self.factories = {}
+        self.devices = {}
+        self.hooks = {}
+        self.errors = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, factory):
+        '''Registers "factory", a callable returning the device called "name".'''
+
+        self.factories[name] = factory
+
+    def on_create(self, name, hook=None):
+        '''Registers a callable run with device "name" once it is created, straight away if it already is. Usable as a decorator.'''
+
+        def decorator(hook):
+            self.hooks.setdefault(name, []).append(hook)
+
+            if name in self.devices:
+                hook(self.devices[name])
+
+            return hook
+
+        return decorator(hook) if hook is not None else decorator
+
+    def get(self, name, default=None):
+        '''Returns device "name", creating it if needed, or "default" if no such device is registered.'''
+
+        device = self.devices.get(name)
+
+        if device is not None or name not in self.factories:
+            return default if device is None else device
+
+        # one lock per device, so a slow camera doesn't hold up the other devices
+        with self.lock:
+            lock = self.locks.setdefault(name, threading.RLock())
+
+        with lock:
+            if name not in self.devices:
+                try:
+                    device = self.factories[name]()
+                except Exception as error:
+                    self.errors[name] = error
+                    raise
+
+                self.errors.pop(name, None)
+                self.devices[name] = device
+
+                for hook in self.hooks.get(name, ()):
+                    hook(device)
+
+        return self.devices[name]
+
+    def __getitem__(self, name):
+
+        device = self.get(name)
+
+        if device is None:
+            raise KeyError(name)
+
+        return device
+
+    def __setitem__(self, name, device):
+        self.devices[name] = device
+
+    def peek(self, name):
+        '''Returns device "name" if it has been created, without creating it.'''
+
+        return self.devices.get(name)
+
+    def status(self):
+        '''Returns {name: "up", "not created" or "failed: <error>"} for every device.'''
+
+        status = {}
+
+        for name in sorted(set(self.factories) | set(self.devices)):
+            if name in self.devices:
+                status[name] = "up"
+            elif name in self.errors:
+                status[name] = "failed: %r" % self.errors[name]
+            else:
+                status[name] = "not created"
+
+        return status
+
 
 class Camera():
+    '''Serves several MJPEG stream profiles from one Picamera2 capture session.
+    Each profile is encoded only while somebody is subscribed to it, and the camera itself only runs while it is in use.'''
+
+    # default profiles, profiles sharing a sensor stream must share its size
+    PROFILES = {
+        "full": StreamProfile("main", (620, 480), 50, 30),
+        "thumbnail": StreamProfile("lores", (320, 240), 40, 5),
+    }
+
     class StreamingOutput(io.BufferedIOBase):
+        '''Frames each JPEG from the encoder once as a multipart chunk and broadcasts that same buffer to every viewer.'''
 
-        def __init__(self):
+        def __init__(self, maxsize=2, max_fps=None):
             self.frame = None
-            self.condition = Condition()
+            self.timestamp = None
+            self.interval = 1.0 / max_fps if max_fps else 0.0
+            self.broadcaster = Broadcaster(maxsize)
 
         def write(self, buf):
-            with self.condition:
-                self.frame = buf
-                self.condition.notify_all()
 
-    def __init__(self):
+            now = time.monotonic()
 
-        self.module = Picamera2()
-        self.module.video_configuration.size = (620, 480)
-        self.output = self.StreamingOutput()
-        self.module.sensor_modes
-        self.module.start_recording(
-            JpegEncoder(q=50), FileOutput(self.output))
+            # skip frames arriving faster than the profile's frame rate cap, allowing for jitter so a source at the cap isn't halved
+            if self.timestamp is not None and now - self.timestamp < self.interval * 0.9:
+                return
 
-    def gen_stream(self):
+            self.frame = buf
+            self.timestamp = now
+            self.broadcaster.publish(b''.join((
+                b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ',
+                str(len(buf)).encode(), b'\r\n\r\n', buf, b'\r\n')))
 
-        while True:
-            with self.output.condition:
-                self.output.condition.wait()
-                frame = self.output.frame
-            yield (b'--frame\r\n'b'Content-Type: image/jpeg\r\n'b'Content-Length: ' + str(len(frame)).encode() + b'\r\n\r\n' + frame + b'\r\n')
+    def __init__(self, profiles: dict = None, snapshot_ttl=5.0, idle_timeout=30.0, module=None, encoder=None, file_output=None):
+        '''"profiles" maps profile names to StreamProfile tuples, defaults to Camera.PROFILES.
+        Snapshots taken while a profile isn't streaming are reused for "snapshot_ttl" seconds.
+        The camera starts with the first viewer or snapshot, and stops once nothing has used it for "idle_timeout" seconds.
+        "module", "encoder" and "file_output" replace Picamera2(), JpegEncoder and FileOutput, e.g. with simulated ones.'''
+
+        self.profiles = profiles or self.PROFILES
+        self.snapshot_ttl = snapshot_ttl
+        self.outputs = {}
+        self.encoders = {}
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+        # frames delivered to and dropped by viewers that have disconnected, per profile
+        self.delivered = {}
+        self.dropped = {}
+
+        # size each sensor stream from the profiles that use it
+        streams = {}
+        for name, profile in self.profiles.items():
+            if streams.setdefault(profile.stream, profile.size) != profile.size:
+                raise ValueError("Profiles on the %s stream have different sizes" % profile.stream)
+
+            self.outputs[name] = self.StreamingOutput(max_fps=profile.max_fps)
+            self.subscribers[name] = 0
+            self.delivered[name] = 0
+            self.dropped[name] = 0
+
+        self.module = module or require(Picamera2, "picamera2")()
+        self.encoder = encoder or JpegEncoder
+        self.file_output = file_output or FileOutput
+        self.module.configure(self.module.create_video_configuration(
+            **{stream: {"size": size} for stream, size in streams.items()}))
+
+        self.running = False
+        self.idle_timeout = idle_timeout
+        self.idle_timer = None
+
+        # snapshots being captured, the camera isn't stopped under them
+        self.capturing = 0
+
+    def _start(self):
+        '''Starts the camera if it's stopped and cancels a pending idle stop. Called with the lock held.'''
+
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+
+        if not self.running:
+            self.module.start()
+            self.running = True
+
+    def _idle(self):
+        '''Schedules the camera to stop after the idle timeout if nobody is streaming. Called with the lock held.'''
+
+        if any(self.subscribers.values()) or self.capturing:
+            return
+
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+
+        self.idle_timer = threading.Timer(self.idle_timeout, self._stop_idle)
+        self.idle_timer.daemon = True
+        self.idle_timer.start()
+
+    def _stop_idle(self):
+
+        with self.lock:
+            # a timer replaced while it waited for the lock is stale
+            if self.idle_timer is not threading.current_thread():
+                return
+
+            self.idle_timer = None
+
+            if self.running and not any(self.subscribers.values()) and not self.capturing:
+                self.module.stop()
+                self.running = False
+
+    def subscribe(self, profile):
+        '''Registers a viewer of "profile", starting its encoder if it's the first one.'''
+
+        with self.lock:
+            self.subscribers[profile] += 1
+
+            if self.subscribers[profile] == 1:
+                self._start()
+
+                settings = self.profiles[profile]
+                self.encoders[profile] = self.encoder(q=settings.quality)
+                self.module.start_encoder(self.encoders[profile],
+                                          self.file_output(self.outputs[profile]),
+                                          name=settings.stream)
+
+    def unsubscribe(self, profile):
+        '''Removes a viewer of "profile", stopping its encoder if it was the last one.'''
+
+        with self.lock:
+            self.subscribers[profile] -= 1
+
+            if self.subscribers[profile] == 0:
+                self.module.stop_encoder([self.encoders.pop(profile)])
+                self._idle()
+
+    def gen_stream(self, profile="full", timeout=None):
+        '''Yields multipart JPEG chunks for one viewer. A viewer that falls behind skips frames instead of slowing down the others.
+        With a "timeout", None is yielded whenever no frame arrives for that many seconds, so the viewer can give up on a stalled camera.'''
+
+        output = self.outputs[profile]
+
+        self.subscribe(profile)
+        subscription = output.broadcaster.subscribe()
+
+        try:
+            while not subscription.closed:
+                frame = subscription.get(timeout)
+
+                if frame is not None or not subscription.closed:
+                    yield frame
+        finally:
+            # moved from the live counts to the totals in one step, so stats() never counts a viewer twice
+            with self.lock:
+                subscription.close()
+                self.delivered[profile] += subscription.delivered
+                self.dropped[profile] += subscription.dropped
+
+            self.unsubscribe(profile)
+
+    def stats(self):
+        '''Returns {profile: {"viewers", "delivered", "dropped"}}, frame counts covering past and current viewers.'''
+
+        result = {}
+
+        with self.lock:
+            for profile, output in self.outputs.items():
+                live = output.broadcaster.subscribers
+
+                result[profile] = {
+                    "viewers": self.subscribers[profile],
+                    "delivered": self.delivered[profile] + sum(subscription.delivered for subscription in live),
+                    "dropped": self.dropped[profile] + sum(subscription.dropped for subscription in live),
+                }
+
+        return result
+
+    def snapshot(self, profile="full"):
+        '''Returns the latest JPEG of "profile" without starting its stream.
+        Falls back to capturing a single still when no recent frame is cached.'''
+
+        output = self.outputs[profile]
+
+        settings = self.profiles[profile]
+
+        with self.lock:
+            if output.timestamp is not None and time.monotonic() - output.timestamp <= self.snapshot_ttl:
+                return output.frame
+
+            self._start()
+            self.capturing += 1
+            self.module.options["quality"] = settings.quality
+
+        # captured without the lock, so viewers subscribing and stats() don't wait for the still
+        buf = io.BytesIO()
+
+        try:
+            self.module.capture_file(buf, name=settings.stream, format="jpeg")
+
+        finally:
+            with self.lock:
+                self.capturing -= 1
+                self._idle()
+
+        with self.lock:
+            output.frame = buf.getvalue()
+            output.timestamp = time.monotonic()
+
+            return output.frame
 
 
 class DHT22:
     '''Simple class for interacting with the DHT22 sensor using CircuitPython and gpiozero'''
 
-    def __init__(self, dataPin: int, powerPin: int = None):
+    def __init__(self, dataPin: int, powerPin: int = None, arbiter=None, device=None):
         '''dataPin is the output pin, and powerPin is the ACC pin on the sensor.
-        You can connect the ACC pin to either a GPIO pin and specify the pin number, or a 3.3v/5v pin and leave the powerPin parameter empty.'''
+        You can connect the ACC pin to either a GPIO pin and specify the pin number, or a 3.3v/5v pin and leave the powerPin parameter empty.
+        Reads are serialized through "arbiter", by default the one of the data pin. "device" replaces the adafruit_dht driver.'''
+
+        self.arbiter = arbiter or get_arbiter("gpio%d" % dataPin)
 
         # set power pin to a mock pin if there is none specified
         if powerPin is None:
@@ -62,11 +374,23 @@ class DHT22:
             self.power = OutputDevice(powerPin)
 
         # Adafruit bullshit https://github.com/adafruit/Adafruit_CircuitPython_DHT
-        self.device = adafruit_dht.DHT22(getattr(board, "D" + str(dataPin)))
+        self.device = device or require(adafruit_dht, "adafruit_dht").DHT22(getattr(board, "D" + str(dataPin)))
 
-    async def read(self):
+    async def read(self, priority=DASHBOARD, timeout=None):
         '''Reads the sensor and returns the data in a tuple: (humidity, temperature).
-        If the sensor is powered off it will be turned on, read, and turned off again.'''
+        If the sensor is powered off it will be turned on, read, and turned off again.
+        "priority" and "timeout" are passed to the arbiter.'''
+
+        async with self.arbiter.hold(priority, timeout):
+            with metrics.DEVICE_READ_SECONDS.time(("DHT22", )):
+                try:
+                    return await self._read()
+                except BaseException:
+                    # timeouts cancel the read, count those too
+                    metrics.DEVICE_READ_FAILURES.inc(1, ("DHT22", ))
+                    raise
+
+    async def _read(self):
 
         # init
         power_state = self.power.value  # get current power state
@@ -88,6 +412,7 @@ class DHT22:
             except RuntimeError:
 
                 # if read operation fails, try again
+                metrics.DEVICE_READ_RETRIES.inc(1, ("DHT22", ))
                 continue
 
             except Exception as error:
@@ -114,10 +439,12 @@ class DHT22:
 
         try:
             # read sensor
-            return self.device.humidity, self.device.temperature
+            with self.arbiter.hold_sync(DASHBOARD):
+                return self.device.humidity, self.device.temperature
 
         except RuntimeError:
             # return None if reading fails
+            metrics.DEVICE_READ_FAILURES.inc(1, ("DHT22", ))
             return None, None
 
 
@@ -155,9 +482,176 @@ class DS18B20:
         return result
 
 
+class DS18B20Bus:
+    '''Reads every DS18B20 probe on the 1-Wire bus at once.
+    One bus-wide conversion is triggered through the kernel's therm_bulk_read, then the probes are read concurrently on a bounded thread pool,
+    so N probes cost about one 750 ms conversion instead of N. Discovered probes are cached and rescanned every "rescan_interval" seconds.'''
+
+    def __init__(self, rescan_interval=300.0, max_workers=4, arbiter=None):
+
+        self.rescan_interval = rescan_interval
+        self.arbiter = arbiter or get_arbiter("w1")
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix="DS18B20")
+        self.sensors = []
+        self.scanned = None
+        self.latest = {}
+
+    def discover(self, force=False) -> list[W1ThermSensor]:
+        '''Returns the cached probes, rescanning the bus when forced or when the cache is older than "rescan_interval".'''
+
+        if force or self.scanned is None or time.monotonic() - self.scanned > self.rescan_interval:
+            self.sensors = sorted(W1ThermSensor.get_available_sensors([Sensor.DS18B20]),
+                                  key=lambda sensor: sensor.id)
+            self.scanned = time.monotonic()
+
+        return self.sensors
+
+    def masters(self):
+        '''Returns the therm_bulk_read files of every bus master, empty on kernels without bulk conversion support.'''
+
+        return glob.glob(os.path.join(str(W1ThermSensor.BASE_DIRECTORY), "w1_bus_master*", "therm_bulk_read"))
+
+    def trigger(self):
+        '''Starts a conversion on every probe at once. Returns False if the kernel doesn't support it.'''
+
+        masters = self.masters()
+
+        for master in masters:
+            with open(master, "w") as file:
+                file.write("trigger\n")
+
+        return bool(masters)
+
+    @staticmethod
+    def read_converted(sensor: W1ThermSensor) -> float:
+        '''Reads the result of a bulk conversion. The kernel waits for the conversion to finish if it hasn't yet.'''
+
+        with open(os.path.join(str(sensor.sensorpath.parent), "temperature")) as file:
+            return int(file.read()) / 1000.0
+
+    def read_all(self, priority=DASHBOARD, timeout=None) -> dict:
+        '''Reads every probe and returns {probe id: temperature}. Probes that fail to read are left out.
+        Blocks while the bus is held by another request, "priority" and "timeout" are passed to the arbiter.'''
+
+        result = {}
+
+        with self.arbiter.hold_sync(priority, timeout), metrics.DEVICE_READ_SECONDS.time(("DS18B20", )):
+            sensors = self.discover()
+            read = self.read_converted if self.trigger() else W1ThermSensor.get_temperature
+            futures = {sensor.id: self.executor.submit(read, sensor) for sensor in sensors}
+
+            for probe, future in futures.items():
+                try:
+                    result[probe] = future.result()
+                except Exception as error:
+                    metrics.DEVICE_READ_FAILURES.inc(1, ("DS18B20", ))
+                    print("DS18B20 %s read failed: %r" % (probe, error))
+
+        # a probe that vanished shows up again on the next scan
+        if len(result) < len(sensors):
+            self.scanned = None
+
+        self.latest = result
+
+        return result
+
+
+class LevelSensor:
+    '''Float switch level sensor like the LLPK1, handled through gpiozero edge callbacks instead of polling.
+    Edges are debounced in software: a new level is only accepted once it has held for "debounce" seconds.
+    The level guards the pump, so it is read through the pin's arbiter at SAFETY priority, ahead of any other request queued there.'''
+
+    # seconds a level read may wait for the pin before it is retried
+    SAFETY_TIMEOUT = 0.5
+
+    def __init__(self, pin: int, debounce=0.02, pin_factory=None, arbiter=None):
+
+        self.device = DigitalInputDevice(pin, pin_factory=pin_factory)
+        self.arbiter = arbiter or get_arbiter("gpio%d" % pin)
+        self.debounce = debounce
+        self.value = self._read()
+        self.timestamp = time.time()
+        self.timer = None
+        self.edge = None
+        self.lock = threading.Lock()
+
+        # called with (value, timestamp) for every accepted level change, on a timer thread
+        self.listeners = []
+
+        self.device.when_activated = self._edge
+        self.device.when_deactivated = self._edge
+
+    def _edge(self):
+
+        with self.lock:
+
+            # the change is dated from the first edge of a bouncing burst
+            if self.edge is None:
+                self.edge = time.time()
+
+            if self.timer is not None:
+                self.timer.cancel()
+
+            self.timer = threading.Timer(self.debounce, self._settle)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _read(self):
+
+        with self.arbiter.hold_sync(SAFETY, self.SAFETY_TIMEOUT):
+            return self.device.value
+
+    def _settle(self):
+
+        try:
+            value = self._read()
+        except DeadlineExpired as error:
+            # the pin is busy, settle again after another debounce period
+            print("reading the level failed: %r" % error)
+
+            with self.lock:
+                # unless a newer edge has already started another timer
+                if self.timer is threading.current_thread():
+                    self.timer = threading.Timer(self.debounce, self._settle)
+                    self.timer.daemon = True
+                    self.timer.start()
+            return
+
+        with self.lock:
+            edge = self.edge
+            self.timer = None
+            self.edge = None
+
+            if value == self.value:
+                return
+
+            self.value = value
+            self.timestamp = edge
+
+        for listener in self.listeners:
+            listener(value, edge)
+
+    def close(self):
+        self.device.close()
+
+
 class ADS1115:
 
-    def __init__(self):
+    # samples per second for each data rate option
+    Data_Rates = {
+        8: "DR_8SPS",
+        16: "DR_16SPS",
+        32: "DR_32SPS",
+        64: "DR_64SPS",
+        128: "DR_128SPS",
+        250: "DR_250SPS",
+        475: "DR_475SPS",
+        860: "DR_860SPS",
+    }
+
+    def __init__(self, arbiter=None, bus=None, pipeline=None):
+        '''"bus" replaces SMBus(1), e.g. with a simulated one. "pipeline" is the TdsPipeline turning samples into TDS values.'''
 
         # I2C addresses of the device
         self.I2C_Addresses = [0x48, 0x49]
@@ -214,32 +708,46 @@ class ADS1115:
         }
 
         # Get I2C bus
-        self.bus = smbus.SMBus(1)
+        self.bus = metrics.CountedBus(bus or require(smbus, "smbus").SMBus(1), "i2c-1")
+
+        # every transaction on the bus goes through its arbiter
+        self.arbiter = arbiter or get_arbiter("i2c-1")
+
+        # every SMBus transfer made by the async API runs on this one thread, off the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix="ADS1115")
 
         # Set operation params
         self.current_address = self.I2C_Addresses[0]
         self.coefficient = 0.125
         self.gain = 0x02
         self.channel = 0
+        self.filters = {}
+
+        # (timestamps, samples) read from each channel since its last TDS update
+        self.blocks = {}
+
+        if pipeline is None:
+            # imported here, tds needs persistence, which imports the tasks module that imports this one
+            from tds import TdsPipeline
+            pipeline = TdsPipeline()
+
+        self.pipeline = pipeline
+
+        # CONFIG register contents last written to each address, so redundant writes can be skipped
+        self.loaded = {}
+
+        # continuous-mode scan engine filling per-channel rings, and its task, started by the first reader
+        self.scanner = None
+        self.scanTask = None
+
+        # called with self.metadata every time the TDS values are updated
+        self.listeners = []
         self.metadata = {
-            "analogBuffer": [
-                0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
-                0, 0, 0, 0, 0, 0, 0, 0, 0
-            ],
-            "analogBufferTemp": [
-                0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
-                0, 0, 0, 0, 0, 0, 0, 0, 0
-            ],
-            "analogBufferIndex":
-            0,
-            "copyIndex":
-            0,
-            "averageVoltage":
-            0,
-            "tdsValue":
-            0,
-            "calibrationFactor":
-            125,
+            "averageVoltage": 0,
+            "tdsValue": 0,
+            "temperature": None,
+            "timestamp": None,
         }
 
     def setGain(self, gain):
@@ -262,7 +770,7 @@ class ADS1115:
             self.coefficient = 0.125
 
     def setChannel(self, channel):
-        self.channel = channel if channel > 3 else 0
+        self.channel = channel if 0 <= channel <= 3 else 0
 
     def setSingle(self):
 
@@ -277,8 +785,7 @@ class ADS1115:
             | self.Config_Options["CQUE_NONE"],
         ]
 
-        self.bus.write_i2c_block_data(self.current_address,
-                                      self.Register_Map["CONFIG"], block)
+        return self.writeConfig(self.current_address, block)
 
     def setDifferential(self):
 
@@ -319,8 +826,36 @@ class ADS1115:
                 | self.Config_Options["CQUE_NONE"],
             ]
 
-        self.bus.write_i2c_block_data(self.current_address,
-                                      self.Register_Map["CONFIG"], block)
+        return self.writeConfig(self.current_address, block)
+
+    def writeConfig(self, address, block):
+        '''Writes "block" to the CONFIG register unless it is already loaded. Returns True if a write happened.'''
+
+        if self.loaded.get(address) == block:
+            return False
+
+        self.bus.write_i2c_block_data(address, self.Register_Map["CONFIG"],
+                                      block)
+        self.loaded[address] = block
+
+        return True
+
+    def continuousBlock(self, channel, data_rate="DR_128SPS"):
+        '''Returns the CONFIG register bytes that convert "channel" continuously at "data_rate".'''
+
+        return [
+            self.Config_Options["MUX_SINGLE_" + str(channel)]
+            | self.gain
+            | self.Config_Options["MODE_CONTIN"],
+            self.Config_Options[data_rate]
+            | self.Config_Options["CQUE_NONE"],
+        ]
+
+    @staticmethod
+    def conversionTime(sps, margin=0.1):
+        '''Seconds one conversion takes at "sps", padded by "margin" for the +/-10% internal oscillator tolerance.'''
+
+        return (1.0 + margin) / sps
 
     def readValue(self):
         """Read data back from Conversion Register, 2 bytes
@@ -329,84 +864,327 @@ class ADS1115:
         data = self.bus.read_i2c_block_data(self.current_address,
                                             self.Register_Map["CONVERT"], 2)
 
+        return self.convert(data)
+
+    def convert(self, data):
+        '''Converts the two bytes read from the Conversion Register to millivolts at the current gain.'''
+
         # Convert the data
         raw_adc = data[0] * 256 + data[1]
 
         if raw_adc > 32767:
-            raw_adc -= 65535
+            raw_adc -= 65536
 
         # Return converted data
         return int(float(raw_adc) * self.coefficient)
 
     def readVoltage(self, channel):
-        self.setChannel(channel)
-        self.setSingle()
-        time.sleep(0.1)
-        return self.readValue()
+        with self.arbiter.hold_sync(CONTROL):
+            self.setChannel(channel)
+            self.setSingle()
+            time.sleep(self.conversionTime(128))
+            return self.readValue()
 
     def ComparatorVoltage(self, channel):
-        self.setChannel(channel)
-        self.setDifferential()
-        time.sleep(0.1)
-        return self.readValue()
-
-    def getMedianTemp(self):
-        temp = 0.0
-        bufferLen = len(self.metadata["analogBuffer"])
-        for j in range(bufferLen - 1):
-            for i in range(bufferLen - j - 1):
-                if (self.metadata["analogBufferTemp"][i] >
-                        self.metadata["analogBufferTemp"][i + 1]):
-                    temp = self.metadata["analogBufferTemp"][i]
-                    self.metadata["analogBufferTemp"][i] = self.metadata[
-                        "analogBufferTemp"][i + 1]
-                    self.metadata["analogBufferTemp"][i + 1] = temp
-        if bufferLen & 1 > 0:
-            temp = self.metadata["analogBufferTemp"][(bufferLen - 1) / 2]
-        else:
-            temp = (
-                self.metadata["analogBufferTemp"][int(bufferLen / 2)] +
-                self.metadata["analogBufferTemp"][int(bufferLen / 2 - 1)]) / 2
-        return float(temp)
+        with self.arbiter.hold_sync(CONTROL):
+            self.setChannel(channel)
+            self.setDifferential()
+            time.sleep(self.conversionTime(128))
+            return self.readValue()
+
+    def singleShotBlock(self, channel, data_rate="DR_128SPS"):
+        '''Returns the CONFIG register bytes that start one single-ended conversion of "channel" and then power down.'''
+
+        return [
+            self.Config_Options["SINGLE"]
+            | self.Config_Options["MUX_SINGLE_" + str(channel)]
+            | self.gain
+            | self.Config_Options["MODE_SINGLE"],
+            self.Config_Options[data_rate]
+            | self.Config_Options["CQUE_NONE"],
+        ]
+
+    def dataRateFor(self, sps):
+        '''Returns the slowest data rate option that can keep up with "sps" samples per second.'''
 
-    def interpVoltage(self):
+        for rate in sorted(self.Data_Rates):
+            if rate >= sps:
+                return rate
 
-        analogSampleTimepoint = time.time()
-        printTimepoint = time.time()
+        return max(self.Data_Rates)
+
+    async def transfer(self, function, *args):
+        '''Runs an SMBus call on the ADS1115 executor thread and awaits its result.'''
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, function, *args)
+
+    async def read(self, channel, sps=128, address=None, priority=CONTROL, timeout=None):
+        '''Reads one single-ended sample from "channel" in millivolts without blocking the event loop.
+        Waits one conversion period at the data rate for "sps", then polls the CONFIG register's OS bit until the conversion is done.
+        The bus is held for the whole sequence, "priority" and "timeout" are passed to the arbiter.'''
+
+        if not 0 <= channel <= 3:
+            raise ValueError("Invalid ADS1115 channel %s" % channel)
+
+        address = address or self.current_address
+        rate = self.dataRateFor(sps)
+        block = self.singleShotBlock(channel, self.Data_Rates[rate])
+
+        async with self.arbiter.hold(priority, timeout):
+            start = time.perf_counter()
+
+            try:
+                # always written, setting the OS bit is what starts the conversion
+                await self.transfer(self.bus.write_i2c_block_data, address,
+                                    self.Register_Map["CONFIG"], block)
+                self.loaded[address] = block
+
+                # the conversion takes one data rate period, re-check at a tenth of that
+                await asyncio.sleep(1.0 / rate)
+
+                while True:
+                    config = await self.transfer(self.bus.read_i2c_block_data,
+                                                 address, self.Register_Map["CONFIG"], 2)
+
+                    # OS bit reads 1 once the device is no longer converting
+                    if config[0] & self.Config_Options["SINGLE"]:
+                        break
+
+                    metrics.DEVICE_READ_RETRIES.inc(1, ("ADS1115", ))
+                    await asyncio.sleep(0.1 / rate)
+
+                data = await self.transfer(self.bus.read_i2c_block_data, address,
+                                           self.Register_Map["CONVERT"], 2)
+
+                return self.convert(data)
+
+            except Exception:
+                metrics.DEVICE_READ_FAILURES.inc(1, ("ADS1115", ))
+                raise
+
+            finally:
+                metrics.DEVICE_READ_SECONDS.observe(time.perf_counter() - start, ("ADS1115", ))
+
+    async def stream(self, channel, sps, address=None, priority=CONTROL, timeout=1.0):
+        '''Async generator yielding samples from "channel" at "sps" samples per second.
+        Samples are scheduled against absolute deadlines so the rate doesn't drift with read latency.
+        A sample that can't get the bus within "timeout" seconds is skipped.'''
+
+        loop = asyncio.get_running_loop()
+        period = 1.0 / sps
+        deadline = loop.time()
 
         while True:
+            try:
+                sample = await self.read(channel, sps, address, priority, timeout)
+            except DeadlineExpired:
+                sample = None
+
+            if sample is not None:
+                yield sample
+
+            deadline += period
+            delay = deadline - loop.time()
+
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                # fell behind, restart the schedule from now instead of bursting to catch up
+                deadline = loop.time()
+
+    def pushSample(self, channel, sample, timestamp=None):
+        '''Adds a sample read from "channel" to its filter and to the block of its next TDS update.'''
+
+        self.getFilter(channel).push(sample)
+
+        times, samples = self.blocks.setdefault(channel, ([], []))
+        times.append(time.time() if timestamp is None else timestamp)
+        samples.append(sample)
+
+    def updateTds(self, channel=1):
+        '''Runs the samples read from "channel" since the last update through the TDS pipeline,
+        updating "averageVoltage", "tdsValue" and the water "temperature" in self.metadata from the newest one.'''
+
+        times, samples = self.blocks.pop(channel, ((), ()))
+
+        if not samples:
+            return
+
+        result = self.pipeline.process("ads1115.%d" % channel, times, samples)
+
+        self.metadata["averageVoltage"] = float(result["voltage"][-1])
+        self.metadata["tdsValue"] = float(result["tds"][-1])
+        self.metadata["temperature"] = float(result["temperature"][-1])
+        self.metadata["timestamp"] = time.time()
+
+        for listener in self.listeners:
+            listener(self.metadata)
+
+    def startScanner(self, channels=None, sps=860):
+        '''Returns the scan engine, starting it as a task on the running loop unless it is running already.
+        "channels" and "sps" only apply to the first start. Call on the runtime loop.'''
+
+        if self.scanner is None:
+            self.scanner = ADS1115Scanner(self, channels, sps)
+
+        if self.scanTask is None or self.scanTask.done():
+            self.scanTask = asyncio.ensure_future(self.scanner.run())
+
+        return self.scanner
+
+    def stopScanner(self):
+
+        if self.scanTask is not None:
+            self.scanTask.cancel()
+            self.scanTask = None
+
+    async def runTds(self, channel=1, interval=0.8, address=None):
+        '''Feeds the samples the scan engine collects from "channel" through the filter and TDS pipeline forever,
+        updating the TDS values in self.metadata every "interval" seconds. The scan engine is stopped when this is cancelled.'''
+
+        address = address or self.current_address
+        scanner = self.startScanner()
+        since = float("-inf")
+
+        try:
+            while True:
+                await asyncio.sleep(interval)
+
+                times, samples = scanner.since(address, channel, since)
+
+                if not len(times):
+                    continue
+
+                since = times[-1]
+
+                for timestamp, sample in zip(times, samples):
+                    self.pushSample(channel, sample, timestamp)
+
+                self.updateTds(channel)
+
+        finally:
+            self.stopScanner()
 
-            if time.time() - analogSampleTimepoint > 0.04:
-                # print(" test.......... ")
-                analogSampleTimepoint = time.time()
+    def getFilter(self, channel, window=30):
+        '''Returns the running median filter that samples read from "channel" are pushed into.'''
 
-                self.metadata["analogBuffer"][
-                    self.metadata["analogBufferIndex"]] = self.readVoltage(1)
+        if channel not in self.filters:
+            self.filters[channel] = RunningMedian(window)
 
-                self.metadata["analogBufferIndex"] += self.metadata[
-                    "analogBufferIndex"]
+        return self.filters[channel]
 
-                if self.metadata["analogBufferIndex"] == 30:
-                    self.metadata["analogBufferIndex"] = 0
+    def getMedianTemp(self, channel=1):
+        '''Median of the recent samples read from "channel", or 0.0 if there are none.'''
 
-            if time.time() - printTimepoint > 0.8:
-                # print(" test ")
-                printTimepoint = time.time()
+        return float(self.getFilter(channel).median() or 0.0)
 
-                for self.metadata["copyIndex"] in range(30):
-                    self.metadata["analogBufferTemp"][
-                        self.metadata["copyIndex"]] = self.readVoltage(1)
 
-                self.metadata["averageVoltage"] = self.getMedianTemp() * (
-                    5.0 / 1024.0)
+class ADS1115Scanner:
+    '''Continuous-mode scan engine sampling many ADS1115 channels on one schedule.
+    Every address converts one of its channels in parallel each step, round-robin, and results go into per-channel ring buffers.'''
 
-                compensationCoefficient = 1.0 + 0.02 * self.metadata[
-                    "calibrationFactor"]
+    def __init__(self, ads1115: ADS1115, channels: dict = None, sps=860, size=1024):
+        '''"channels" maps I2C addresses to the channels to scan on them, defaults to AIN0-AIN3 on every address.
+        Conversions run at the data rate for "sps", and the last "size" samples of each channel are kept.'''
 
-                compensationVolatge = (self.metadata["averageVoltage"] /
-                                       compensationCoefficient)
+        self.ads1115 = ads1115
+        self.channels = channels or {
+            address: [0, 1, 2, 3] for address in ads1115.I2C_Addresses
+        }
+        self.rate = ads1115.dataRateFor(sps)
+        self.period = ads1115.conversionTime(self.rate)
+
+        # (address, channel) -> ring buffers of sample times and millivolts
+        self.times = {}
+        self.values = {}
+
+        for address, channels in self.channels.items():
+            for channel in channels:
+                self.times[(address, channel)] = RingBuffer(size)
+                self.values[(address, channel)] = RingBuffer(size)
+
+        self.steps = 0
+
+    def since(self, address, channel, timestamp):
+        '''Returns the (timestamps, millivolts) arrays of a channel's samples taken after "timestamp", oldest first.'''
+
+        key = (address, channel)
+        times = self.times[key].values()
+        first = bisect.bisect_right(times, timestamp)
+
+        return times[first:], self.values[key].values()[first:]
+
+    def latest(self, address, channel):
+        '''Returns the newest (timestamp, millivolts) sample of a channel, or None if it hasn't been sampled yet.'''
+
+        key = (address, channel)
+
+        if len(self.values[key]) == 0:
+            return None
+
+        return self.times[key].last(), self.values[key].last()
+
+    def schedule(self):
+        '''Returns the (address, channel) pairs converted at each step, one channel per address.'''
+
+        longest = max(len(channels) for channels in self.channels.values())
+
+        return [[(address, channels[step % len(channels)])
+                 for address, channels in self.channels.items()]
+                for step in range(longest)]
+
+    def _select(self, address, channel):
+
+        # a redundant write would restart the running conversion, so skip it
+        return self.ads1115.writeConfig(
+            address,
+            self.ads1115.continuousBlock(channel,
+                                         self.ads1115.Data_Rates[self.rate]))
+
+    def _read(self, address):
+
+        return self.ads1115.bus.read_i2c_block_data(
+            address, self.ads1115.Register_Map["CONVERT"], 2)
+
+    async def run(self):
+        '''Scans forever. Each step loads the next channel on every address, waits exactly one conversion period and reads them all.
+        An address that doesn't answer, like a second board that isn't fitted, is dropped from the scan.'''
+
+        ads1115 = self.ads1115
+
+        while self.channels:
+            for step in self.schedule():
+                missing = []
+
+                # a single-shot read in between changes the config, it is written again on the next step
+                async with ads1115.arbiter.hold(CONTROL):
+
+                    for address, channel in step:
+                        try:
+                            await ads1115.transfer(self._select, address, channel)
+                        except OSError as error:
+                            print("ADS1115 at 0x%02x dropped from the scan: %r" % (address, error))
+                            missing.append(address)
+
+                    await asyncio.sleep(self.period)
+
+                    for address, channel in step:
+                        if address in missing:
+                            continue
+
+                        data = await ads1115.transfer(self._read, address)
+
+                        self.times[(address, channel)].append(time.time())
+                        self.values[(address, channel)].append(ads1115.convert(data))
+
+                self.steps += 1
+
+                if missing:
+                    for address in missing:
+                        del self.channels[address]
+
+                    # start over on the remaining addresses
+                    break
 
-                self.metadata["tdsValue"] = (
-                    133.42 * compensationVolatge**3 -
-                    255.86 * compensationVolatge**2 +
-                    857.39 * compensationVolatge) * 0.5
+        raise OSError("No ADS1115 answered on the scanned addresses")
@@ -0,0 +1,91 @@
+import json
+import threading
+import time
+
+from broadcast import Broadcaster
+from runtime import runtime as default_runtime
+
+
+class EventHub:
+    '''Pushes events to any number of Server-Sent Events clients.
+    Each event is encoded once and shared by every client. Events published faster than their topic's minimum interval are coalesced, only the newest is sent.'''
+
+    def __init__(self, min_intervals: dict = None, default_interval=0.0, maxsize=64, runtime=None):
+        '''"min_intervals" maps topics to the minimum number of seconds between two of their events, other topics use "default_interval".
+        Clients that fall more than "maxsize" events behind drop their oldest ones.'''
+
+        self.min_intervals = dict(min_intervals or {})
+        self.default_interval = default_interval
+        self.broadcaster = Broadcaster(maxsize)
+        self.runtime = runtime or default_runtime
+
+        # per coalescing key: when it was last sent, and the newest event waiting to be sent
+        self.sent = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        # newest event of every key, replayed to clients as they connect
+        self.latest = {}
+
+    def publish(self, topic, data, key=None):
+        '''Publishes "data" as a "topic" event. Safe to call from any thread and never blocks.
+        Events are coalesced per "key", which defaults to the topic, so give e.g. every relay its own key.'''
+
+        key = (topic, key)
+        interval = self.min_intervals.get(topic, self.default_interval)
+
+        with self.lock:
+            now = time.monotonic()
+            wait = self.sent.get(key, -interval) + interval - now
+
+            if wait <= 0:
+                self.sent[key] = now
+                self._emit(key, data)
+                return
+
+            # a flush is already scheduled if something was pending, just replace what it will send
+            scheduled = key in self.pending
+            self.pending[key] = data
+
+        if not scheduled:
+            self.runtime.loop.call_soon_threadsafe(
+                self.runtime.loop.call_later, wait, self._flush, key)
+
+    def _flush(self, key):
+
+        with self.lock:
+            if key not in self.pending:
+                return
+
+            self.sent[key] = time.monotonic()
+            self._emit(key, self.pending.pop(key))
+
+    def _emit(self, key, data):
+
+        event = b"event: %s\ndata: %s\n\n" % (key[0].encode(), json.dumps(data).encode())
+
+        self.latest[key] = event
+        self.broadcaster.publish(event)
+
+    def stream(self, topics=None, heartbeat=15.0):
+        '''Generator of encoded SSE chunks for one client, starting with the newest event of every key.
+        "topics" limits the events to the given topics. A comment is sent every "heartbeat" idle seconds to keep the connection open.'''
+
+        def wanted(event):
+            return topics is None or event.split(b"\n", 1)[0][7:].decode() in topics
+
+        with self.broadcaster.subscribe() as subscription:
+
+            yield b"retry: 5000\n\n"
+
+            for event in list(self.latest.values()):
+                if wanted(event):
+                    yield event
+
+            while True:
+                event = subscription.get(heartbeat)
+
+                if event is None:
+                    yield b": keepalive\n\n"
+                elif wanted(event):
+                    yield event
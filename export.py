@@ -0,0 +1,81 @@
+import heapq
+import json
+import math
+import zlib
+
+from timeseries import TimeSeriesStore
+
+
+def records(store: TimeSeriesStore, metrics, start=None, end=None, cursor=None):
+    '''Yields (timestamp, metric, value) for every sample of "metrics" with start <= timestamp < end, merged into time order.
+    Only one record per metric is held in memory at a time. "cursor" is the (timestamp, metric) of the last record a client received,
+    output resumes right after it.'''
+
+    if cursor is not None:
+        start = cursor[0] if start is None else max(start, cursor[0])
+
+    streams = [_tagged(store, metric, start, end) for metric in sorted(metrics)]
+
+    for record in heapq.merge(*streams):
+        if cursor is not None and record[:2] <= tuple(cursor):
+            continue
+
+        yield record
+
+
+def _tagged(store, metric, start, end):
+
+    for timestamp, value in store.read(metric, start, end):
+        yield timestamp, metric, value
+
+
+def ndjson(rows, fields):
+    '''Formats rows as newline-delimited JSON objects with the given field names. NaN and infinite values are written as null.'''
+
+    for row in rows:
+        # json.dumps would write them as NaN and Infinity, which aren't JSON
+        row = [None if isinstance(value, float) and not math.isfinite(value) else value for value in row]
+
+        yield json.dumps(dict(zip(fields, row)), allow_nan=False) + "\n"
+
+
+def csv_lines(rows, fields):
+    '''Formats rows as CSV with a header line. Values are numbers or plain identifiers, so nothing needs quoting.'''
+
+    yield ",".join(fields) + "\n"
+
+    for row in rows:
+        yield ",".join(repr(value) if isinstance(value, float) else str(value) for value in row) + "\n"
+
+
+def chunked(lines, size=65536):
+    '''Joins text lines into encoded chunks of about "size" bytes, so the response isn't written a line at a time.'''
+
+    chunk = []
+    length = 0
+
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+
+        if length >= size:
+            yield "".join(chunk).encode()
+            chunk = []
+            length = 0
+
+    if chunk:
+        yield "".join(chunk).encode()
+
+
+def gzipped(chunks, level=6):
+    '''Compresses a stream of byte chunks into a single gzip stream as it goes.'''
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+
+        if data:
+            yield data
+
+    yield compressor.flush()
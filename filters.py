@@ -0,0 +1,143 @@
+import bisect
+from array import array
+
+
+class RingBuffer:
+    '''Fixed-capacity FIFO of numbers backed by an array. Once full, each append overwrites the oldest value.'''
+
+    def __init__(self, capacity: int, typecode="d"):
+
+        self.capacity = capacity
+        self.data = array(typecode, bytes(array(typecode).itemsize * capacity))
+        self.start = 0
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def full(self):
+        return self.length == self.capacity
+
+    def append(self, value):
+        '''Appends a value and returns the value it overwrote, or None if the buffer wasn't full.'''
+
+        end = (self.start + self.length) % self.capacity
+
+        if self.length == self.capacity:
+            evicted = self.data[end]
+            self.data[end] = value
+            self.start = (self.start + 1) % self.capacity
+            return evicted
+
+        self.data[end] = value
+        self.length += 1
+
+        return None
+
+    def clear(self):
+        self.start = 0
+        self.length = 0
+
+    def last(self):
+        '''Returns the newest value, or None if empty.'''
+
+        if self.length == 0:
+            return None
+
+        return self.data[(self.start + self.length - 1) % self.capacity]
+
+    def values(self) -> array:
+        '''Returns a copy of the buffered values, oldest first.'''
+
+        end = self.start + self.length
+
+        if end <= self.capacity:
+            return self.data[self.start:end]
+
+        return self.data[self.start:] + self.data[:end - self.capacity]
+
+    def __iter__(self):
+        return iter(self.values())
+
+
+class RunningMedian:
+    '''Sliding-window filter fed one sample at a time.
+    Keeps the window both in arrival order and sorted, so the median and percentiles are O(1) reads and each push is an O(log n) search.'''
+
+    def __init__(self, window: int = 30):
+
+        self.window = RingBuffer(window)
+        self.sorted = array("d")
+        self.total = 0.0
+
+    def __len__(self):
+        return len(self.window)
+
+    def push(self, value):
+        '''Adds a sample, dropping the oldest one once the window is full.'''
+
+        value = float(value)
+        evicted = self.window.append(value)
+
+        if evicted is not None:
+            del self.sorted[bisect.bisect_left(self.sorted, evicted)]
+            self.total -= evicted
+
+        bisect.insort(self.sorted, value)
+        self.total += value
+
+        # resync the running sum now and then so rounding errors don't accumulate
+        if self.window.full() and self.window.start == 0:
+            self.total = sum(self.sorted)
+
+    def clear(self):
+        self.window.clear()
+        del self.sorted[:]
+        self.total = 0.0
+
+    def median(self):
+        '''Median of the window, or None if empty.'''
+
+        n = len(self.sorted)
+
+        if n == 0:
+            return None
+
+        if n & 1:
+            return self.sorted[n // 2]
+
+        return (self.sorted[n // 2 - 1] + self.sorted[n // 2]) / 2
+
+    def percentile(self, p):
+        '''Linearly interpolated "p"th percentile (0-100) of the window, or None if empty.'''
+
+        n = len(self.sorted)
+
+        if n == 0:
+            return None
+
+        rank = (n - 1) * p / 100.0
+        low = int(rank)
+        high = min(low + 1, n - 1)
+
+        return self.sorted[low] + (self.sorted[high] - self.sorted[low]) * (rank - low)
+
+    def mean(self):
+        '''Mean of the window, or None if empty.'''
+
+        n = len(self.sorted)
+
+        return self.total / n if n else None
+
+    def trimmed_mean(self, proportion=0.1):
+        '''Mean of the window after discarding "proportion" of the samples from each end, or None if empty.'''
+
+        n = len(self.sorted)
+
+        if n == 0:
+            return None
+
+        cut = int(n * proportion)
+        kept = self.sorted[cut:n - cut] or self.sorted
+
+        return sum(kept) / len(kept)
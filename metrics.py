@@ -0,0 +1,364 @@
+import asyncio
+import bisect
+import threading
+import time
+
+
+# latency buckets in seconds, from sub-millisecond I2C transfers to multi-second DHT22 retries
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# series pushed by a worker are dropped once it hasn't pushed for this many seconds, e.g. after it exited
+REMOTE_TTL = 60.0
+
+
+class Registry:
+    '''Collection of metrics rendered together in the Prometheus text format.'''
+
+    def __init__(self):
+
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+
+        with self.lock:
+            self.metrics.append(metric)
+
+        return metric
+
+    def render(self):
+        '''Returns every metric in the Prometheus text exposition format, version 0.0.4.'''
+
+        lines = []
+
+        for metric in list(self.metrics):
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            lines.extend(metric.lines())
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    pairs.extend('%s="%s"' % pair for pair in extra)
+
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+def _number(value):
+
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value))
+
+
+class _Sharded:
+    '''Base of metrics updated without locks: every thread writes its own shard, and shards are only summed when rendered.
+    Shards of threads that have exited are folded into one, so short-lived request threads don't pile up.'''
+
+    type = "untyped"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+        # (thread, shard) per thread that has written, and the folded shards of finished threads
+        self.shards = []
+        self.retired = {}
+
+        # worker -> (monotonic time received, collected series) pushed by other processes, see absorb()
+        self.remote = {}
+
+        if registry is not None:
+            registry.register(self)
+
+    def _shard(self):
+
+        try:
+            return self.local.shard
+        except AttributeError:
+            pass
+
+        shard = self.local.shard = {}
+
+        with self.lock:
+            if len(self.shards) >= 64:
+                self._retire()
+
+            self.shards.append((threading.current_thread(), shard))
+
+        return shard
+
+    def _retire(self):
+
+        alive = []
+
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self._merge(self.retired, shard)
+
+        self.shards = alive
+
+    def collect(self):
+        '''Returns the sum of every shard, keyed by label values.'''
+
+        with self.lock:
+            self._retire()
+            total = {}
+            self._merge(total, self.retired)
+
+            for _, shard in self.shards:
+                # a dict copy is atomic under the GIL, so the owner thread can keep writing
+                self._merge(total, shard.copy())
+
+        return total
+
+    def series(self):
+        '''Yields (extra labels, label values, value) of this process's series, then of every worker that pushed recently.'''
+
+        for labels, value in sorted(self.collect().items()):
+            yield (), labels, value
+
+        now = time.monotonic()
+
+        for worker, (received, collected) in sorted(self.remote.items()):
+            if now - received > REMOTE_TTL:
+                continue
+
+            for labels, value in sorted(collected.items()):
+                yield (("worker", worker), ), labels, value
+
+
+class Counter(_Sharded):
+    '''Monotonic counter, optionally split by label values.'''
+
+    type = "counter"
+
+    def inc(self, amount=1.0, labels=()):
+        '''Adds "amount" to the series of the "labels" value tuple.'''
+
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0.0) + amount
+
+    @staticmethod
+    def _merge(total, shard):
+
+        for labels, value in shard.items():
+            total[labels] = total.get(labels, 0.0) + value
+
+    def lines(self):
+
+        for extra, labels, value in self.series():
+            yield "%s%s %s" % (self.name, _labels(self.labelnames, labels, extra), _number(value))
+
+
+class Histogram(_Sharded):
+    '''Distribution of observed values in fixed buckets, optionally split by label values.'''
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS, registry=REGISTRY):
+
+        self.buckets = tuple(sorted(buckets))
+
+        super().__init__(name, help, labelnames, registry)
+
+    def observe(self, value, labels=()):
+        '''Records one observation in the series of the "labels" value tuple.'''
+
+        shard = self._shard()
+        counts = shard.get(labels)
+
+        if counts is None:
+            # one count per bucket plus +Inf, then the sum
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, labels=()):
+        '''Context manager observing the time spent in its block.'''
+
+        return _Timer(self, labels)
+
+    @staticmethod
+    def _merge(total, shard):
+
+        for labels, counts in shard.items():
+            if labels in total:
+                total[labels] = [a + b for a, b in zip(total[labels], counts)]
+            else:
+                total[labels] = list(counts)
+
+    def lines(self):
+
+        for extra, labels, counts in self.series():
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + (float("inf"), ), counts):
+                cumulative += count
+                yield "%s_bucket%s %d" % (self.name, _labels(self.labelnames, labels, extra + (("le", _number(bound)), )), cumulative)
+
+            yield "%s_sum%s %s" % (self.name, _labels(self.labelnames, labels, extra), _number(counts[-1]))
+            yield "%s_count%s %d" % (self.name, _labels(self.labelnames, labels, extra), cumulative)
+
+
+class _Timer:
+
+    def __init__(self, histogram, labels):
+
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+
+
+class Callback:
+    '''Metric read from "function" when rendered, for values another object already keeps, like queue depths.
+    "function" returns a number, or a dict of label value tuples to numbers.'''
+
+    def __init__(self, name, help, function, labelnames=(), type="gauge", registry=REGISTRY):
+
+        self.name = name
+        self.help = help
+        self.function = function
+        self.labelnames = tuple(labelnames)
+        self.type = type
+
+        if registry is not None:
+            registry.register(self)
+
+    def lines(self):
+
+        values = self.function()
+
+        if not isinstance(values, dict):
+            values = {(): values}
+
+        for labels, value in sorted(values.items()):
+            if value is not None:
+                yield "%s%s %s" % (self.name, _labels(self.labelnames, labels), _number(value))
+
+
+# device reads, by device class
+DEVICE_READ_SECONDS = Histogram("growroom_device_read_seconds", "Duration of device reads, including retries.", ["device"])
+DEVICE_READ_RETRIES = Counter("growroom_device_read_retries_total", "Device read attempts that were retried.", ["device"])
+DEVICE_READ_FAILURES = Counter("growroom_device_read_failures_total", "Device reads that failed.", ["device"])
+
+# I2C traffic, by bus, device address and direction
+I2C_TRANSACTIONS = Counter("growroom_i2c_transactions_total", "I2C transactions.", ["bus", "address", "op"])
+I2C_BYTES = Counter("growroom_i2c_bytes_total", "I2C payload bytes transferred.", ["bus", "address", "op"])
+
+# persistence
+JOURNAL_SECONDS = Histogram("growroom_journal_operation_seconds", "Duration of journal loads, flushes and compactions.", ["journal", "op"])
+JOURNAL_RECORDS = Counter("growroom_journal_records_written_total", "Records appended to journals.", ["journal"])
+
+# HTTP, by route pattern
+HTTP_SECONDS = Histogram("growroom_http_request_duration_seconds", "Time to produce the response, streams are timed up to their first byte.", ["route", "method"])
+HTTP_REQUESTS = Counter("growroom_http_requests_total", "HTTP requests handled.", ["route", "method", "status"])
+
+# event loop
+LOOP_LAG = Histogram("growroom_event_loop_lag_seconds", "How late the runtime event loop wakes up a sleeping coroutine.")
+
+
+class CountedBus:
+    '''Wraps an SMBus, counting the transactions and bytes of the block transfers it makes.'''
+
+    def __init__(self, bus, name):
+
+        self.bus = bus
+        self.name = name
+
+    def write_i2c_block_data(self, address, register, data):
+
+        labels = (self.name, "0x%02x" % address, "write")
+        I2C_TRANSACTIONS.inc(1, labels)
+        I2C_BYTES.inc(1 + len(data), labels)
+
+        return self.bus.write_i2c_block_data(address, register, data)
+
+    def read_i2c_block_data(self, address, register, length):
+
+        labels = (self.name, "0x%02x" % address, "read")
+        I2C_TRANSACTIONS.inc(1, labels)
+        I2C_BYTES.inc(length, labels)
+
+        return self.bus.read_i2c_block_data(address, register, length)
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+
+
+def export(names, registry=REGISTRY):
+    '''Returns the series of the counters and histograms called "names" as JSON-able data, for pushing to another process.'''
+
+    return {
+        metric.name: [[list(labels), value] for labels, value in metric.collect().items()]
+        for metric in list(registry.metrics) if metric.name in names and isinstance(metric, _Sharded)
+    }
+
+
+def absorb(worker, data, registry=REGISTRY):
+    '''Takes the export() of process "worker", replacing what it pushed before. Its series are rendered with a "worker" label.'''
+
+    received = time.monotonic()
+
+    for metric in list(registry.metrics):
+        if metric.name in data and isinstance(metric, _Sharded):
+            metric.remote[str(worker)] = (received, {tuple(labels): value for labels, value in data[metric.name]})
+
+
+async def watch_loop(interval=0.5):
+    '''Measures event loop lag forever: how much later than asked for a sleep of "interval" seconds returns.'''
+
+    loop = asyncio.get_running_loop()
+
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - start - interval))
+
+
+def instrument(app):
+    '''Times every request of the Flask "app" per route pattern, so paths with ids don't each get their own series.'''
+
+    from flask import g, request
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def stop_timer(response):
+
+        start = g.pop("metrics_start", None)
+
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            HTTP_SECONDS.observe(time.perf_counter() - start, (route, request.method))
+            HTTP_REQUESTS.inc(1, (route, request.method, str(response.status_code)))
+
+        return response
+
+    return app
@@ -0,0 +1,183 @@
+'''Hardware owner process of the production server.
+Runs the devices, task handler, scheduler and camera of api.py, publishes sensor snapshots and camera frames to shared memory for the
+HTTP workers in worker.py, and answers the requests they forward, like relay loop changes, on a local Unix socket.'''
+
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+from flask import make_response, request
+from werkzeug.serving import run_simple
+
+import api
+import metrics
+from devices import Camera
+from shared import SharedState
+
+# shared with worker.py through the environment
+SHARED_NAME = os.environ.get("GROWROOM_SHM", "growroom")
+SOCKET = os.environ.get("GROWROOM_SOCKET", ".growroom.sock")
+
+# slot sizes in bytes
+SNAPSHOT_SIZE = 64 * 1024
+FRAME_SIZE = 1024 * 1024
+
+
+class SnapshotPublisher:
+    '''Writes api.sensor_snapshot() to the "sensors" slot whenever the event hub publishes something, and at least every "interval" seconds.
+    Unchanged snapshots aren't written, so a worker's version check stays cheap.'''
+
+    def __init__(self, state, interval=1.0):
+
+        self.state = state
+        self.interval = interval
+        self.last = None
+        self.thread = threading.Thread(target=self.run, name="snapshot_publisher", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def publish(self):
+
+        data = json.dumps(api.sensor_snapshot(), sort_keys=True).encode()
+
+        if data != self.last:
+            self.state.write("sensors", data)
+            self.last = data
+
+    def run(self):
+
+        with api.hub.broadcaster.subscribe() as subscription:
+            while True:
+                try:
+                    self.publish()
+                except Exception as error:
+                    print("publishing the sensor snapshot failed: %r" % error)
+
+                subscription.get(self.interval)
+
+
+class FrameFeed:
+    '''Copies the multipart chunks of one camera profile to its "camera/<profile>" slot while workers hold a lease on it.
+    Workers renew their lease while they have viewers, so the camera still stops once nobody is watching.'''
+
+    def __init__(self, state, profile, lease=10.0):
+
+        self.state = state
+        self.profile = profile
+        self.lease = lease
+        self.expires = 0.0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def watch(self):
+        '''Extends the lease, starting the feed if it isn't running.'''
+
+        with self.lock:
+            self.expires = time.monotonic() + self.lease
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="feed_" + self.profile, daemon=True)
+                self.thread.start()
+
+    def run(self):
+
+        stream = None
+
+        try:
+            # wake at least every second, so a stalled camera can't hold the feed past its lease
+            stream = api.devices["camera"].gen_stream(self.profile, timeout=1.0)
+
+            for chunk in stream:
+                if chunk is not None:
+                    self.state.write("camera/" + self.profile, chunk)
+
+                with self.lock:
+                    if time.monotonic() > self.expires:
+                        self.thread = None
+                        return
+
+        except Exception as error:
+            print("camera feed %s failed: %r" % (self.profile, error))
+
+            with self.lock:
+                self.thread = None
+
+        finally:
+            if stream is not None:
+                stream.close()
+
+
+def frame_chunk(frame):
+    '''Frames a JPEG the way Camera streams do, so snapshots and stream frames share a slot.'''
+
+    return b''.join((b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ',
+                     str(len(frame)).encode(), b'\r\n\r\n', frame, b'\r\n'))
+
+
+def main():
+
+    state = SharedState.create(SHARED_NAME, {
+        "sensors": SNAPSHOT_SIZE,
+        **{"camera/" + profile: FRAME_SIZE for profile in Camera.PROFILES},
+    })
+    feeds = {profile: FrameFeed(state, profile) for profile in Camera.PROFILES}
+
+    SnapshotPublisher(state).start()
+
+    # requests only the workers make, they aren't part of the public api
+    @api.app.route("/owner/camera_watch", methods=["POST"])
+    def owner_camera_watch():
+
+        profile = request.args.get("profile", "full")
+
+        if profile not in feeds:
+            return make_response('''Invalid query param "profile"''', 400)
+
+        feeds[profile].watch()
+
+        return make_response("", 204)
+
+    @api.app.route("/owner/camera_snapshot", methods=["POST"])
+    def owner_camera_snapshot():
+
+        profile = request.args.get("profile", "full")
+
+        if profile not in feeds:
+            return make_response('''Invalid query param "profile"''', 400)
+
+        state.write("camera/" + profile, frame_chunk(api.devices["camera"].snapshot(profile)))
+
+        return make_response("", 204)
+
+    # request metrics of the workers, served on /metrics with a "worker" label
+    @api.app.route("/owner/metrics", methods=["POST"])
+    def owner_metrics():
+
+        metrics.absorb(request.args.get("worker", "unknown"), request.get_json(force=True))
+
+        return make_response("", 204)
+
+    # server_start stops the owner with SIGTERM, exit through the cleanup below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # a socket left behind by a crashed owner would make the bind fail
+    if os.path.exists(SOCKET):
+        os.remove(SOCKET)
+
+    # only the workers connect, over the socket, so the development server is enough here
+    try:
+        run_simple("unix://" + os.path.abspath(SOCKET), 0, api.app, threaded=True)
+    finally:
+        api.runtime.stop()
+        state.close()
+
+        if os.path.exists(SOCKET):
+            os.remove(SOCKET)
+
+
+if __name__ == "__main__":
+    main()
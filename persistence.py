@@ -1,92 +1,337 @@
+import os
+import dbm
+import pickle
 import shelve
+import struct
+import threading
+import zlib
 import tasks
-import asyncio
+
+import metrics
+from runtime import runtime as default_runtime
+
+
+class Journal:
+    '''Crash-safe key/value store kept in memory and persisted as an append-only journal of pickled records.
+    Changes are written behind, "delay" seconds after the first unflushed change, and the journal is compacted once it is mostly dead records.'''
+
+    # record header: payload length and crc32 of the payload
+    HEADER = struct.Struct("<II")
+
+    def __init__(self, filename, delay=1.0, compact_after=256):
+
+        self.filename = filename
+        self.delay = delay
+        self.compact_after = compact_after
+        self.state = {}
+
+        # key -> pickled "set" record of its current value, what compaction writes
+        self.encoded = {}
+
+        self.records = 0
+        self.pending = []
+
+        # guards the state as well as the pending records, so compaction sees the same state the records describe
+        self.lock = threading.Lock()
+
+        # serialises writes to the file, held across the fsync instead of the lock above
+        self.flush_lock = threading.Lock()
+        self.timer = None
+        self.label = os.path.basename(filename)
+
+        with metrics.JOURNAL_SECONDS.time((self.label, "load")):
+            self.load()
+
+    def load(self):
+        '''Replays the journal into memory. A torn or corrupt record at the tail from a crash mid-write is truncated away.'''
+
+        self.state = {}
+        self.encoded = {}
+        self.records = 0
+        good = 0
+
+        try:
+            with open(self.filename, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return
+
+        while good + self.HEADER.size <= len(data):
+            length, crc = self.HEADER.unpack_from(data, good)
+            start = good + self.HEADER.size
+            payload = data[start:start + length]
+
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+
+            op, key, value = pickle.loads(payload)
+
+            if op == "set":
+                self.state[key] = value
+                self.encoded[key] = payload
+            else:
+                self.state.pop(key, None)
+                self.encoded.pop(key, None)
+
+            self.records += 1
+            good = start + length
+
+        if good < len(data):
+            with open(self.filename, "r+b") as file:
+                file.truncate(good)
+
+        if self.records > len(self.state):
+            self._compact(self._snapshot())
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def set(self, key, value):
+        '''Stores "value" under "key", writing to disk only if it changed.
+        The value is pickled right away, so changing it afterwards doesn't change what gets written.'''
+
+        payload = pickle.dumps(("set", key, value))
+
+        with self.lock:
+            if self.encoded.get(key) == payload:
+                return
+
+            self.state[key] = value
+            self.encoded[key] = payload
+            self._append(payload)
+
+        if self.delay <= 0:
+            self.flush()
+
+    def delete(self, key):
+        '''Removes "key", writing to disk only if it was present.'''
+
+        with self.lock:
+            if key not in self.state:
+                return
+
+            del self.state[key]
+            del self.encoded[key]
+            self._append(pickle.dumps(("del", key, None)))
+
+        if self.delay <= 0:
+            self.flush()
+
+    def _append(self, payload):
+        '''Queues a pickled record, called with the lock held.'''
+
+        self.pending.append(payload)
+
+        if self.delay > 0 and self.timer is None:
+            self.timer = threading.Timer(self.delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        '''Writes pending changes to the journal and syncs it to disk.
+        The lock is only held to take the pending records, so changes aren't blocked behind the fsync.'''
+
+        with self.flush_lock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+
+                pending, self.pending = self.pending, []
+
+            if not pending:
+                return
+
+            chunks = []
+            for payload in pending:
+                chunks.append(self.HEADER.pack(len(payload), zlib.crc32(payload)))
+                chunks.append(payload)
+
+            try:
+                with metrics.JOURNAL_SECONDS.time((self.label, "flush")):
+                    with open(self.filename, "ab") as file:
+                        file.write(b"".join(chunks))
+                        file.flush()
+                        os.fsync(file.fileno())
+
+            except BaseException:
+                # put the records back in order, the next flush retries them
+                with self.lock:
+                    self.pending = pending + self.pending
+                raise
+
+            metrics.JOURNAL_RECORDS.inc(len(pending), (self.label, ))
+
+            with self.lock:
+                self.records += len(pending)
+
+                if self.records <= self.compact_after or self.records <= 2 * len(self.state):
+                    return
+
+                payloads = self._snapshot()
+
+            with metrics.JOURNAL_SECONDS.time((self.label, "compact")):
+                self._compact(payloads)
+
+    def compact(self):
+        '''Rewrites the journal as one record per live key, replacing the old file atomically.'''
+
+        with self.flush_lock:
+            with self.lock:
+                payloads = self._snapshot()
+
+            self._compact(payloads)
+
+    def _snapshot(self):
+        '''Returns the records compaction writes, called with both locks held. Pending records are dropped, the snapshot already holds them.'''
+
+        self.pending = []
+        self.records = len(self.encoded)
+
+        return list(self.encoded.values())
+
+    def _compact(self, payloads):
+
+        temp = self.filename + ".tmp"
+
+        with open(temp, "wb") as file:
+            for payload in payloads:
+                file.write(self.HEADER.pack(len(payload), zlib.crc32(payload)))
+                file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(temp, self.filename)
+
+        # the rename only survives a power cut once the directory is synced too
+        directory = os.open(os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY)
+
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
 
 
 class task_handler:
-    '''High-level class to dynamically schedule and manage coroutines defined in "./tasks.py" with a built-in event loop. 
-    Tasks are persistent and __init__ will attempt to reschedule any coroutines that were running if  the application was stopped.'''
+    '''High-level class to dynamically schedule and manage coroutines defined in "./tasks.py" on the shared Runtime event loop.
+    Tasks are persistent and restore() will attempt to reschedule any coroutines that were running if  the application was stopped.
+    Task state is served from memory, and only changes are written to disk through a Journal.'''
 
-    def __init__(self, filename, persistence=True):
+    def __init__(self, filename, persistence=True, runtime=None):
 
-        self.event_loop = asyncio.get_event_loop()
-        self.tasks = set()
+        self.runtime = runtime or default_runtime
+        self.event_loop = self.runtime.loop
+        self.tasks = {}
         self.filename = filename
 
-        if persistence:
+        # called with ("start" or "stop", task id) on every change
+        self.listeners = []
+        self.journal = Journal(filename + ".journal") if persistence else None
 
-            # read tasks_db and start stored tasks
-            with shelve.open(filename) as tasks_db:
-                for id in tasks_db.keys():
-                    task_info = tasks_db[id]
+        # set once stored tasks have been started again
+        self.restored = not persistence
+
+        # carry over tasks stored by the shelve based versions of this class
+        if persistence and not os.path.exists(self.journal.filename):
+            self._import_shelve(filename)
+
+    def restore(self):
+        '''Starts the stored tasks again, keeping the records of coroutines that no longer exist so they can be migrated.
+        Kept out of __init__ so it can run in the background, e.g. from a runtime startup hook.'''
+
+        if self.journal is not None:
+            for id, task_info in list(self.journal.state.items()):
+                if hasattr(tasks, task_info["coro"]):
                     self.start(task_info["coro"], id, **task_info["kwargs"])
+                else:
+                    print("skipping stored task %s, tasks.%s doesn't exist" % (id, task_info["coro"]))
+
+        self.restored = True
+
+    def _import_shelve(self, filename):
+
+        try:
+            with shelve.open(filename, flag="r") as tasks_db:
+                for id in tasks_db.keys():
+                    self.journal.set(id, tasks_db[id])
+        except dbm.error:
+            return
+
+        self.journal.flush()
 
     def start(self, coro, task_id, **kwargs):
-        '''Schedules and runs a coroutine defined in "./tasks.py" who's name matches the given "task_id". 
+        '''Schedules and runs a coroutine defined in "./tasks.py" who's name matches the given "task_id".
         Keyword arguments have to be basic data types, or anything pickle-able.'''
 
+        # tasks are only created and cancelled on the runtime thread
+        self.runtime.call(self._start, coro, task_id, kwargs)
+
+        # add task info to persistence object
+        if self.journal is not None:
+            self.journal.set(task_id, {"coro": coro, "kwargs": kwargs})
+
+    def _start(self, coro, task_id, kwargs):
+
+        # replace a task already running under this id
+        if task_id in self.tasks:
+            self.tasks.pop(task_id).cancel()
+
         # create task with provided task_id and keyword arguments
         task = self.event_loop.create_task(
             getattr(tasks, coro)(**kwargs), name=task_id)
 
-        # add task to set for future reference, and to prevent garbage collection
-        self.tasks.add(task)
+        # keep a reference to prevent garbage collection, and forget the task once it finishes
+        self.tasks[task_id] = task
+        task.add_done_callback(self._discard)
 
-        # add task info to persistence object
-        with shelve.open(self.filename) as tasks_db:
-            tasks_db[task_id] = {"coro": coro, "kwargs": kwargs}
+        for listener in self.listeners:
+            listener("start", task_id)
+
+    def _discard(self, task):
 
-        # run event loop if it's stopped
-        if not self.event_loop.is_running():
-            self.event_loop.run_in_executor(None, self.event_loop.run_forever)
+        if self.tasks.get(task.get_name()) is task:
+            del self.tasks[task.get_name()]
+
+        for listener in self.listeners:
+            listener("stop", task.get_name())
 
     def stop(self, task_id):
         '''Calls Task.cancel() on a running task who's Task.get_name() matches the given "task_id"'''
 
-        # stop task and clear it from memory
-        if task_id in self.list_tasks():
+        # stop task and clear it from memory, on the runtime thread like every other change to the tasks
+        self.runtime.call(self._stop, task_id)
+
+        # remove item from persistence object
+        if self.journal is not None:
+            self.journal.delete(task_id)
+
+    def _stop(self, task_id):
 
-            task = self.fetch_task(task_id)
+        task = self.tasks.pop(task_id, None)
 
+        if task is not None:
             task.cancel()
-            self.tasks.discard(task)
 
-        # remove item from persistence object
-        with shelve.open(self.filename) as tasks_db:
-            del tasks_db[task_id]
+    def close(self):
+        '''Writes any pending task changes to disk. Running tasks are left to the runtime to cancel.'''
 
-        # stop event loop if there are no running tasks
-        if len(self.tasks) == 0:
-            self.event_loop.call_soon_threadsafe(self.event_loop.stop)
+        if self.journal is not None:
+            self.journal.flush()
 
     def fetch_task(self, task_id):
         '''Returns a Task object where Task.get_name() matches the given "task_id", else returns None'''
 
-        query = None
-
-        # binary search for a task who's name matches "task_id"
-        for task in self.tasks:
-            if task.get_name() == task_id:
-                query = task
-                break
-
-        return query
+        return self.tasks.get(task_id)
 
     def fetch_task_info(self, task_id):
-        with shelve.open(self.filename) as tasks_db:
-            try:
-                info = tasks_db[task_id]
-            except KeyError:
-                info = None
+        '''Returns the stored coroutine name and keyword arguments of "task_id", else returns None'''
 
-            return info
+        if self.journal is None:
+            return None
 
-    def list_tasks(self):
-        '''List the result of Task.get_name() for every element in self.tasks'''
+        return self.journal.get(task_id)
 
-        # generate array of task names
-        arr = []
-        for task in self.tasks:
-            arr.append(task.get_name())
+    def list_tasks(self):
+        '''List the result of Task.get_name() for every running task'''
 
-        return arr
+        return list(self.tasks)
@@ -0,0 +1,325 @@
+import queue
+import struct
+import threading
+import numpy as np
+
+from timeseries import TimeSeriesStore
+
+
+# one closed rollup bucket on disk: bucket start, min, max, sum, count, last
+ROLLUP = struct.Struct("<dddddd")
+
+RAW_DTYPE = np.dtype([("t", "<f8"), ("value", "<f8")])
+ROLLUP_DTYPE = np.dtype([("t", "<f8"), ("min", "<f8"), ("max", "<f8"), ("sum", "<f8"), ("count", "<f8"), ("last", "<f8")])
+
+
+class Rollup:
+    '''One aggregation tier of one metric, updated a sample at a time. Closed buckets are appended to the "<metric>@<step>" series.'''
+
+    def __init__(self, series, step):
+
+        self.series = series
+        self.step = step
+        self.bucket = None
+
+        # samples up to here were read from disk when the tier was opened, the listener skips them
+        self.end = float("-inf")
+
+    def add(self, timestamp, value):
+
+        start = timestamp // self.step * self.step
+
+        if self.bucket is not None and start != self.bucket[0]:
+            if start < self.bucket[0]:
+                # the clock went backwards, the sample is only kept raw
+                return
+
+            self.close()
+
+        if self.bucket is None:
+            self.bucket = [start, value, value, value, 1.0, value]
+        else:
+            bucket = self.bucket
+            bucket[1] = min(bucket[1], value)
+            bucket[2] = max(bucket[2], value)
+            bucket[3] += value
+            bucket[4] += 1.0
+            bucket[5] = value
+
+    def extend(self, times, values):
+        '''Folds arrays of samples in at once with NumPy, the same as calling add() for each of them in order.'''
+
+        starts = times // self.step * self.step
+
+        # samples from before a newer bucket, the clock having gone backwards, are only kept raw
+        floor = np.maximum.accumulate(starts)
+
+        if self.bucket is not None:
+            floor = np.maximum(floor, self.bucket[0])
+
+        keep = starts >= floor
+        starts, values = starts[keep], values[keep]
+
+        if not len(starts):
+            return
+
+        first = np.concatenate(([0], np.flatnonzero(np.diff(starts)) + 1))
+        last = np.concatenate((first[1:], [len(starts)])) - 1
+        buckets = np.column_stack((starts[first], np.minimum.reduceat(values, first), np.maximum.reduceat(values, first),
+                                   np.add.reduceat(values, first), last - first + 1.0, values[last]))
+
+        # the first new bucket can continue the open one
+        if self.bucket is not None and buckets[0, 0] == self.bucket[0]:
+            start, low, high, total, count, latest = buckets[0]
+            bucket = self.bucket
+            buckets[0] = (start, min(bucket[1], low), max(bucket[2], high), bucket[3] + total, bucket[4] + count, latest)
+        else:
+            self.close()
+
+        for bucket in buckets[:-1]:
+            self.series.append(*bucket.tolist())
+
+        self.bucket = buckets[-1].tolist()
+
+    def close(self):
+        '''Writes the open bucket to the tier's series.'''
+
+        if self.bucket is not None:
+            self.series.append(*self.bucket)
+            self.bucket = None
+
+
+def load(series, dtype, start, end):
+    '''Reads the records of "series" with start <= t < end into one NumPy structured array, straight from the segment maps.'''
+
+    series.flush()
+    chunks = []
+
+    for segment in series.segments():
+        if segment.start >= end or segment.start + series.span <= start:
+            continue
+
+        view = segment.open()
+
+        if view is None:
+            continue
+
+        records = np.frombuffer(view, dtype)
+        first, last = np.searchsorted(records["t"], [start, end])
+
+        # copy the slice so the map can be closed
+        chunks.append(records[first:last].copy())
+
+        del records
+        view.close()
+
+    if not chunks:
+        return np.empty(0, dtype)
+
+    return np.concatenate(chunks)
+
+
+class Rollups:
+    '''Maintains 1 min, 15 min and 1 h (by default) rollup tiers for every metric of a TimeSeriesStore as samples arrive,
+    and answers downsampled range queries from the coarsest tier that fits, aggregating buckets with NumPy.'''
+
+    def __init__(self, store: TimeSeriesStore, tiers=(60, 900, 3600)):
+
+        self.store = store
+        self.tiers = sorted(tiers)
+        self.rollups = {}
+        self.lock = threading.Lock()
+
+        # metrics being caught up, with the samples that arrived meanwhile, and an Event per metric set once it's open
+        self.opening = {}
+        self.ready = {}
+
+        # tiers are only ever built on the opener thread, so the listener never touches the disk
+        self.queue = queue.Queue()
+        self.thread = None
+
+        store.listeners.append(self.add)
+
+    def start(self):
+        '''Queues every stored metric for the opener thread, so catching them up doesn't hold up startup or the runtime loop.'''
+
+        with self.lock:
+            for name in self.store.metrics():
+                self._request(name)
+
+    def _request(self, name, reset=False):
+        '''Queues metric "name" for the opener thread unless it already is, returning the Event set once it's open. Called with the lock held.'''
+
+        ready = self.ready.get(name)
+
+        if ready is None or reset:
+            ready = self.ready[name] = threading.Event()
+            self.queue.put((name, reset, ready))
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="rollups", daemon=True)
+                self.thread.start()
+
+        return ready
+
+    def _run(self):
+
+        while True:
+            name, reset, ready = self.queue.get()
+
+            try:
+                self._open(name, reset)
+            except Exception as error:
+                print("rollups of %s failed: %r" % (name, error))
+            finally:
+                ready.set()
+
+    def _open(self, name, reset=False):
+        '''Creates the metric's tiers and rebuilds any buckets missing since the last closed one, e.g. after a restart.
+        The raw samples are read up to the newest one when opening starts, later ones are folded in as they arrive.
+        With "reset", the tiers are dropped and recomputed from scratch.'''
+
+        series = self.store.get(name)
+
+        with self.lock:
+            if reset:
+                self.rollups.pop(name, None)
+            elif name in self.rollups:
+                return
+
+            # samples up to "end" are already stored, so they're read from disk and skipped by the listener
+            last = series.last()
+            end = last[0] if last else float("-inf")
+            self.opening[name] = []
+
+        try:
+            rollups = []
+
+            for step in self.tiers:
+                tier = Rollup(self.store.get("%s@%d" % (name, step), ROLLUP), step)
+                resume = float("-inf")
+
+                if reset:
+                    tier.series.replace(b"")
+
+                # pick up after the newest closed bucket on disk
+                for segment in reversed(tier.series.segments()):
+                    closed = load(tier.series, ROLLUP_DTYPE, segment.start, float("inf"))
+
+                    if len(closed):
+                        resume = float(closed[-1]["t"]) + step
+                        break
+
+                records = load(series, RAW_DTYPE, resume, np.nextafter(end, np.inf))
+                tier.extend(records["t"], records["value"])
+                tier.end = end
+
+                rollups.append(tier)
+
+        except BaseException:
+            with self.lock:
+                del self.opening[name]
+            raise
+
+        with self.lock:
+            self.rollups[name] = rollups
+
+            for timestamp, value in self.opening.pop(name):
+                self._add(rollups, timestamp, value)
+
+    def add(self, name, timestamp, value):
+        '''Store listener: folds one new sample into every tier of its metric.
+        Samples of a metric that isn't open yet are held for the opener, or left to it to read from disk.'''
+
+        with self.lock:
+            rollups = self.rollups.get(name)
+
+            if rollups is None:
+                if name in self.opening:
+                    self.opening[name].append((timestamp, value))
+                else:
+                    self._request(name)
+                return
+
+            self._add(rollups, timestamp, value)
+
+    @staticmethod
+    def _add(rollups, timestamp, value):
+
+        # a sample stored just before its metric was opened can reach the listener after it was read from disk
+        for tier in rollups:
+            if timestamp > tier.end:
+                tier.add(timestamp, value)
+
+    def rebuild(self, name):
+        '''Recomputes every tier of metric "name" from its raw samples, after they were rewritten by TimeSeriesStore.replace().'''
+
+        with self.lock:
+            ready = self._request(name, reset=True)
+
+        ready.wait()
+
+    def flush(self):
+        '''Writes every tier's closed buckets to disk. Open buckets are rebuilt from the raw samples on restart.'''
+
+        for rollups in list(self.rollups.values()):
+            for tier in rollups:
+                tier.series.flush()
+
+    def query(self, name, start, end, step):
+        '''Returns (tier, buckets) for metric "name" between "start" and "end", in buckets of "step" seconds aligned to the epoch.
+        "tier" is the rollup step the answer was computed from, 0 for raw samples. "buckets" maps "t", "min", "max", "mean", "last" and "count" to arrays.'''
+
+        if name not in self.store.series or "@" in name:
+            raise KeyError(name)
+
+        with self.lock:
+            ready = self._request(name)
+
+        ready.wait()
+
+        with self.lock:
+            rollups = self.rollups.get(name, [])
+
+        # the coarsest tier that divides the step evenly, so every tier bucket lands in exactly one output bucket
+        tier = None
+        for rollup in rollups:
+            if rollup.step <= step and step % rollup.step == 0:
+                tier = rollup
+
+        if tier is None:
+            raw = load(self.store.get(name), RAW_DTYPE, start, end)
+            times, values = raw["t"], raw["value"]
+            mins = maxs = sums = lasts = values
+            counts = np.ones(len(values))
+        else:
+            # the bucket holding "start" may have started before it
+            first = start // tier.step * tier.step
+            rows = load(tier.series, ROLLUP_DTYPE, first, end)
+
+            with self.lock:
+                if tier.bucket is not None and first <= tier.bucket[0] < end:
+                    rows = np.concatenate([rows, np.array([tuple(tier.bucket)], ROLLUP_DTYPE)])
+
+            times, mins, maxs, sums, counts, lasts = (rows[field] for field in ROLLUP_DTYPE.names)
+
+        buckets = np.floor(times / step) * step
+
+        if len(buckets) == 0:
+            empty = np.empty(0)
+            return (tier.step if tier else 0), {"t": empty, "min": empty, "max": empty, "mean": empty, "last": empty, "count": empty}
+
+        # rows are in time order, so each output bucket is one contiguous run
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        ends = np.r_[starts[1:], len(buckets)] - 1
+        total = np.add.reduceat(sums, starts)
+        count = np.add.reduceat(counts, starts)
+
+        return (tier.step if tier else 0), {
+            "t": buckets[starts],
+            "min": np.minimum.reduceat(mins, starts),
+            "max": np.maximum.reduceat(maxs, starts),
+            "mean": total / count,
+            "last": lasts[ends],
+            "count": count,
+        }
@@ -0,0 +1,160 @@
+import asyncio
+import atexit
+import inspect
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+
+class Runtime:
+    '''One long-lived thread owning the asyncio event loop that all device I/O and tasks run on.
+    Synchronous code, like Flask views, hands work to it through submit() and call(), which block the caller with a timeout.'''
+
+    def __init__(self, name="runtime"):
+
+        self.name = name
+        self.loop = asyncio.new_event_loop()
+        self.thread = None
+        self.startup_hooks = []
+        self.shutdown_hooks = []
+
+        # set once every startup hook has run
+        self.started = threading.Event()
+
+    def on_startup(self, hook):
+        '''Registers a callable, or coroutine function, to run on the event loop when the runtime starts. Usable as a decorator.'''
+
+        self.startup_hooks.append(hook)
+
+        # hooks registered after start run straight away
+        if self.is_running():
+            self.submit(self._run_hook(hook))
+
+        return hook
+
+    def on_shutdown(self, hook):
+        '''Registers a callable, or coroutine function, to run on the event loop before the runtime stops. Usable as a decorator.'''
+
+        self.shutdown_hooks.append(hook)
+
+        return hook
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def in_loop(self):
+        '''True when called from the runtime thread itself.'''
+
+        return threading.current_thread() is self.thread
+
+    def start(self, wait=True):
+        '''Starts the event loop thread and runs the startup hooks in order. Calling it again does nothing.
+        With "wait" False the hooks run in the background instead of blocking the caller, "started" is set once they are done.'''
+
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name=self.name, daemon=True)
+        self.thread.start()
+
+        atexit.register(self.stop)
+
+        if wait:
+            for hook in self.startup_hooks:
+                self.submit(self._run_hook(hook))
+
+            self.started.set()
+        else:
+            self.spawn(self._startup(list(self.startup_hooks)), name="startup")
+
+    async def _startup(self, hooks):
+
+        # a failing hook is reported and the rest still run, so one broken device can't keep the app from starting
+        for hook in hooks:
+            try:
+                await self._run_hook(hook)
+            except Exception as error:
+                print("startup hook failed: %r" % error)
+
+        self.started.set()
+
+    def stop(self, timeout=5.0):
+        '''Runs the shutdown hooks, cancels every remaining task and stops the event loop thread.'''
+
+        if not self.is_running():
+            return
+
+        for hook in reversed(self.shutdown_hooks):
+            try:
+                self.submit(self._run_hook(hook), timeout)
+            except Exception as error:
+                print("shutdown hook failed: %r" % error)
+
+        try:
+            self.submit(self._cancel_tasks(), timeout)
+        except FutureTimeoutError:
+            pass
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+        self.thread = None
+        self.started.clear()
+
+    async def _run_hook(self, hook):
+
+        result = hook()
+
+        if inspect.isawaitable(result):
+            await result
+
+    async def _cancel_tasks(self):
+
+        current = asyncio.current_task()
+        pending = [task for task in asyncio.all_tasks() if task is not current]
+
+        for task in pending:
+            task.cancel()
+
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    def spawn(self, coro, name=None):
+        '''Schedules "coro" as a task on the runtime loop from any thread and returns a concurrent.futures.Future for its result.'''
+
+        return asyncio.run_coroutine_threadsafe(self._named(coro, name), self.loop)
+
+    async def _named(self, coro, name):
+
+        if name is not None:
+            asyncio.current_task().set_name(name)
+
+        return await coro
+
+    def submit(self, coro, timeout=None):
+        '''Runs "coro" on the runtime loop and blocks until it returns, raising concurrent.futures.TimeoutError after "timeout" seconds.
+        Must not be called from the runtime thread, await the coroutine there instead.'''
+
+        if self.in_loop():
+            raise RuntimeError("Runtime.submit() called from the runtime thread")
+
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    def call(self, function, *args, timeout=None):
+        '''Calls a plain function on the runtime thread and returns its result. Called directly when already on that thread.'''
+
+        if self.in_loop() or not self.is_running():
+            return function(*args)
+
+        async def wrapper():
+            return function(*args)
+
+        return self.submit(wrapper(), timeout)
+
+
+# the runtime shared by the whole application
+runtime = Runtime()
@@ -0,0 +1,149 @@
+import asyncio
+import time
+from collections import namedtuple
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from runtime import runtime as default_runtime
+
+
+# a cached device reading and the wall-clock time it was taken at
+Reading = namedtuple("Reading", ["value", "timestamp"])
+
+
+class Sampler:
+    '''Reads a device on its own schedule and keeps the latest reading in memory.
+    Concurrent callers share one in-flight read instead of each starting their own, so cached reads return immediately.'''
+
+    def __init__(self, read, interval=30.0, ttl=60.0, timeout=15.0, first_wait=2.0, runtime=None):
+        '''"read" is a coroutine function or a plain callable returning the device value.
+        A new reading is taken every "interval" seconds, and a reading older than "ttl" seconds is considered stale.
+        Reads taking longer than "timeout" seconds are abandoned. get() waits at most "first_wait" seconds, and only for the first reading.
+        Sampling runs on "runtime", defaults to the shared runtime.'''
+
+        self.read = read
+        self.interval = interval
+        self.ttl = ttl
+        self.timeout = timeout
+        self.first_wait = first_wait
+        self.runtime = runtime or default_runtime
+        self.latest = None
+
+        # called with every new Reading, on the runtime thread
+        self.listeners = []
+
+        # shared by every caller waiting on the current read, only touched from the event loop
+        self._inflight = None
+        self._task = None
+
+    def start(self):
+        '''Starts sampling the device every "interval" seconds in the background.'''
+
+        if self._task is None:
+            self._task = self.runtime.spawn(self.run())
+
+    def stop(self):
+        '''Stops background sampling. The last reading stays cached.'''
+
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def age(self):
+        '''Seconds since the latest reading was taken, or None if there is no reading yet.'''
+
+        if self.latest is None:
+            return None
+
+        return time.time() - self.latest.timestamp
+
+    def is_fresh(self):
+        '''True if the latest reading is younger than "ttl".'''
+
+        age = self.age()
+
+        return age is not None and age <= self.ttl
+
+    async def sample(self):
+        '''Takes a new reading, or joins the read already in progress. Must be awaited on the runtime loop.'''
+
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._read())
+
+        # shield so one impatient caller can't cancel the read for everybody else
+        return await asyncio.shield(self._inflight)
+
+    def refresh(self):
+        '''Starts a new reading in the background unless one is in flight already. Safe to call from any thread.'''
+
+        if self.runtime.in_loop():
+            self._refresh()
+        else:
+            self.runtime.loop.call_soon_threadsafe(self._refresh)
+
+    def _refresh(self):
+
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._read())
+            self._inflight.add_done_callback(self._refreshed)
+
+    def _refreshed(self, future):
+
+        if not future.cancelled() and future.exception() is not None:
+            print("sampler read failed: %r" % future.exception())
+
+    async def _read(self):
+
+        try:
+            if asyncio.iscoroutinefunction(self.read):
+                value = await asyncio.wait_for(self.read(), self.timeout)
+            else:
+                value = await asyncio.wait_for(
+                    asyncio.get_running_loop().run_in_executor(None, self.read),
+                    self.timeout)
+
+            self.latest = Reading(value, time.time())
+
+            for listener in self.listeners:
+                listener(self.latest)
+
+            return self.latest
+
+        finally:
+            self._inflight = None
+
+    async def run(self):
+        '''Samples the device forever, every "interval" seconds.'''
+
+        while True:
+
+            try:
+                await self.sample()
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                # a failed read keeps the previous reading, try again next interval
+                print("sampler read failed: %r" % error)
+
+            await asyncio.sleep(self.interval)
+
+    def get(self, wait=True):
+        '''Returns the latest Reading, or None if the device has never been read. Safe to call from any thread.
+        A stale reading is returned as it is while a new one is taken in the background, so callers never wait on the hardware.
+        Only while there is no reading at all, and "wait" is True, this waits up to "first_wait" seconds for the first one.'''
+
+        if self.is_fresh():
+            return self.latest
+
+        self.refresh()
+
+        if self.latest is not None or not wait or self.runtime.in_loop():
+            return self.latest
+
+        try:
+            return self.runtime.submit(self.sample(), self.first_wait)
+        except (FutureTimeoutError, asyncio.TimeoutError):
+            pass
+        except Exception as error:
+            print("sampler read failed: %r" % error)
+
+        return self.latest
@@ -0,0 +1,369 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from datetime import datetime, timedelta
+from gpiozero import OutputDevice
+from gpiozero.pins import mock
+
+from persistence import Journal
+from runtime import runtime as default_runtime
+
+
+class Cycle:
+    '''Repeating on/off cycle: on for "timeOn" seconds, then off for "timeOff" seconds.
+    The phase is anchored to the wall-clock time "anchor", so the cycle never drifts and resumes mid-cycle after a restart.'''
+
+    type = "cycle"
+
+    def __init__(self, timeOn=60, timeOff=300, anchor=None):
+
+        self.timeOn = float(timeOn)
+        self.timeOff = float(timeOff)
+        self.anchor = time.time() if anchor is None else float(anchor)
+
+        if self.timeOn < 0 or self.timeOff < 0 or self.timeOn + self.timeOff <= 0:
+            raise ValueError("Cycle times must be positive")
+
+    def state_at(self, t):
+        '''Returns (on, next_change): whether the relay is on at wall-clock time "t", and when that next changes.'''
+
+        period = self.timeOn + self.timeOff
+        phase = (t - self.anchor) % period
+
+        if phase < self.timeOn:
+            return True, t + self.timeOn - phase
+
+        return False, t + period - phase
+
+    def to_dict(self):
+        return {"type": self.type, "timeOn": self.timeOn, "timeOff": self.timeOff, "anchor": self.anchor}
+
+
+class Duty(Cycle):
+    '''Cycle given as a "period" in seconds and the fraction "duty" of it spent on.'''
+
+    type = "duty"
+
+    def __init__(self, period=600, duty=0.5, anchor=None):
+
+        if not 0.0 <= float(duty) <= 1.0:
+            raise ValueError("Duty must be between 0 and 1")
+
+        self.period = float(period)
+        self.duty = float(duty)
+
+        super().__init__(self.period * self.duty, self.period * (1.0 - self.duty), anchor)
+
+    def to_dict(self):
+        return {"type": self.type, "period": self.period, "duty": self.duty, "anchor": self.anchor}
+
+
+class Window:
+    '''Cron-like daily windows in local time, given as "HH:MM-HH:MM" strings. A window ending before it starts runs past midnight.
+    "days" limits the windows to the weekdays they start on, 0 being Monday.'''
+
+    type = "window"
+
+    def __init__(self, windows=("06:00-18:00", ), days=None):
+
+        self.windows = list(windows)
+        self.days = None if days is None else sorted(int(day) for day in days)
+        self.spans = []
+
+        for window in self.windows:
+            start, end = window.split("-")
+            self.spans.append((self._minutes(start), self._minutes(end)))
+
+    @staticmethod
+    def _minutes(text):
+
+        hours, minutes = text.strip().split(":")
+        value = int(hours) * 60 + int(minutes)
+
+        if not 0 <= value <= 24 * 60:
+            raise ValueError("Invalid time of day %s" % text)
+
+        return value
+
+    def _intervals(self, t):
+
+        midnight = datetime.fromtimestamp(t).replace(hour=0, minute=0, second=0, microsecond=0)
+
+        # yesterday's windows can still be running past midnight
+        for offset in range(-1, 8):
+            day = midnight + timedelta(days=offset)
+
+            if self.days is not None and day.weekday() not in self.days:
+                continue
+
+            for start, end in self.spans:
+                if end <= start:
+                    end += 24 * 60
+
+                yield ((day + timedelta(minutes=start)).timestamp(),
+                       (day + timedelta(minutes=end)).timestamp())
+
+    def state_at(self, t):
+
+        on = False
+        next_change = t + 24 * 60 * 60
+
+        for start, end in self._intervals(t):
+            if start <= t < end:
+                on = True
+
+            for boundary in (start, end):
+                if boundary > t:
+                    next_change = min(next_change, boundary)
+
+        return on, next_change
+
+    def to_dict(self):
+        return {"type": self.type, "windows": self.windows, "days": self.days}
+
+
+# schedule classes by their "type" key
+SCHEDULES = {schedule.type: schedule for schedule in (Cycle, Duty, Window)}
+
+
+def schedule_from_dict(info: dict):
+    '''Rebuilds a schedule from the result of its to_dict()'''
+
+    kwargs = dict(info)
+    return SCHEDULES[kwargs.pop("type")](**kwargs)
+
+
+class RelayScheduler:
+    '''Drives any number of relays from one coroutine, using a heap of absolute monotonic deadlines.
+    Schedules are persisted with their phase anchors through a Journal, so a restart resumes every relay where it left off.'''
+
+    def __init__(self, relays: dict, filename, runtime=None):
+        '''"relays" maps relay ids to GPIO pin numbers, a pin of None uses a mock pin.'''
+
+        self.relays = relays
+        self.runtime = runtime or default_runtime
+        self.journal = Journal(filename + ".journal")
+        self.devices = {}
+        self.schedules = {}
+        self.states = {}
+
+        # relay id -> state asked for by the controller driving it, for relays without a schedule
+        self.driven = {}
+
+        # relay id -> reasons it is held off, checked and toggled under the lock so an interlock can't be overridden
+        self.inhibited = {}
+        self.lock = threading.Lock()
+
+        # (deadline, sequence, relay id, generation), stale entries are skipped by generation
+        self.heap = []
+        self.generations = {}
+        self.sequence = itertools.count()
+        self.wakeup = None
+        self.task = None
+
+        # called with ("relay", relay id, on) for every toggle and ("loop", relay id, info) for every schedule change
+        self.listeners = []
+
+    def device(self, relay_id):
+
+        if relay_id not in self.devices:
+            pin = self.relays[relay_id]
+
+            if pin is None:
+                self.devices[relay_id] = OutputDevice(1, pin_factory=mock.MockFactory())
+            else:
+                self.devices[relay_id] = OutputDevice(pin)
+
+        return self.devices[relay_id]
+
+    def start(self):
+        '''Restores persisted schedules and starts driving relays. Call from a runtime startup hook.'''
+
+        for relay_id, info in list(self.journal.state.items()):
+            if relay_id in self.relays:
+                self.schedules[relay_id] = schedule_from_dict(info)
+                self._arm(relay_id)
+
+        if self.task is None:
+            self.task = self.runtime.spawn(self.run(), name="relay_scheduler")
+
+    def add(self, relay_id, schedule):
+        '''Drives "relay_id" from "schedule", replacing its current schedule.'''
+
+        if relay_id not in self.relays:
+            raise KeyError(relay_id)
+
+        self.journal.set(relay_id, schedule.to_dict())
+        self.runtime.call(self._add, relay_id, schedule)
+
+    def _add(self, relay_id, schedule):
+
+        self.schedules[relay_id] = schedule
+        self._arm(relay_id)
+        self._notify("loop", relay_id, self.info(relay_id))
+
+    def remove(self, relay_id):
+        '''Stops driving "relay_id" and switches it off.'''
+
+        self.journal.delete(relay_id)
+        self.runtime.call(self._remove, relay_id)
+
+    def _remove(self, relay_id):
+
+        if self.schedules.pop(relay_id, None) is not None:
+            self.generations[relay_id] = self.generations.get(relay_id, 0) + 1
+            self._apply(relay_id, False)
+            self._notify("loop", relay_id, None)
+
+    def drive(self, relay_id, on):
+        '''Switches "relay_id" for a controller, which the relay mustn't also be scheduled by. Interlocks still hold it off,
+        and once they're released it returns to the last state asked for. Runs on the runtime thread.'''
+
+        if relay_id not in self.relays:
+            raise KeyError(relay_id)
+
+        if relay_id in self.schedules:
+            raise ValueError("%s is driven by a schedule" % relay_id)
+
+        self.driven[relay_id] = on
+        self._apply(relay_id, on)
+
+    def undrive(self, relay_id):
+        '''Releases "relay_id" from its controller and switches it off, unless a schedule has taken it over meanwhile.'''
+
+        if self.driven.pop(relay_id, None) is not None and relay_id not in self.schedules:
+            self._apply(relay_id, False)
+
+    def _notify(self, event, relay_id, data):
+
+        for listener in self.listeners:
+            listener(event, relay_id, data)
+
+    def schedule(self, relay_id):
+        '''Returns the schedule driving "relay_id", or None.'''
+
+        return self.schedules.get(relay_id)
+
+    def state(self, relay_id):
+        '''Returns True if the relay was last switched on, False if off, None if it was never switched.'''
+
+        return self.states.get(relay_id)
+
+    def list(self):
+        return list(self.schedules)
+
+    def info(self, relay_id):
+        '''Returns the relay's schedule settings and current state, or None if it isn't scheduled.'''
+
+        schedule = self.schedules.get(relay_id)
+
+        if schedule is None:
+            return None
+
+        return {
+            "relay_state": self.states.get(relay_id),
+            "inhibited": sorted(self.inhibited.get(relay_id, ())),
+            "schedule": schedule.to_dict(),
+        }
+
+    def adopt(self, th):
+        '''Moves relay loops persisted as "power_loop" tasks by a task_handler onto this scheduler.'''
+
+        for task_id, info in list(th.journal.state.items() if th.journal else ()):
+            if info["coro"] == "power_loop" and task_id in self.relays:
+                self.add(task_id, Cycle(info["kwargs"].get("timeOn", 60), info["kwargs"].get("timeOff", 60)))
+                th.stop(task_id)
+
+    def _arm(self, relay_id):
+        '''Applies the relay's current state and pushes its next deadline. Runs on the runtime thread.'''
+
+        generation = self.generations.get(relay_id, 0) + 1
+        self.generations[relay_id] = generation
+
+        now = time.time()
+        on, next_change = self.schedules[relay_id].state_at(now)
+        self._apply(relay_id, on)
+
+        # convert the wall-clock change time to a monotonic deadline
+        deadline = time.monotonic() + max(0.0, next_change - now)
+        heapq.heappush(self.heap, (deadline, next(self.sequence), relay_id, generation))
+
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def _apply(self, relay_id, on):
+
+        with self.lock:
+            if self.inhibited.get(relay_id):
+                on = False
+
+            if self.states.get(relay_id) == on:
+                return
+
+            device = self.device(relay_id)
+            device.on() if on else device.off()
+            self.states[relay_id] = on
+
+        print(relay_id + (" on" if on else " off"))
+        self._notify("relay", relay_id, on)
+
+    def inhibit(self, relay_id, reason):
+        '''Switches "relay_id" off right away and holds it off until every reason is released. Safe to call from any thread.'''
+
+        with self.lock:
+            self.inhibited.setdefault(relay_id, set()).add(reason)
+
+        self._apply(relay_id, False)
+
+    def release(self, relay_id, reason):
+        '''Drops one reason holding "relay_id" off. Once none are left, the relay returns to its scheduled or driven state.'''
+
+        with self.lock:
+            reasons = self.inhibited.get(relay_id, set())
+            reasons.discard(reason)
+
+            if reasons:
+                return
+
+            self.inhibited.pop(relay_id, None)
+
+        if relay_id in self.schedules or relay_id in self.driven:
+            self.runtime.loop.call_soon_threadsafe(self._rearm, relay_id)
+
+    def _rearm(self, relay_id):
+
+        if relay_id in self.schedules:
+            self._arm(relay_id)
+        elif relay_id in self.driven:
+            self._apply(relay_id, self.driven[relay_id])
+
+    async def run(self):
+        '''Sleeps until the earliest deadline, switches every relay that is due, and reschedules it.'''
+
+        self.wakeup = asyncio.Event()
+
+        try:
+            while True:
+                now = time.monotonic()
+
+                while self.heap and self.heap[0][0] <= now:
+                    _, _, relay_id, generation = heapq.heappop(self.heap)
+
+                    if self.generations.get(relay_id) == generation and relay_id in self.schedules:
+                        self._arm(relay_id)
+
+                timeout = self.heap[0][0] - now if self.heap else None
+
+                self.wakeup.clear()
+
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+        except asyncio.CancelledError:
+            for relay_id in list(self.schedules):
+                self._apply(relay_id, False)
+            raise
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import struct
+import threading
+import time
+from collections import namedtuple
+from multiprocessing import resource_tracker, shared_memory
+
+
+# slot header: sequence number, payload length, padding, wall-clock time of the write
+HEADER = struct.Struct("QIId")
+
+# segment header: length of the JSON slot directory that follows it
+DIRECTORY = struct.Struct("I")
+
+Value = namedtuple("Value", ["version", "timestamp", "data"])
+
+
+class SharedState:
+    '''Named shared-memory segment of fixed size slots, written by one process and read by any number of others.
+    Every slot is guarded by a seqlock: the writer makes its sequence number odd while writing and even once done,
+    readers copy the payload out and retry if the number was odd or changed meanwhile. Readers never block the writer.'''
+
+    def __init__(self, memory, slots: dict, owner=False):
+
+        self.memory = memory
+        self.buf = memory.buf
+        self.slots = slots
+        self.owner = owner
+
+        # writes to a slot can come from several threads of the owner, the seqlock only allows one writer at a time
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, name, capacities: dict):
+        '''Creates segment "name" holding one slot per key of "capacities", sized in bytes. A segment left behind by a crashed owner is replaced.'''
+
+        # slot offsets, kept 8 byte aligned so sequence numbers are written in one store
+        slots = {}
+        offset = 4096
+
+        for slot, capacity in capacities.items():
+            slots[slot] = (offset, capacity)
+            offset += HEADER.size + (capacity + 7) // 8 * 8
+
+        directory = json.dumps(slots).encode()
+
+        if DIRECTORY.size + len(directory) > 4096:
+            raise ValueError("Too many shared slots")
+
+        try:
+            memory = shared_memory.SharedMemory(name, create=True, size=offset)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            memory = shared_memory.SharedMemory(name, create=True, size=offset)
+
+        memory.buf[:offset] = bytes(offset)
+        DIRECTORY.pack_into(memory.buf, 0, len(directory))
+        memory.buf[DIRECTORY.size:DIRECTORY.size + len(directory)] = directory
+
+        return cls(memory, slots, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        '''Opens the existing segment "name" for reading. Raises FileNotFoundError if its owner hasn't created it yet.'''
+
+        memory = shared_memory.SharedMemory(name)
+
+        # the resource tracker would unlink the segment when this process exits, it belongs to the owner
+        resource_tracker.unregister(memory._name, "shared_memory")
+
+        length, = DIRECTORY.unpack_from(memory.buf, 0)
+        slots = {slot: tuple(place) for slot, place in
+                 json.loads(bytes(memory.buf[DIRECTORY.size:DIRECTORY.size + length])).items()}
+
+        return cls(memory, slots)
+
+    def write(self, slot, data, timestamp=None):
+        '''Replaces the payload of "slot" with the bytes "data". Raises ValueError if it doesn't fit.'''
+
+        offset, capacity = self.slots[slot]
+
+        if len(data) > capacity:
+            raise ValueError("%d bytes don't fit shared slot %s of %d" % (len(data), slot, capacity))
+
+        with self.lock:
+            sequence = HEADER.unpack_from(self.buf, offset)[0]
+
+            HEADER.pack_into(self.buf, offset, sequence + 1, 0, 0, 0.0)
+            self.buf[offset + HEADER.size:offset + HEADER.size + len(data)] = data
+            HEADER.pack_into(self.buf, offset, sequence + 2, len(data), 0,
+                             time.time() if timestamp is None else timestamp)
+
+    def version(self, slot):
+        '''Returns the sequence number of "slot", which changes with every write, so readers can poll it before copying anything.'''
+
+        return HEADER.unpack_from(self.buf, self.slots[slot][0])[0]
+
+    def read(self, slot, retries=1000):
+        '''Returns a Value of the latest complete write to "slot", its data being None if nothing was written yet.'''
+
+        offset, _ = self.slots[slot]
+        start = offset + HEADER.size
+
+        for _ in range(retries):
+            sequence, length, _, timestamp = HEADER.unpack_from(self.buf, offset)
+
+            if sequence & 1:
+                # mid-write, let the writer finish
+                time.sleep(0)
+                continue
+
+            data = bytes(self.buf[start:start + length])
+
+            if HEADER.unpack_from(self.buf, offset)[0] == sequence:
+                return Value(sequence, timestamp if sequence else None, data if sequence else None)
+
+        raise TimeoutError("Shared slot %s kept changing while read" % slot)
+
+    def close(self):
+        '''Detaches from the segment, and removes it if this process created it.'''
+
+        # views of the buffer have to go before the mapping can be closed
+        self.buf = None
+        self.memory.close()
+
+        if self.owner:
+            self.memory.unlink()
+
+
+def snapshot_ages(snapshot, now=None):
+    '''Adds an "age" in seconds next to every "timestamp" of a sensor snapshot.'''
+
+    now = now or time.time()
+
+    for fields in snapshot.values():
+        if "timestamp" in fields:
+            fields["age"] = None if fields["timestamp"] is None else round(now - fields["timestamp"], 3)
+
+    snapshot["timestamp"] = now
+
+    return snapshot
+
+
+def snapshot_etag(snapshot):
+    '''Returns an ETag of a sensor snapshot covering only the values, so polls get a 304 until a reading actually changes.'''
+
+    values = {
+        name: {key: value for key, value in fields.items() if key not in ("timestamp", "age")}
+        for name, fields in snapshot.items() if isinstance(fields, dict)
+    }
+
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode()).hexdigest()
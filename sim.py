@@ -0,0 +1,483 @@
+'''Simulated hardware for running the server off the Pi, selected with GROWROOM_BACKEND=sim.
+Every device class in devices.py runs unchanged on top of these stand-ins, so timings measured here include the real device code.'''
+
+import atexit
+import math
+import os
+import random
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+# w1thermsensor tries to load the w1 kernel modules on import, which fails off the Pi
+os.environ.setdefault("W1THERMSENSOR_NO_KERNEL_MODULE", "1")
+
+from gpiozero import Device
+from gpiozero.pins.mock import MockFactory
+from w1thermsensor import W1ThermSensor
+
+from devices import Camera, DHT22, DS18B20Bus, ADS1115, LevelSensor
+
+
+def wave(base, amplitude=0.0, period=86400.0, noise=0.0, rng=random):
+    '''Returns a signal of wall-clock time: "base" plus a sine of "amplitude" and "period" seconds, plus gaussian "noise".'''
+
+    def signal(t):
+        return base + amplitude * math.sin(2 * math.pi * t / period) + rng.gauss(0.0, noise)
+
+    return signal
+
+
+class SimSMBus:
+    '''SMBus stand-in with the ADS1115's register semantics.
+    Writing CONFIG with the OS bit set starts a single-shot conversion that takes one data rate period, skewed by the oscillator "clock_error".
+    CONFIG reads back the OS bit as 0 while converting, and CONVERT holds the last finished conversion scaled to the programmed PGA range.
+    Continuous mode converts back to back. Every transfer blocks for its time on the wire at "bus_speed" Hz, and unknown addresses raise OSError like a NACK.'''
+
+    DATA_RATES = [8, 16, 32, 64, 128, 250, 475, 860]
+
+    # full scale volts for PGA bits 11:9, the last codes all mean 0.256V
+    RANGES = [6.144, 4.096, 2.048, 1.024, 0.512, 0.256, 0.256, 0.256]
+
+    # inputs measured by MUX bits 14:12, as (positive, negative) channels, None is ground
+    MUX = [(0, 1), (0, 3), (1, 3), (2, 3), (0, None), (1, None), (2, None), (3, None)]
+
+    def __init__(self, inputs: dict = None, addresses=(0x48, 0x49), bus_speed=100000, clock_error=0.0):
+        '''"inputs" maps (address, channel) to functions of time returning volts, unlisted channels read 0V.'''
+
+        self.inputs = dict(inputs or {})
+        self.bus_speed = bus_speed
+        self.clock_error = clock_error
+        self.lock = threading.Lock()
+        self.transactions = 0
+
+        # per address: CONFIG register, CONVERT register, and when the running conversion started
+        self.config = {address: 0x8583 for address in addresses}
+        self.result = {address: 0 for address in addresses}
+        self.started = {address: None for address in addresses}
+
+    def _wire(self, nbytes):
+
+        # 9 clocks per byte plus start and stop
+        time.sleep((nbytes * 9 + 2) / self.bus_speed)
+
+    def _device(self, address):
+
+        if address not in self.config:
+            raise OSError(121, "Remote I/O error")
+
+        self.transactions += 1
+
+    def _period(self, config):
+        return 1.0 / (self.DATA_RATES[(config >> 5) & 0x07] * (1.0 + self.clock_error))
+
+    def _sample(self, address, config):
+
+        positive, negative = self.MUX[(config >> 12) & 0x07]
+        volts = self.inputs.get((address, positive), lambda t: 0.0)(time.time())
+
+        if negative is not None:
+            volts -= self.inputs.get((address, negative), lambda t: 0.0)(time.time())
+
+        full_scale = self.RANGES[(config >> 9) & 0x07]
+
+        return max(-32768, min(32767, int(volts / full_scale * 32768)))
+
+    def _update(self, address):
+        '''Finishes the running conversion if its period has passed.'''
+
+        config = self.config[address]
+        started = self.started[address]
+
+        if started is None:
+            return
+
+        period = self._period(config)
+        elapsed = time.monotonic() - started
+
+        if elapsed < period:
+            return
+
+        self.result[address] = self._sample(address, config)
+
+        if config & 0x0100:
+            # single-shot: power down and report done
+            self.started[address] = None
+            self.config[address] = config | 0x8000
+        else:
+            # continuous: the next conversion started when this one ended
+            self.started[address] = started + elapsed // period * period
+
+    def write_i2c_block_data(self, address, register, data):
+
+        self._wire(2 + len(data))
+
+        with self.lock:
+            self._device(address)
+
+            if register != 0x01:
+                return
+
+            config = data[0] << 8 | data[1]
+            self._update(address)
+
+            if config & 0x0100:
+                if config & 0x8000:
+                    self.started[address] = time.monotonic()
+                    config &= 0x7FFF
+            else:
+                self.started[address] = time.monotonic()
+
+            self.config[address] = config
+
+    def read_i2c_block_data(self, address, register, length):
+
+        self._wire(3 + length)
+
+        with self.lock:
+            self._device(address)
+            self._update(address)
+
+            if register == 0x01:
+                value = self.config[address]
+            else:
+                value = self.result[address] & 0xFFFF
+
+        return [value >> 8, value & 0xFF][:length]
+
+
+class SimW1:
+    '''Fake 1-Wire sysfs tree of DS18B20 probes, with the files W1ThermSensor and the bulk read use.
+    A thread rewrites every probe's readings every "interval" seconds. Reads are plain file reads, so they don't wait out a conversion like the kernel does.'''
+
+    def __init__(self, probes: dict, root=None, interval=2.0):
+        '''"probes" maps probe ids like "28-0000000000a1" to functions of time returning degrees Celsius.'''
+
+        self.probes = probes
+        self.interval = interval
+        self.root = root or tempfile.mkdtemp(prefix="growroom-w1-")
+
+        os.makedirs(os.path.join(self.root, "w1_bus_master1"), exist_ok=True)
+
+        with open(os.path.join(self.root, "w1_bus_master1", "therm_bulk_read"), "w") as file:
+            file.write("0\n")
+
+        for probe in probes:
+            os.makedirs(os.path.join(self.root, probe), exist_ok=True)
+
+        self.update()
+
+        if root is None:
+            atexit.register(shutil.rmtree, self.root, True)
+
+        threading.Thread(target=self.run, name="sim-w1", daemon=True).start()
+
+    def _write(self, path, text):
+
+        # replaced whole so a reader never sees a half-written file
+        with open(path + ".tmp", "w") as file:
+            file.write(text)
+
+        os.replace(path + ".tmp", path)
+
+    def update(self):
+
+        now = time.time()
+
+        for probe, signal in self.probes.items():
+            millidegrees = int(round(signal(now) * 1000))
+            raw = millidegrees * 16 // 1000 & 0xFFFF
+            scratchpad = "%02x %02x 4b 46 7f ff 0c 10 1c" % (raw & 0xFF, raw >> 8)
+
+            self._write(os.path.join(self.root, probe, "w1_slave"),
+                        "%s : crc=1c YES\n%s t=%d\n" % (scratchpad, scratchpad, millidegrees))
+            self._write(os.path.join(self.root, probe, "temperature"), "%d\n" % millidegrees)
+
+    def run(self):
+
+        while True:
+            time.sleep(self.interval)
+            self.update()
+
+
+class SimDHT22:
+    '''Stand-in for adafruit_dht.DHT22. A measurement blocks for "latency" seconds and fails with RuntimeError at "failure_rate",
+    and like the real driver, values are cached for 2 seconds between measurements.'''
+
+    def __init__(self, humidity, temperature, latency=0.025, failure_rate=0.1, rng=random):
+
+        self.humidity_signal = humidity
+        self.temperature_signal = temperature
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = rng
+        self.measured = None
+        self.values = (None, None)
+
+    def measure(self):
+
+        if self.measured is not None and time.monotonic() - self.measured < 2.0:
+            return
+
+        self.measured = time.monotonic()
+        time.sleep(self.latency)
+
+        if self.random.random() < self.failure_rate:
+            raise RuntimeError("Checksum did not validate. Try again.")
+
+        now = time.time()
+        self.values = (round(self.humidity_signal(now), 1), round(self.temperature_signal(now), 1))
+
+    @property
+    def humidity(self):
+        self.measure()
+        return self.values[0]
+
+    @property
+    def temperature(self):
+        self.measure()
+        return self.values[1]
+
+    def exit(self):
+        pass
+
+
+class _Bits:
+    '''Bit writer for JPEG entropy coded data, with 0xFF byte stuffing.'''
+
+    def __init__(self):
+
+        self.data = bytearray()
+        self.value = 0
+        self.length = 0
+
+    def write(self, value, length):
+
+        self.value = self.value << length | value & ((1 << length) - 1)
+        self.length += length
+
+        while self.length >= 8:
+            self.length -= 8
+            byte = self.value >> self.length & 0xFF
+            self.data.append(byte)
+
+            if byte == 0xFF:
+                self.data.append(0x00)
+
+        self.value &= (1 << self.length) - 1
+
+    def flush(self):
+
+        # pad the last byte with ones
+        if self.length:
+            self.write((1 << (8 - self.length)) - 1, 8 - self.length)
+
+        return bytes(self.data)
+
+
+def _segment(marker, payload):
+    return struct.pack(">BBH", 0xFF, marker, len(payload) + 2) + payload
+
+
+# standard luminance DC table (ITU T.81 K.3): code counts per length, then categories 0-11
+DC_BITS = [0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0]
+DC_CODES = []
+
+_code = 0
+for _length, _count in enumerate(DC_BITS, 1):
+    for _ in range(_count):
+        DC_CODES.append((_code, _length))
+        _code += 1
+    _code <<= 1
+
+
+def synthetic_jpeg(width, height, phase=0.0, size=None, label=b""):
+    '''Encodes a valid baseline greyscale JPEG of a scrolling sine pattern, flat within each 8x8 block so only DC coefficients are coded.
+    Comment segments pad the file to about "size" bytes, so frames weigh what real camera frames do.'''
+
+    columns, rows = (width + 7) // 8, (height + 7) // 8
+    levels = [int(100 * math.sin(2 * math.pi * (column / columns + phase))) for column in range(columns)]
+
+    bits = _Bits()
+    previous = 0
+
+    for row in range(rows):
+        for column in range(columns):
+            # a flat block's DC coefficient is 8 times its level shifted mean, quantized by 8
+            level = levels[column] + (16 if (row // 4 + column // 4) % 2 else 0)
+            diff = level - previous
+            previous = level
+
+            category = abs(diff).bit_length()
+            code, length = DC_CODES[category]
+            bits.write(code, length)
+
+            if category:
+                bits.write(diff if diff > 0 else diff + (1 << category) - 1, category)
+
+            # end of block, the only AC symbol
+            bits.write(0, 1)
+
+    header = [
+        b"\xff\xd8",
+        _segment(0xE0, b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"),
+        _segment(0xDB, b"\x00" + b"\x08" * 64),
+        _segment(0xC0, struct.pack(">BHHBBBB", 8, height, width, 1, 1, 0x11, 0)),
+        _segment(0xC4, b"\x00" + bytes(DC_BITS) + bytes(range(12))),
+        _segment(0xC4, b"\x10" + bytes([1] + [0] * 15) + b"\x00"),
+    ]
+
+    body = [_segment(0xDA, b"\x01\x01\x00\x00\x3f\x00"), bits.flush(), b"\xff\xd9"]
+
+    if label:
+        header.append(_segment(0xFE, label))
+
+    padding = (size or 0) - sum(len(part) for part in header + body)
+
+    while padding > 4:
+        chunk = min(padding - 4, 65533)
+        header.append(_segment(0xFE, b"\x00" * chunk))
+        padding -= chunk + 4
+
+    return b"".join(header + body)
+
+
+class SimJpegEncoder:
+    '''Stands in for picamera2.encoders.JpegEncoder, only carrying the quality.'''
+
+    def __init__(self, q=50):
+
+        self.q = q
+        self.running = False
+
+
+class SimPicamera2:
+    '''Stand-in for Picamera2 emitting synthetic JPEG frames at "framerate" from one thread per running encoder.
+    A few frames per stream and quality are encoded up front and cycled, so the simulation itself costs next to no CPU.'''
+
+    def __init__(self, framerate=30.0, frames=30):
+
+        self.framerate = framerate
+        self.frames = frames
+        self.options = {"quality": 90}
+        self.started = False
+        self.streams = {}
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def create_video_configuration(self, **streams):
+        return streams
+
+    def configure(self, config):
+        self.streams = {name: stream["size"] for name, stream in config.items()}
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.started = False
+
+    def sequence(self, name, quality):
+        '''Returns the cycled frames of stream "name" at "quality", about as heavy as real frames at that quality.'''
+
+        with self.lock:
+            key = (name, quality)
+
+            if key not in self.cache:
+                width, height = self.streams[name]
+                size = int(width * height * (0.02 + 0.0025 * quality))
+
+                self.cache[key] = [
+                    synthetic_jpeg(width, height, index / self.frames, size, b"frame %d" % index)
+                    for index in range(self.frames)
+                ]
+
+            return self.cache[key]
+
+    def start_encoder(self, encoder, output, name="main"):
+
+        frames = self.sequence(name, encoder.q)
+        encoder.running = True
+
+        def run():
+            deadline = time.monotonic()
+            index = 0
+
+            while encoder.running:
+                output.write(frames[index % len(frames)])
+                index += 1
+
+                deadline += 1.0 / self.framerate
+                time.sleep(max(0.0, deadline - time.monotonic()))
+
+        threading.Thread(target=run, name="sim-camera-" + name, daemon=True).start()
+
+    def stop_encoder(self, encoders):
+
+        for encoder in encoders:
+            encoder.running = False
+
+    def capture_file(self, file, name="main", format="jpeg"):
+
+        frames = self.sequence(name, self.options["quality"])
+        file.write(frames[int(time.time() * self.framerate) % len(frames)])
+
+
+class Hardware:
+    '''Builds the devices.py classes on simulated hardware. GPIO goes through gpiozero's MockFactory, which becomes the default pin factory,
+    so relays and every other gpiozero device created afterwards use mock pins too.'''
+
+    def __init__(self, seed=None, w1_root=None):
+
+        self.random = random.Random(seed)
+        rng = self.random
+
+        self.pin_factory = MockFactory()
+        Device.pin_factory = self.pin_factory
+
+        # TDS probe on AIN1 of the first ADS1115, about 0.9V with a slow daily swing
+        self.smbus = SimSMBus({
+            (0x48, 1): wave(0.9, 0.05, 86400.0, 0.002, rng),
+        }, clock_error=rng.uniform(-0.05, 0.05))
+
+        self.w1 = SimW1({
+            "28-00000000a1f0": wave(21.0, 1.5, 86400.0, 0.05, rng),
+            "28-00000000b2e1": wave(20.5, 1.5, 86400.0, 0.05, rng),
+        }, w1_root)
+        W1ThermSensor.BASE_DIRECTORY = Path(self.w1.root)
+
+    def camera(self, **kwargs):
+        return Camera(module=SimPicamera2(), encoder=SimJpegEncoder, file_output=lambda output: output, **kwargs)
+
+    def dht22(self, dataPin, powerPin=None):
+
+        device = SimDHT22(wave(55.0, 8.0, 86400.0, 0.5, self.random),
+                          wave(24.0, 3.0, 86400.0, 0.1, self.random),
+                          rng=self.random)
+
+        return DHT22(dataPin, powerPin, device=device)
+
+    def ds18b20(self, **kwargs):
+        return DS18B20Bus(**kwargs)
+
+    def ads1115(self, **kwargs):
+        return ADS1115(bus=self.smbus, **kwargs)
+
+    def level_sensor(self, pin, high=True, **kwargs):
+
+        sensor = LevelSensor(pin, pin_factory=self.pin_factory, **kwargs)
+        self.set_level(pin, high)
+
+        # start at the simulated level instead of reporting it as the first edge
+        sensor.value = sensor.device.value
+
+        return sensor
+
+    def set_level(self, pin, high):
+        '''Drives the level sensor on "pin" like the water rising above or falling below it.'''
+
+        pin = self.pin_factory.pin(pin)
+        pin.drive_high() if high else pin.drive_low()
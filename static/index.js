@@ -18,6 +18,16 @@ async function LLPK1() {
 	return await request.json();
 }
 
+/**
+ * Gets every sensor value and relay state in one request. The browser revalidates with the ETag, so unchanged polls are a 304.
+ * @returns {Promise<any>}
+ */
+async function sensors() {
+	let request = await fetch("/sensors");
+
+	return await request.json();
+}
+
 /**
  * Gets data about a given loop. Toggle the execution of the loop with the "loop_state" parameter.
  * @param {boolean | null} loop_state Toggles loop execution depending on the given "loop_state". For example, if loop_state == true, then GET /loop?execution=stop
@@ -67,7 +77,8 @@ var airTemp = document.getElementById("air-temp"),
 	refresh = document.getElementById("refresh"),
 	refreshToggle = document.getElementById("refresh-toggle"),
 	refreshInterval = document.getElementById("refresh-interval"),
-	globalInterval;
+	globalInterval,
+	eventSource;
 
 //! event handlers
 function refreshRelay(id) {
@@ -75,40 +86,88 @@ function refreshRelay(id) {
 
 	loop(row.id).then((response) => {
 		row.querySelector(".loop-state").innerText = response.loop_state;
-		row.querySelector(".timeOn").value = response.loop_info.kwargs.timeOn;
-		row.querySelector(".timeOff").value = response.loop_info.kwargs.timeOff;
+
+		if (response.loop_info && response.loop_info.schedule.type === "cycle") {
+			row.querySelector(".timeOn").value = response.loop_info.schedule.timeOn;
+			row.querySelector(".timeOff").value = response.loop_info.schedule.timeOff;
+		}
 	});
 
 	return true;
 }
 
+function showDHT22(data) {
+	airTemp.innerText = data.temperature + "° C";
+	airHumidity.innerText = data.humidity + "%";
+}
+
+function showDS18B20(data) {
+	waterTemp.innerText = data.temperature + "° C";
+}
+
+function showLLPK1(data) {
+	waterLevel.innerText = !data.state;
+}
+
+function showLoop(id, data) {
+	let row = document.getElementById(id);
+
+	if (row) {
+		row.querySelector(".loop-state").innerText = data.loop_state;
+
+		if (data.loop_info && data.loop_info.schedule.type === "cycle") {
+			row.querySelector(".timeOn").value = data.loop_info.schedule.timeOn;
+			row.querySelector(".timeOff").value = data.loop_info.schedule.timeOff;
+		}
+	}
+}
+
 function refreshAll() {
-	DHT22().then((response) => {
-		airTemp.innerText = response.temperature + "° C";
-		airHumidity.innerText = response.humidity + "%";
-	});
+	sensors().then((response) => {
+		showDHT22(response.DHT22);
+		showDS18B20(response.DS18B20);
+		showLLPK1(response.LLPK1);
 
-	DS18B20().then((response) => {
-		waterTemp.innerText = response.temperature + "° C";
+		for (let [id, relay] of Object.entries(response.relays)) {
+			showLoop(id, relay);
+		}
 	});
+}
 
-	LLPK1().then((response) => {
-		waterLevel.innerText = !response.state;
+/**
+ * Opens the /events push channel. The server sends the latest value of every topic on connect, then each change as it happens.
+ * @returns {EventSource}
+ */
+function liveUpdates() {
+	let source = new EventSource("/events");
+
+	source.addEventListener("DHT22", (event) => showDHT22(JSON.parse(event.data)));
+	source.addEventListener("DS18B20", (event) => showDS18B20(JSON.parse(event.data)));
+	source.addEventListener("LLPK1", (event) => showLLPK1(JSON.parse(event.data)));
+	source.addEventListener("loop", (event) => {
+		let data = JSON.parse(event.data);
+		showLoop(data.id, data);
 	});
 
-	for (let row of relayTable.getElementsByTagName("tr")) {
-		row.id && refreshRelay(row.id) && console.log("Refreshed " + row.id);
-	}
+	return source;
 }
 
 function autoRefresh() {
 	if (refreshToggle.checked) {
-		let desiredInterval = Number(refreshInterval.value);
-
 		refreshAll();
-		globalInterval = setInterval(refreshAll, desiredInterval * 1000);
+
+		// push updates when the browser supports them, otherwise poll
+		if (window.EventSource) {
+			eventSource = liveUpdates();
+		} else {
+			let desiredInterval = Number(refreshInterval.value);
+
+			globalInterval = setInterval(refreshAll, desiredInterval * 1000);
+		}
 	} else {
 		clearInterval(globalInterval);
+		eventSource && eventSource.close();
+		eventSource = null;
 	}
 }
 
@@ -1,42 +1,47 @@
 import asyncio
-from gpiozero import OutputDevice
-from gpiozero.pins import mock
 
-from devices import ADS1115
+from controllers import Controller, Signals, make_rule
+from devices import ADS1115, DeviceRegistry
 
+# devices shared with the running application by name, so persisted task kwargs only need to hold the name
+devices = DeviceRegistry()
 
-async def power_loop(relay_pin=None, timeOn=60, timeOff=60, id=""):
-    '''Infinite loop that turns a relay on and off at the provided intervals'''
+# sensor signals controllers follow by name, fed by the application
+signals = Signals()
 
-    if relay_pin != None:
-        relay = OutputDevice(relay_pin)
-    else:
-        relay = OutputDevice(1, pin_factory=mock.MockFactory())
+# the RelayScheduler controllers switch relays through, set by the application
+scheduler = None
 
-    try:
-        while True:
+# relay id -> Controller of every running controller
+controllers = {}
 
-            relay.on()
-            print(id + " on")
 
-            await asyncio.sleep(int(timeOn))
+async def run_tds(device="ADS1115"):
+    '''Samples the TDS probe on the ADS1115 registered under "device" until cancelled'''
 
-            relay.off()
-            print(id + " off")
+    ads1115 = devices.get(device)
 
-            await asyncio.sleep(int(timeOff))
+    if not isinstance(ads1115, ADS1115):
+        raise ValueError("No ADS1115 registered as %s" % device)
 
+    try:
+        print("TDS sensor active")
+        await ads1115.runTds()
     except asyncio.CancelledError:
-        print(id + " loop cancelled")
-        relay.off()
-
-
-async def run_tds(ads1115: ADS1115):
-    if(hasattr(ads1115, "interpVoltage") and callable(getattr(ads1115, "interpVoltage"))):
-        try:
-            print("TDS sensor active")
-            ads1115.interpVoltage()
-        except asyncio.CancelledError:
-            print("TDS sensor inactive")
-    else:
-        raise ValueError("Given object is missing method %s", ads1115)
+        print("TDS sensor inactive")
+
+
+async def run_controller(relay, signal, mode="hysteresis", min_on=60, min_off=60, max_age=600, **settings):
+    '''Drives "relay" from sensor signal "signal" with a "hysteresis" or "pid" rule built from "settings" until cancelled'''
+
+    if scheduler is None:
+        raise ValueError("No scheduler to drive %s through" % relay)
+
+    controller = Controller(relay, signals[signal], make_rule(mode, **settings), scheduler, min_on, min_off, max_age)
+    controllers[relay] = controller
+
+    try:
+        await controller.run()
+    finally:
+        if controllers.get(relay) is controller:
+            del controllers[relay]
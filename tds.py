@@ -0,0 +1,214 @@
+import threading
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from filters import RingBuffer
+from persistence import Journal
+from rollups import load, RAW_DTYPE
+
+
+# the probe's cubic curve, ppm for a compensated voltage in volts, highest power first
+CURVE = (133.42, -255.86, 857.39, 0.0)
+TDS_FACTOR = 0.5
+
+# ADS1115 samples are millivolts, the curve takes volts
+SCALE = 1.0 / 1000.0
+
+# readings are compensated to the conductivity they would have at this water temperature
+REFERENCE_TEMPERATURE = 25.0
+
+# rows of the sliding window view medianed at once, bounding the temporary copy np.median makes
+CHUNK = 65536
+
+
+def median_filter(samples, window, history=None):
+    '''Trailing median of every sample over itself and the "window" - 1 samples before it.
+    "history" holds the samples preceding the block, so consecutive blocks filter like one continuous stream. Without it the first sample is repeated.'''
+
+    samples = np.asarray(samples, dtype=float)
+
+    if window <= 1 or len(samples) == 0:
+        return samples.copy()
+
+    history = np.asarray(() if history is None else history, dtype=float)[-(window - 1):]
+
+    first = history[0] if len(history) else samples[0]
+    padded = np.concatenate((np.full(window - 1 - len(history), first), history, samples))
+    windows = sliding_window_view(padded, window)
+
+    return np.concatenate([np.median(windows[start:start + CHUNK], axis=1) for start in range(0, len(windows), CHUNK)])
+
+
+def compensate(voltage, temperature, coefficient=0.02):
+    '''Voltage the probe would read at the reference temperature, conductivity rising by "coefficient" per degree.'''
+
+    return voltage / (1.0 + coefficient * (temperature - REFERENCE_TEMPERATURE))
+
+
+def align(times, temperature_times, temperatures, default=REFERENCE_TEMPERATURE):
+    '''Returns the water temperature at each of "times", interpolated between readings and held past the first and last one.
+    Without any readings every sample is taken to be at "default".'''
+
+    if len(temperature_times) == 0:
+        return np.full(len(times), float(default))
+
+    return np.interp(times, temperature_times, temperatures)
+
+
+class Calibration:
+    '''Calibration of one TDS probe. "k" scales the curve, "points" are (measured, reference) ppm pairs taken in standard solutions:
+    readings are corrected by the reference/measured ratio, interpolated between the points and held beyond them.
+    "temperature_probe" is the id of the DS18B20 in the same water, None for the first probe on the bus.'''
+
+    def __init__(self, k=1.0, points=(), temperature_probe=None, coefficient=0.02):
+
+        self.k = float(k)
+        self.points = sorted((float(measured), float(reference)) for measured, reference in points)
+        self.temperature_probe = temperature_probe
+        self.coefficient = float(coefficient)
+
+        if self.k <= 0 or any(measured <= 0 or reference <= 0 for measured, reference in self.points):
+            raise ValueError("Calibration values must be positive")
+
+    def apply(self, tds):
+        '''Corrects uncalibrated ppm values.'''
+
+        tds = tds * self.k
+
+        if self.points:
+            measured, reference = np.array(self.points).T
+            tds = tds * np.interp(tds, measured, reference / measured)
+
+        return tds
+
+    def to_dict(self):
+        return {"k": self.k, "points": self.points, "temperature_probe": self.temperature_probe, "coefficient": self.coefficient}
+
+
+def tds(voltage, temperature, calibration: Calibration):
+    '''TDS in ppm of filtered probe voltages at the given water temperatures, all arrays of the same length.'''
+
+    compensated = compensate(voltage, temperature, calibration.coefficient)
+
+    return calibration.apply(np.polyval(CURVE, compensated) * TDS_FACTOR)
+
+
+class TdsPipeline:
+    '''Turns blocks of raw ADS1115 samples into temperature compensated TDS as whole-array operations:
+    median filter, scaling to volts, compensation with time-aligned DS18B20 temperatures, then the probe's curve and calibration.
+    Calibrations are persisted per TDS probe through a Journal when "filename" is given.'''
+
+    def __init__(self, filename=None, window=30, temperature_capacity=256):
+
+        self.journal = Journal(filename + ".journal") if filename else None
+        self.window = window
+        self.temperature_capacity = temperature_capacity
+        self.lock = threading.Lock()
+
+        self.calibrations = {
+            probe: Calibration(**info) for probe, info in (self.journal.state.items() if self.journal else ())
+        }
+
+        # last window - 1 raw samples of every TDS probe, carried over into its next block
+        self.tails = {}
+
+        # DS18B20 id -> (timestamps, temperatures) of its recent readings
+        self.temperatures = {}
+
+    def calibration(self, probe) -> Calibration:
+        return self.calibrations.get(probe) or Calibration()
+
+    def set_calibration(self, probe, calibration: Calibration):
+        '''Replaces the calibration of TDS probe "probe". History isn't touched, see recompute().'''
+
+        self.calibrations[probe] = calibration
+
+        if self.journal is not None:
+            self.journal.set(probe, calibration.to_dict())
+
+    def add_temperatures(self, reading):
+        '''DS18B20 bus sampler listener: keeps the reading of every probe for aligning samples with.'''
+
+        if reading is None or not reading.value:
+            return
+
+        with self.lock:
+            for probe, temperature in reading.value.items():
+                if probe not in self.temperatures:
+                    self.temperatures[probe] = (RingBuffer(self.temperature_capacity), RingBuffer(self.temperature_capacity))
+
+                times, values = self.temperatures[probe]
+
+                # skip a reading that was already added
+                if times.last() is None or reading.timestamp > times.last():
+                    times.append(reading.timestamp)
+                    values.append(temperature)
+
+    def temperature_history(self, probe=None):
+        '''Returns the (timestamps, temperatures) arrays of DS18B20 "probe", the first probe by id if None.'''
+
+        with self.lock:
+            if probe is None and self.temperatures:
+                probe = min(self.temperatures)
+
+            if probe not in self.temperatures:
+                return np.empty(0), np.empty(0)
+
+            times, values = self.temperatures[probe]
+
+            return np.array(times.values()), np.array(values.values())
+
+    def process(self, probe, times, samples):
+        '''Processes one block of raw samples in millivolts of TDS probe "probe", taken at the wall-clock "times".
+        Returns a dict of arrays: "t", "voltage" (filtered, in volts), "temperature" and "tds" in ppm.'''
+
+        times = np.asarray(times, dtype=float)
+        samples = np.asarray(samples, dtype=float)
+        calibration = self.calibration(probe)
+
+        with self.lock:
+            tail = self.tails.get(probe)
+            filtered = median_filter(samples, self.window, tail)
+            history = np.concatenate((tail if tail is not None else np.empty(0), samples))
+            self.tails[probe] = history[max(0, len(history) - self.window + 1):]
+
+        voltage = filtered * SCALE
+        temperature = align(times, *self.temperature_history(calibration.temperature_probe))
+
+        return {"t": times, "voltage": voltage, "temperature": temperature, "tds": tds(voltage, temperature, calibration)}
+
+
+def recompute(pipeline: TdsPipeline, store, probe, voltage_metric="ads1115.voltage", tds_metric="ads1115.tds", start=None, end=None):
+    '''Recomputes the stored "tds_metric" of TDS probe "probe" with its current calibration, from the filtered voltages and DS18B20
+    temperatures in the history "store", and rewrites it in place. Rollups of the metric have to be rebuilt afterwards.
+    Returns the number of samples rewritten.'''
+
+    start = float("-inf") if start is None else start
+    end = float("inf") if end is None else end
+
+    if voltage_metric not in store.series:
+        return 0
+
+    calibration = pipeline.calibration(probe)
+    voltage = load(store.get(voltage_metric), RAW_DTYPE, start, end)
+
+    # history keeps the first probe as "ds18b20.temperature" and every probe under its id
+    temperature_metric = "ds18b20." + (calibration.temperature_probe or "temperature")
+
+    if temperature_metric in store.series and len(voltage):
+        # readings just outside the range still bound its first and last samples
+        margin = 3600.0
+        temperature = load(store.get(temperature_metric), RAW_DTYPE, voltage["t"][0] - margin, voltage["t"][-1] + margin)
+    else:
+        temperature = np.empty(0, RAW_DTYPE)
+
+    # segments keep samples in arrival order, the rewrite needs them in time order
+    voltage = voltage[np.argsort(voltage["t"], kind="stable")]
+
+    records = np.empty(len(voltage), RAW_DTYPE)
+    records["t"] = voltage["t"]
+    records["value"] = tds(voltage["value"], align(voltage["t"], temperature["t"], temperature["value"]), calibration)
+
+    store.replace(tds_metric, records.tobytes(), start, end)
+
+    return len(records)
@@ -0,0 +1,53 @@
+import threading
+import time
+import unittest
+
+from arbiter import BusArbiter, SAFETY, DASHBOARD
+
+
+class ArbiterTest(unittest.TestCase):
+
+    def test_safety_preempts_queued_dashboard(self):
+
+        arbiter = BusArbiter("test")
+        order = []
+        holding = threading.Event()
+        release = threading.Event()
+
+        def hold(name, priority):
+            with arbiter.hold_sync(priority, timeout=5.0):
+                order.append(name)
+
+        def owner():
+            with arbiter.hold_sync(DASHBOARD):
+                holding.set()
+                release.wait(5.0)
+
+        threads = [threading.Thread(target=owner)]
+        threads[0].start()
+        holding.wait(5.0)
+
+        # dashboard reads queue up first, then a safety read arrives behind them
+        for index in range(3):
+            threads.append(threading.Thread(target=hold, args=("dashboard%d" % index, DASHBOARD)))
+            threads[-1].start()
+
+        while arbiter.stats()["depth"] < 3:
+            time.sleep(0.001)
+
+        threads.append(threading.Thread(target=hold, args=("safety", SAFETY)))
+        threads[-1].start()
+
+        while arbiter.stats()["depth"] < 4:
+            time.sleep(0.001)
+
+        release.set()
+
+        for thread in threads:
+            thread.join(5.0)
+
+        self.assertEqual(order, ["safety", "dashboard0", "dashboard1", "dashboard2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
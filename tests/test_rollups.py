@@ -0,0 +1,44 @@
+import shutil
+import tempfile
+import unittest
+
+from rollups import Rollups
+from timeseries import TimeSeriesStore
+
+
+class RollupQueryTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.root = tempfile.mkdtemp()
+        self.store = TimeSeriesStore(self.root)
+        self.rollups = Rollups(self.store, tiers=(60, ))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_first_sample_counted_once(self):
+
+        for i in range(5):
+            self.store.append("x", i, 6000.0 + i)
+
+        _, buckets = self.rollups.query("x", 6000.0, 6060.0, 60)
+
+        self.assertEqual(buckets["count"].tolist(), [5.0])
+
+    def test_start_inside_open_bucket(self):
+
+        # one closed bucket, and an open one from 6060 on
+        for t in (6000.0, 6010.0, 6065.0, 6070.0):
+            self.store.append("x", t - 6000.0, t)
+
+        tier, buckets = self.rollups.query("x", 6066.0, 6120.0, 60)
+
+        self.assertEqual(tier, 60)
+        self.assertEqual(buckets["t"].tolist(), [6060.0])
+        self.assertEqual(buckets["count"].tolist(), [2.0])
+        self.assertEqual(buckets["last"].tolist(), [70.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import sim
+from devices import ADS1115, ADS1115Scanner
+
+
+class RecordingBus(sim.SimSMBus):
+    '''SimSMBus remembering the (address, channel) of every CONFIG write.'''
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+        self.selected = []
+
+    def write_i2c_block_data(self, address, register, data):
+
+        if register == 0x01:
+            self.selected.append((address, (data[0] >> 4) & 0x03))
+
+        return super().write_i2c_block_data(address, register, data)
+
+
+def scan(scanner, steps):
+    '''Runs "scanner" until it has made "steps" steps.'''
+
+    async def run():
+
+        task = asyncio.ensure_future(scanner.run())
+
+        while scanner.steps < steps:
+            await asyncio.wait((task, ), timeout=0.001)
+
+        task.cancel()
+
+    asyncio.run(run())
+
+
+class ScannerTest(unittest.TestCase):
+
+    def test_round_robin(self):
+
+        bus = RecordingBus()
+        scanner = ADS1115Scanner(ADS1115(bus=bus), sps=860)
+
+        scan(scanner, 8)
+
+        expected = [(address, step % 4) for step in range(8) for address in (0x48, 0x49)]
+        self.assertEqual(bus.selected[:16], expected)
+
+    def test_waits_one_conversion_period(self):
+
+        original = asyncio.sleep
+
+        for rate, name in ADS1115.Data_Rates.items():
+            with self.subTest(rate=name):
+                waits = []
+
+                async def sleep(delay, *args, **kwargs):
+                    waits.append(delay)
+                    await original(0)
+
+                scanner = ADS1115Scanner(ADS1115(bus=sim.SimSMBus()), sps=rate)
+
+                with mock.patch("devices.asyncio.sleep", sleep):
+                    scan(scanner, 4)
+
+                self.assertEqual(scanner.rate, rate)
+                self.assertTrue(waits)
+                self.assertTrue(all(wait == ADS1115.conversionTime(rate) for wait in waits))
+
+    def test_samples_land_in_their_channel(self):
+
+        inputs = {(0x48, channel): (lambda t, volts=0.1 * (channel + 1): volts) for channel in range(4)}
+        scanner = ADS1115Scanner(ADS1115(bus=sim.SimSMBus(inputs)), sps=860)
+
+        scan(scanner, 8)
+
+        for channel in range(4):
+            self.assertAlmostEqual(scanner.latest(0x48, channel)[1], 100 * (channel + 1), delta=1)
+            self.assertEqual(scanner.latest(0x49, channel)[1], 0)
+
+    def test_missing_address_is_dropped(self):
+
+        scanner = ADS1115Scanner(ADS1115(bus=sim.SimSMBus(addresses=(0x48, ))), sps=860)
+
+        scan(scanner, 6)
+
+        self.assertEqual(list(scanner.channels), [0x48])
+
+
+if __name__ == "__main__":
+    unittest.main()
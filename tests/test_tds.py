@@ -0,0 +1,28 @@
+import unittest
+
+import numpy as np
+
+import sim  # noqa: F401, the simulated backend stands in for the kernel modules tds imports through persistence
+from tds import Calibration, TdsPipeline, tds
+
+
+class TdsTest(unittest.TestCase):
+
+    def test_known_voltage(self):
+
+        # 133.42 * 0.9^3 - 255.86 * 0.9^2 + 857.39 * 0.9, halved
+        expected = (133.42 * 0.729 - 255.86 * 0.81 + 857.39 * 0.9) * 0.5
+
+        self.assertAlmostEqual(float(tds(np.array([0.9]), np.array([25.0]), Calibration())[0]), expected, places=6)
+
+    def test_millivolt_samples(self):
+
+        pipeline = TdsPipeline(window=1)
+        result = pipeline.process("probe", [1.0, 2.0], [900.0, 900.0])
+
+        np.testing.assert_allclose(result["voltage"], [0.9, 0.9])
+        np.testing.assert_allclose(result["tds"], [330.8] * 2, atol=0.1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+import shutil
+import tempfile
+import unittest
+
+from timeseries import Series
+
+
+class SeriesReloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_rings_filled_from_newest_segments(self):
+
+        # spread over three segments of 100 seconds
+        series = Series(self.root, capacity=8, span=100)
+
+        for t in range(0, 300, 20):
+            series.append(float(t), t / 10.0)
+
+        series.flush()
+
+        times, values = Series(self.root, capacity=8, span=100).recent()
+
+        self.assertEqual(times.tolist(), [float(t) for t in range(140, 300, 20)])
+        self.assertEqual(values.tolist(), [t / 10.0 for t in range(140, 300, 20)])
+
+
+if __name__ == "__main__":
+    unittest.main()
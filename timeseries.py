@@ -0,0 +1,396 @@
+import asyncio
+import bisect
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+from filters import RingBuffer
+from runtime import runtime as default_runtime
+
+
+# one sample on disk: timestamp and value as little-endian doubles
+RECORD = struct.Struct("<dd")
+
+
+class Segment:
+    '''One append-only file of fixed-width records, all with timestamps in [start, start + span).
+    Reads go through a read-only memory map, so a query only pages in the part of the file it touches.'''
+
+    def __init__(self, path, start, record=RECORD):
+
+        self.path = path
+        self.start = start
+        self.record = record
+
+    def append(self, data):
+        '''Appends already packed records.'''
+
+        with open(self.path, "ab") as file:
+            file.write(data)
+
+    def size(self):
+
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def open(self):
+        '''Returns a read-only mmap of every complete record, or None if there are none.
+        A record torn by a crash mid-write is left out.'''
+
+        length = self.size() // self.record.size * self.record.size
+
+        if length == 0:
+            return None
+
+        with open(self.path, "rb") as file:
+            return mmap.mmap(file.fileno(), length, access=mmap.ACCESS_READ)
+
+    def read(self, start=None, end=None):
+        '''Yields the records with start <= timestamp < end, in order. Finds "start" with a binary search over the map.'''
+
+        view = self.open()
+
+        if view is None:
+            return
+
+        try:
+            timestamps = _Timestamps(view, self.record)
+            first = 0 if start is None else bisect.bisect_left(timestamps, start)
+            last = len(timestamps) if end is None else bisect.bisect_left(timestamps, end)
+
+            for index in range(first, last):
+                yield self.record.unpack_from(view, index * self.record.size)
+
+        finally:
+            view.close()
+
+    def tail(self, count):
+        '''Returns the newest "count" records, oldest first.'''
+
+        view = self.open()
+
+        if view is None:
+            return []
+
+        try:
+            length = len(view) // self.record.size
+            return [self.record.unpack_from(view, index * self.record.size) for index in range(max(0, length - count), length)]
+
+        finally:
+            view.close()
+
+
+class _Timestamps:
+    '''Sequence of the first field of every record in a buffer, for bisect.'''
+
+    def __init__(self, view, record):
+
+        self.view = view
+        self.record = record
+        self.length = len(view) // record.size
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        return struct.unpack_from("<d", self.view, index * self.record.size)[0]
+
+
+class Series:
+    '''One metric: its most recent samples in array-backed ring buffers, and its full history in time-rolled segments on disk.
+    New samples are buffered and written in batches by flush().'''
+
+    def __init__(self, directory, capacity=4096, span=86400, record=RECORD):
+
+        self.directory = directory
+        self.span = span
+        self.record = record
+        self.times = RingBuffer(capacity)
+        self.values = RingBuffer(capacity)
+        self.lock = threading.Lock()
+
+        # packed records waiting to be written, and the start of the segment they go to
+        self.buffer = bytearray()
+        self.buffer_start = None
+
+        os.makedirs(directory, exist_ok=True)
+
+        # samples recorded before a restart are still recent
+        self._reload()
+
+    def segment_start(self, timestamp):
+        return int(timestamp // self.span * self.span)
+
+    def segment(self, start):
+        return Segment(os.path.join(self.directory, "%d.seg" % start), start, self.record)
+
+    def segments(self):
+        '''Returns every Segment on disk, oldest first.'''
+
+        starts = []
+
+        for name in os.listdir(self.directory):
+            if name.endswith(".seg"):
+                starts.append(int(name[:-4]))
+
+        return [self.segment(start) for start in sorted(starts)]
+
+    def append(self, timestamp, *fields):
+        '''Adds a sample. The first field is kept in the in-memory rings as the sample value.'''
+
+        with self.lock:
+            self.times.append(timestamp)
+            self.values.append(fields[0])
+
+            # samples roll over into a new segment when they cross a span boundary
+            start = self.segment_start(timestamp)
+
+            if self.buffer and start != self.buffer_start:
+                self._flush()
+
+            self.buffer_start = start
+            self.buffer += self.record.pack(timestamp, *fields)
+
+    def last(self):
+        '''Returns the newest (timestamp, value), or None.'''
+
+        if len(self.times) == 0:
+            return None
+
+        return self.times.last(), self.values.last()
+
+    def flush(self):
+        '''Writes buffered samples to their segment.'''
+
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+
+        if self.buffer:
+            self.segment(self.buffer_start).append(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def recent(self):
+        '''Returns the in-memory (timestamps, values) arrays, oldest first.'''
+
+        with self.lock:
+            return self.times.values(), self.values.values()
+
+    def read(self, start=None, end=None):
+        '''Yields every record with start <= timestamp < end from disk and the write buffer, oldest first.'''
+
+        self.flush()
+
+        for segment in self.segments():
+            if end is not None and segment.start >= end:
+                break
+            if start is not None and segment.start + self.span <= start:
+                continue
+
+            yield from segment.read(start, end)
+
+    def replace(self, data, start=None, end=None):
+        '''Replaces every record with start <= timestamp < end by the packed, time ordered records "data", which must lie in that range.
+        Each affected segment is rewritten to a new file and swapped in, so readers holding a map of the old one are unaffected.'''
+
+        size = self.record.size
+        timestamps = _Timestamps(data, self.record)
+
+        if len(timestamps) and ((start is not None and timestamps[0] < start) or (end is not None and timestamps[len(timestamps) - 1] >= end)):
+            raise ValueError("Replacement records outside the replaced range")
+
+        # split the new records by the segment they belong to
+        pieces = {}
+        index = 0
+
+        while index < len(timestamps):
+            segment_start = self.segment_start(timestamps[index])
+            following = bisect.bisect_left(timestamps, segment_start + self.span, index)
+            pieces[segment_start] = data[index * size:following * size]
+            index = following
+
+        with self.lock:
+            self._flush()
+
+            affected = set(pieces)
+
+            for segment in self.segments():
+                if (end is None or segment.start < end) and (start is None or segment.start + self.span > start):
+                    affected.add(segment.start)
+
+            for segment_start in sorted(affected):
+                segment = self.segment(segment_start)
+                before = after = b""
+                view = segment.open()
+
+                if view is not None:
+                    old = _Timestamps(view, self.record)
+                    first = 0 if start is None else bisect.bisect_left(old, start)
+                    last = len(old) if end is None else bisect.bisect_left(old, end)
+                    before, after = view[:first * size], view[last * size:]
+                    view.close()
+
+                content = before + bytes(pieces.get(segment_start, b"")) + after
+
+                if not content:
+                    if view is not None:
+                        os.remove(segment.path)
+                    continue
+
+                with open(segment.path + ".tmp", "wb") as file:
+                    file.write(content)
+
+                os.replace(segment.path + ".tmp", segment.path)
+
+            # the rings hold the newest samples, reload them from the rewritten segments
+            self._reload()
+
+    def _reload(self):
+        '''Refills the rings from the tail of the newest segments, up to their capacity. Called with the lock held, or before the series is shared.'''
+
+        self.times.clear()
+        self.values.clear()
+        records = []
+
+        for segment in reversed(self.segments()):
+            records[:0] = segment.tail(self.times.capacity - len(records))
+
+            if len(records) >= self.times.capacity:
+                break
+
+        for timestamp, value, *_ in records:
+            self.times.append(timestamp)
+            self.values.append(value)
+
+    def retain(self, cutoff):
+        '''Deletes segments holding only samples older than "cutoff".'''
+
+        for segment in self.segments():
+            if segment.start + self.span <= cutoff:
+                os.remove(segment.path)
+
+
+class TimeSeriesStore:
+    '''Embedded time-series store with one Series per metric under "root".
+    Buffers are flushed every "flush_interval" seconds, so the SD card sees a few sequential writes instead of one per sample.
+    Segments span "span" seconds and are deleted once older than "retention" seconds.'''
+
+    # metric names double as directory names, "@" is reserved for derived series such as rollups
+    NAME = re.compile(r"^[A-Za-z0-9_.@-]+$")
+
+    def __init__(self, root, retention=180 * 86400, span=86400, capacity=4096, flush_interval=60.0, runtime=None):
+
+        self.root = root
+        self.retention = retention
+        self.span = span
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.runtime = runtime or default_runtime
+        self.series = {}
+        self.lock = threading.Lock()
+        self.task = None
+
+        # called with (name, timestamp, value) for every sample appended
+        self.listeners = []
+
+        os.makedirs(root, exist_ok=True)
+
+        # derived series have their own record formats, their owners open them
+        for name in os.listdir(root):
+            if os.path.isdir(os.path.join(root, name)) and self.NAME.match(name) and "@" not in name:
+                self.get(name)
+
+    def get(self, name, record=RECORD):
+        '''Returns the Series for metric "name", creating it if needed.'''
+
+        series = self.series.get(name)
+
+        if series is None:
+            if not self.NAME.match(name):
+                raise ValueError("Invalid metric name %s" % name)
+
+            with self.lock:
+                series = self.series.get(name)
+
+                if series is None:
+                    series = Series(os.path.join(self.root, name), self.capacity, self.span, record)
+                    self.series[name] = series
+
+        return series
+
+    def metrics(self):
+        '''Names of the sampled metrics, leaving out derived series.'''
+
+        return sorted(name for name in self.series if "@" not in name)
+
+    def append(self, name, value, timestamp=None):
+        '''Records one sample of metric "name". Safe to call from any thread.'''
+
+        timestamp = time.time() if timestamp is None else timestamp
+        value = float(value)
+
+        self.get(name).append(timestamp, value)
+
+        for listener in self.listeners:
+            listener(name, timestamp, value)
+
+    def last(self, name):
+        '''Returns the newest (timestamp, value) of metric "name", or None.'''
+
+        series = self.series.get(name)
+
+        return series.last() if series else None
+
+    def read(self, name, start=None, end=None):
+        '''Yields (timestamp, value) records of metric "name" with start <= timestamp < end, oldest first.'''
+
+        series = self.series.get(name)
+
+        if series is None:
+            return iter(())
+
+        return series.read(start, end)
+
+    def replace(self, name, data, start=None, end=None):
+        '''Replaces the samples of metric "name" with start <= timestamp < end by the packed, time ordered records "data",
+        e.g. after recomputing a derived metric. Listeners aren't called, rebuild anything kept from the metric's samples.'''
+
+        self.get(name).replace(data, start, end)
+
+    def flush(self):
+        '''Writes every buffered sample to disk.'''
+
+        for series in list(self.series.values()):
+            series.flush()
+
+    def retain(self):
+        '''Deletes segments older than the retention period.'''
+
+        cutoff = time.time() - self.retention
+
+        for series in list(self.series.values()):
+            series.retain(cutoff)
+
+    def start(self):
+        '''Starts the periodic flush and retention sweep. Call from a runtime startup hook.'''
+
+        if self.task is None:
+            self.task = self.runtime.spawn(self.run(), name="timeseries")
+
+    async def run(self):
+
+        loop = asyncio.get_running_loop()
+
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await loop.run_in_executor(None, self.flush)
+                await loop.run_in_executor(None, self.retain)
+        finally:
+            self.flush()
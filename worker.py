@@ -0,0 +1,376 @@
+'''HTTP worker of the production server, run as several processes under gunicorn next to one owner.py process.
+Sensor snapshots and camera frames are read from the owner's shared memory without touching hardware or the owner itself,
+everything else, like relay loop changes, history and exports, is forwarded to the owner over its Unix socket.
+Workers have to be restarted along with the owner, since a new owner creates a new shared memory segment.'''
+
+import http.client
+import json
+import os
+import socket
+import threading
+import time
+
+from flask import Flask, make_response, request, render_template, Response
+
+import metrics
+from broadcast import Broadcaster
+from shared import SharedState, snapshot_ages, snapshot_etag
+
+# shared with owner.py through the environment
+SHARED_NAME = os.environ.get("GROWROOM_SHM", "growroom")
+SOCKET = os.environ.get("GROWROOM_SOCKET", ".growroom.sock")
+
+# cached frames older than this are refreshed through the owner when a snapshot is asked for
+SNAPSHOT_TTL = 5.0
+
+# seconds between pushes of this worker's request metrics to the owner
+METRICS_INTERVAL = 5.0
+
+# headers that only apply to one hop and aren't passed on
+HOP_BY_HOP = {"connection", "keep-alive", "transfer-encoding", "te", "trailer", "upgrade", "proxy-authenticate", "proxy-authorization"}
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    '''HTTPConnection to a server listening on a Unix socket.'''
+
+    def __init__(self, path, timeout=30.0):
+
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+state = None
+state_lock = threading.Lock()
+
+
+def shared():
+    '''Returns the owner's shared state, attaching to it on first use. Raises OSError while the owner isn't up.'''
+
+    global state
+
+    with state_lock:
+        if state is None:
+            state = SharedState.attach(SHARED_NAME)
+
+    return state
+
+
+def owner_request(method, path, body=None, headers=None):
+    '''Makes a request to the owner and returns its status code, for requests whose answer goes through shared memory.'''
+
+    connection = UnixHTTPConnection(SOCKET)
+
+    try:
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        response.read()
+
+        return response.status
+    finally:
+        connection.close()
+
+
+def unavailable():
+    return make_response('''Hardware owner unavailable''', 503)
+
+
+class FrameRelay:
+    '''Rebroadcasts one camera profile's frames from shared memory to the viewers of this worker, copying every frame out once for all of them.
+    While anyone is watching, the owner's lease on the profile is renewed so it keeps the camera streaming.'''
+
+    def __init__(self, profile, poll=0.005, renew=3.0):
+
+        self.profile = profile
+        self.slot = "camera/" + profile
+        self.poll = poll
+        self.renew = renew
+        self.broadcaster = Broadcaster(2)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        '''Returns a new Subscription to the profile's frames, starting the relay if it's the first one.'''
+
+        with self.lock:
+            subscription = self.broadcaster.subscribe()
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="relay_" + self.profile, daemon=True)
+                self.thread.start()
+
+        return subscription
+
+    def run(self):
+
+        try:
+            self._relay()
+        except OSError as error:
+            # the owner's shared memory is gone, end the streams and let the next viewer start the relay again
+            print("relaying %s camera frames failed: %r" % (self.profile, error))
+
+            with self.lock:
+                subscribers = self.broadcaster.subscribers
+                self.thread = None
+
+            for subscription in subscribers:
+                subscription.close()
+
+    def _relay(self):
+
+        version = shared().version(self.slot)
+        renewed = float("-inf")
+
+        while True:
+            with self.lock:
+                if not self.broadcaster.subscribers:
+                    self.thread = None
+                    return
+
+            now = time.monotonic()
+
+            if now - renewed >= self.renew:
+                try:
+                    owner_request("POST", "/owner/camera_watch?profile=" + self.profile)
+                except OSError as error:
+                    print("renewing the %s camera lease failed: %r" % (self.profile, error))
+
+                renewed = now
+
+            # the version is polled without copying anything, frames are only copied once they changed
+            current = shared().version(self.slot)
+
+            if current != version and not current & 1:
+                value = shared().read(self.slot)
+                version = value.version
+                self.broadcaster.publish(value.data)
+            else:
+                time.sleep(self.poll)
+
+
+relays = {}
+relays_lock = threading.Lock()
+
+
+def relay(profile):
+
+    with relays_lock:
+        if profile not in relays:
+            relays[profile] = FrameRelay(profile)
+
+        return relays[profile]
+
+
+def sensor_snapshot():
+    '''Returns the owner's latest sensor snapshot, or None if it hasn't published one yet.'''
+
+    value = shared().read("sensors")
+
+    return None if value.data is None else json.loads(value.data)
+
+
+def profiles():
+    return [slot.split("/", 1)[1] for slot in shared().slots if slot.startswith("camera/")]
+
+
+def push_metrics():
+    '''Pushes this worker's request metrics to the owner forever. The owner serves them on /metrics with a "worker" label.'''
+
+    names = (metrics.HTTP_SECONDS.name, metrics.HTTP_REQUESTS.name)
+
+    while True:
+        time.sleep(METRICS_INTERVAL)
+
+        try:
+            owner_request("POST", "/owner/metrics?worker=%d" % os.getpid(), json.dumps(metrics.export(names)),
+                          {"Content-Type": "application/json"})
+        except OSError as error:
+            print("pushing request metrics failed: %r" % error)
+
+
+pusher = None
+pusher_lock = threading.Lock()
+
+
+# flask
+app = Flask(__name__)
+metrics.instrument(app)
+
+
+@app.before_request
+def start_pusher():
+
+    global pusher
+
+    # started from the first request rather than at import, so it runs in the gunicorn worker and not a parent forked from
+    if pusher is None:
+        with pusher_lock:
+            if pusher is None:
+                pusher = threading.Thread(target=push_metrics, name="metrics_pusher", daemon=True)
+                pusher.start()
+
+
+@app.route("/")
+def index():
+
+    try:
+        snapshot = sensor_snapshot()
+    except OSError:
+        return unavailable()
+
+    return render_template('index.html', relays=(snapshot or {}).get("relays", {}).keys())
+
+
+@app.route('/camera_feed')
+def camera_feed():
+
+    profile = request.args.get("profile", "full")
+
+    try:
+        if profile not in profiles():
+            return make_response('''Invalid query param "profile"''', 400)
+    except OSError:
+        return unavailable()
+
+    subscription = relay(profile).subscribe()
+
+    def stream():
+        try:
+            yield from subscription
+        finally:
+            subscription.close()
+
+    return Response(stream(), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+
+@app.route('/camera_snapshot')
+def camera_snapshot():
+
+    profile = request.args.get("profile", "full")
+
+    try:
+        if profile not in profiles():
+            return make_response('''Invalid query param "profile"''', 400)
+
+        value = shared().read("camera/" + profile)
+
+        if value.data is None or time.time() - value.timestamp > SNAPSHOT_TTL:
+            if owner_request("POST", "/owner/camera_snapshot?profile=" + profile) != 204:
+                return unavailable()
+
+            value = shared().read("camera/" + profile)
+
+    except OSError:
+        return unavailable()
+
+    # the owner answered, but nothing was ever captured to the slot
+    if value.data is None:
+        return unavailable()
+
+    # slots hold multipart chunks, the JPEG sits between the part headers and the trailing CRLF
+    frame = value.data[value.data.index(b'\r\n\r\n') + 4:-2]
+
+    return Response(frame, mimetype='image/jpeg')
+
+
+def snapshot_or_unavailable(read):
+    '''Calls "read" with the owner's sensor snapshot, answering 503 while there is none.'''
+
+    try:
+        snapshot = sensor_snapshot()
+    except OSError:
+        return unavailable()
+
+    if snapshot is None:
+        return unavailable()
+
+    return read(snapshot)
+
+
+@app.route("/DHT22")
+def read_DHT22():
+    return snapshot_or_unavailable(lambda snapshot: snapshot["DHT22"])
+
+
+@app.route("/DS18B20")
+def read_DS18B20():
+    return snapshot_or_unavailable(lambda snapshot: snapshot["DS18B20"])
+
+
+@app.route("/DS18B20/<probe>")
+def read_DS18B20_probe(probe):
+
+    def read(snapshot):
+
+        fields = snapshot["DS18B20"]
+
+        if probe not in fields["probes"]:
+            return make_response('''Unknown probe''', 404)
+
+        return {"temperature": fields["probes"][probe], "timestamp": fields["timestamp"]}
+
+    return snapshot_or_unavailable(read)
+
+
+@app.route("/LLPK1")
+def read_LLPK1():
+    return snapshot_or_unavailable(lambda snapshot: snapshot["LLPK1"])
+
+
+@app.route("/sensors")
+def read_sensors():
+
+    def read(snapshot):
+
+        etag = snapshot_etag(snapshot)
+
+        if request.if_none_match.contains(etag):
+            response = make_response("", 304)
+        else:
+            response = make_response(snapshot_ages(snapshot))
+
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+
+        return response
+
+    return snapshot_or_unavailable(read)
+
+
+@app.route("/<path:path>", methods=["GET", "POST", "PUT", "DELETE"])
+def forward(path):
+    '''Passes any other request on to the owner, streaming its response back, so e.g. /events and exports work unchanged.'''
+
+    # the owner's internal routes are only for workers, over its socket
+    if path.startswith("owner/"):
+        return make_response('''Not Found''', 404)
+
+    connection = UnixHTTPConnection(SOCKET, timeout=None)
+    headers = {name: value for name, value in request.headers.items() if name.lower() not in HOP_BY_HOP and name.lower() != "host"}
+
+    try:
+        connection.request(request.method, request.full_path, body=request.get_data() or None, headers=headers)
+        upstream = connection.getresponse()
+    except OSError:
+        connection.close()
+        return unavailable()
+
+    def body():
+        try:
+            while True:
+                chunk = upstream.read1(65536)
+
+                if not chunk:
+                    break
+
+                yield chunk
+        finally:
+            connection.close()
+
+    return Response(body(), status=upstream.status,
+                    headers=[(name, value) for name, value in upstream.getheaders() if name.lower() not in HOP_BY_HOP])